@@ -0,0 +1,166 @@
+###
+# Copyright (c) 2015, James Lu
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+Archive of relayed traffic, stored as rotating gzip-compressed JSON lines
+files. This module doesn't depend on Supybot, so that archives can be read
+back without a bot:
+
+    python archive.py /path/to/archive/directory
+"""
+
+import gzip
+import json
+import os
+import sys
+import threading
+import time
+import zlib
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+SUFFIX = '.jsonl.gz'
+
+class ArchiveWriter(object):
+    """Writes relay records to an archive directory.
+
+    Records are queued by write() and written out in batches by a background
+    thread, so that disk I/O never blocks the relay itself. Each batch is
+    flushed as soon as it is written, and a new file is started once the
+    current one holds more than <rotateSize> bytes of (uncompressed) data."""
+
+    def __init__(self, directory, rotateSize, queueSize=10000, batchSize=500,
+                 log=None):
+        self.directory = directory
+        self.rotateSize = rotateSize
+        self.batchSize = batchSize
+        self.log = log
+        self.dropped = 0
+        self._file = None
+        self._written = 0
+        self._queue = queue.Queue(queueSize)
+        self._thread = threading.Thread(target=self._run,
+                                        name='RelayNext archive writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, record):
+        """Queues <record> (a dict) to be written to the archive."""
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            # Losing an archive line is better than stalling the relay.
+            self.dropped += 1
+
+    def close(self):
+        """Writes out everything queued so far and stops the writer."""
+        self._queue.put(None)
+        self._thread.join(10)
+
+    def _open(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # Filenames sort in the order they were written in.
+        name = time.strftime('relay-%Y%m%d-%H%M%S', time.gmtime())
+        n = 0
+        while True:
+            path = os.path.join(self.directory,
+                                '%s-%03d%s' % (name, n, SUFFIX))
+            if not os.path.exists(path):
+                break
+            n += 1
+        self._file = gzip.open(path, 'wb')
+        self._written = 0
+
+    def _writeBatch(self, batch):
+        if self._file is None or self._written >= self.rotateSize:
+            if self._file is not None:
+                self._file.close()
+            self._open()
+        data = ''.join(json.dumps(record) + '\n' for record in batch)
+        data = data.encode('utf-8')
+        self._file.write(data)
+        # Make everything written so far readable, even if the bot dies
+        # before the file is closed.
+        self._file.flush()
+        self._written += len(data)
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch = [self._queue.get()]
+            while len(batch) < self.batchSize:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stop = True
+                batch = [record for record in batch if record is not None]
+            if not batch:
+                continue
+            try:
+                self._writeBatch(batch)
+            except Exception as e:
+                if self.log:
+                    self.log.warning('RelayNext: Unable to write %s records '
+                                     'to the archive: %s', len(batch), e)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def readArchive(directory):
+    """Yields the records stored in <directory>, oldest first.
+
+    The file currently being written may end abruptly; reading just stops
+    at the last complete record."""
+    names = sorted(name for name in os.listdir(directory)
+                   if name.endswith(SUFFIX))
+    for name in names:
+        f = gzip.open(os.path.join(directory, name), 'rb')
+        try:
+            for line in f:
+                if not line.endswith(b'\n'):  # Partially written
+                    break
+                yield json.loads(line.decode('utf-8'))
+        except (EOFError, IOError, zlib.error):
+            pass
+        finally:
+            f.close()
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.exit('usage: %s <archive directory>' % sys.argv[0])
+    for record in readArchive(sys.argv[1]):
+        print(json.dumps(record, sort_keys=True))
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,133 @@
+###
+# Copyright (c) 2015, James Lu
+# All rights reserved.
+###
+"""
+Throughput benchmark for RelayNext's worker pool, on synthetic traffic.
+Nothing connects anywhere: relayed messages go to stand-in Irc objects.
+
+    python RelayNext/benchmark.py [-n MESSAGES] [--relays N] [--channels N]
+                                  [--workers 0,1,2,4,8] [--delay 0,0.0002]
+
+Messages are spread evenly over --relays relays of --channels channels each
+(one channel per network), and the time is taken from the first message
+until every worker has sent out everything it was given. For each --delay
+(the seconds each queueMsg takes, standing in for a slow network) it reports
+the messages relayed per second with each number of --workers; 0 sends them
+from the receiving thread, like the plugin does by default.
+"""
+
+from __future__ import print_function
+import argparse
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+# supybot writes its conf/, data/ and logs/ to the current directory. It
+# also logs its own shutdown, so this is removed after that.
+tmpdir = tempfile.mkdtemp()
+atexit.register(shutil.rmtree, tmpdir, True)
+os.chdir(tmpdir)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import supybot.log as log
+import supybot.conf as conf
+conf.supybot.log.stdout.setValue(False)
+import supybot.ircmsgs as ircmsgs
+
+from RelayNext import plugin
+
+
+class FakeIrc(object):
+    """Stands in for a network's Irc object, counting what is sent to it."""
+
+    def __init__(self, network, delay):
+        self.network = network
+        self.delay = delay
+        self.sent = {}
+        self.lock = threading.Lock()
+
+    def queueMsg(self, msg):
+        if self.delay:
+            time.sleep(self.delay)
+        with self.lock:
+            self.sent.setdefault(msg.args[0], []).append(msg.args[1])
+
+
+def relayer(relays, networks):
+    """Returns a RelayNext that relays between <relays> on <networks>,
+    without a bot behind it."""
+    cb = plugin.RelayNext.__new__(plugin.RelayNext)
+    cb.log = log.getPluginLogger('RelayNext')
+    cb.db = relays
+    cb.networks = networks
+    cb.peers = None
+    cb.archive = None
+    cb.workers = []
+    return cb
+
+
+def run(count, nrelays, nchannels, workers, delay):
+    networks = dict(('net%d' % c, FakeIrc('net%d' % c, delay))
+                    for c in range(nchannels))
+    relays = dict(('relay%d' % r, set('#relay%d-%d@net%d' % (r, c, c)
+                                      for c in range(nchannels)))
+                  for r in range(nrelays))
+    msgs = [ircmsgs.privmsg('#relay%d-0' % (n % nrelays), 'message %d' % n,
+                            prefix='nick%d!user@host' % (n % 50))
+            for n in range(count)]
+    cb = relayer(relays, networks)
+    conf.supybot.plugins.RelayNext.workers.queueSize.setValue(count)
+    cb._startWorkers(workers)
+    source = networks['net0']
+    start = time.time()
+    for msg in msgs:
+        cb.relay(source, msg)
+    dropped = sum(getattr(cb, 'dropped', []))
+    cb._stopWorkers()
+    elapsed = time.time() - start
+    # Every relay's messages should have arrived everywhere, in order.
+    for r in range(nrelays):
+        sent = [n for n in range(count) if n % nrelays == r]
+        for c in range(1, nchannels):
+            got = networks['net%d' % c].sent.get('#relay%d-%d' % (r, c), [])
+            if [int(s.split()[-1]) for s in got] != sent[:len(got)]:
+                raise AssertionError('relay%d arrived out of order' % r)
+    return (count / elapsed, dropped)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='RelayNext worker pool throughput benchmark.')
+    parser.add_argument('-n', '--messages', type=int, default=5000,
+                        help='messages per run (default: 5000)')
+    parser.add_argument('--relays', type=int, default=200,
+                        help='relays (default: 200)')
+    parser.add_argument('--channels', type=int, default=6,
+                        help='channels per relay (default: 6)')
+    parser.add_argument('--workers', default='0,1,2,4,8',
+                        help='worker counts to try (default: 0,1,2,4,8)')
+    parser.add_argument('--delay', default='0,0.0002',
+                        help='seconds each queueMsg takes (default: 0,0.0002)')
+    args = parser.parse_args()
+    workers = [int(w) for w in args.workers.split(',')]
+    delays = [float(d) for d in args.delay.split(',')]
+    print('%d messages, %d relays x %d channels' % (args.messages,
+          args.relays, args.channels))
+    print('%-18s' % 'workers' + ''.join('%9d' % w for w in workers))
+    for delay in delays:
+        results = [run(args.messages, args.relays, args.channels, w, delay)
+                   for w in workers]
+        print('%-18s' % ('delay %gms (msg/s)' % (delay * 1e3)) +
+              ''.join('%9.0f' % rate for (rate, dropped) in results))
+        if any(dropped for (rate, dropped) in results):
+            print('(some messages were dropped)')
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -61,6 +61,19 @@ conf.registerChannelValue(RelayNext, 'noHighlight',
     registry.Boolean(False, _("""Determines whether the bot should prefix nicks
     with a hyphen (-) to prevent excess highlights (in PRIVMSGs and actions).""")))
 
+conf.registerGlobalValue(RelayNext, 'workers',
+    registry.NonNegativeInteger(0, _("""Determines how many threads are used
+    to send out relayed messages. Each relay is always handled by the same
+    thread, so messages stay in order within a relay. If this is 0, messages
+    are sent out by the thread that received them. Changes take effect when
+    the plugin is reloaded.""")))
+conf.registerGlobalValue(RelayNext.workers, 'queueSize',
+    registry.PositiveInteger(1000, _("""Determines how many relayed messages
+    may wait for each worker thread. When a worker falls this far behind
+    (for example, because a network has stalled), further messages for its
+    relays are dropped until it catches up. Changes take effect when the
+    plugin is reloaded.""")))
+
 conf.registerGroup(RelayNext, 'events')
 
 _events = ('quit', 'join', 'part', 'nick', 'mode', 'kick')
@@ -68,4 +81,36 @@ for ev in _events:
     conf.registerChannelValue(RelayNext.events, 'relay%ss' % ev,
         registry.Boolean(True, """Determines whether the bot should relay %ss.""" % ev))
 
+conf.registerGroup(RelayNext, 'archive')
+conf.registerGlobalValue(RelayNext.archive, 'directory',
+    registry.String('', _("""Determines the directory where relayed
+    traffic is archived, as gzip-compressed JSON lines files (one record per
+    relayed event, no matter how many channels it was relayed to). If this
+    is empty, nothing is archived. Changes take effect when the plugin is
+    reloaded.""")))
+conf.registerGlobalValue(RelayNext.archive, 'rotateSize',
+    registry.PositiveInteger(10485760, _("""Determines how much data (in
+    bytes, before compression) is written to an archive file before starting
+    a new one.""")))
+
+conf.registerGroup(RelayNext, 'election')
+conf.registerGlobalValue(RelayNext.election, 'directory',
+    registry.String('', _("""Determines the directory this bot shares with
+    other bots running RelayNext on the same machine. Each bot keeps a
+    heartbeat file there listing the channels it is in, and only one live
+    bot in both channels is elected to relay between them. If this is empty,
+    leader election is disabled and this bot relays everything.""")))
+conf.registerGlobalValue(RelayNext.election, 'id',
+    registry.String('', _("""Determines the name this bot uses in the
+    election directory. This must be unique among the bots sharing the
+    directory; if empty, the bot's nick is used.""")))
+conf.registerGlobalValue(RelayNext.election, 'interval',
+    registry.PositiveInteger(2, _("""Determines how often (in seconds) the
+    bot refreshes its heartbeat. Changes take effect when the plugin is
+    reloaded.""")))
+conf.registerGlobalValue(RelayNext.election, 'timeout',
+    registry.PositiveInteger(6, _("""Determines how long (in seconds) a bot
+    may go without refreshing its heartbeat before the others consider it
+    gone and take over its relays.""")))
+
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -29,8 +29,30 @@
 ###
 
 from copy import deepcopy
+import hashlib
+import json
+import os
 import pickle
 import re
+import threading
+import time
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+try:
+    from os import replace
+except ImportError:  # Python 2
+    def replace(src, dst):
+        """os.rename, which on Windows won't overwrite <dst>: then <dst> is
+        removed first (so that is not atomic there)."""
+        try:
+            os.rename(src, dst)
+        except OSError:
+            if not os.path.exists(dst):
+                raise
+            os.remove(dst)
+            os.rename(src, dst)
 
 import supybot.world as world
 import supybot.irclib as irclib
@@ -41,6 +63,7 @@ from supybot.commands import *
 import supybot.plugins as plugins
 import supybot.ircutils as ircutils
 import supybot.callbacks as callbacks
+import supybot.schedule as schedule
 try:
     from supybot.i18n import PluginInternationalization
     _ = PluginInternationalization('RelayNext')
@@ -49,6 +72,7 @@ except ImportError:
     # without the i18n module
     _ = lambda x: x
 
+from . import archive
 
 filename = conf.supybot.directories.data.dirize("RelayNext.db")
 
@@ -96,11 +120,225 @@ class RelayNext(callbacks.Plugin):
         world.flushers.append(self.exportDB)
         self.initializeNetworks()
 
+        # The live bots sharing our election directory, mapped to the
+        # channels they are in, or None if leader election is disabled (in
+        # which case we relay everything).
+        self.peers = None
+        schedule.addPeriodicEvent(self.heartbeat,
+                                  self.registryValue('election.interval'),
+                                  name='RelayNext.heartbeat')
+
+        self.archive = None
+        archivedir = self.registryValue('archive.directory')
+        if archivedir:
+            self.archive = archive.ArchiveWriter(archivedir,
+                self.registryValue('archive.rotateSize'), log=self.log)
+
+        self.workers = []
+        self._startWorkers(self.registryValue('workers'))
+
     def die(self):
         self.exportDB()
         world.flushers.remove(self.exportDB)
+        self._stopWorkers()
+        if self.archive:
+            self.archive.close()
+        schedule.removePeriodicEvent('RelayNext.heartbeat')
+        # Remove our heartbeat so that the other bots take over our relays
+        # right away, instead of waiting for it to time out.
+        path = self._heartbeatPath()
+        if path:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
         self.__parent.die()
 
+    ### Leader election
+
+    def _electionId(self):
+        """Returns the name we use in the election directory."""
+        botid = self.registryValue('election.id') or conf.supybot.nick()
+        # This is used as a filename, so keep it to something safe.
+        return re.sub(r'[^\w.-]', '_', botid)
+
+    def _heartbeatPath(self):
+        directory = self.registryValue('election.directory')
+        if directory:
+            return os.path.join(directory, self._electionId() + '.heartbeat')
+
+    def _joinedChannels(self):
+        """Returns the #channel@network we are in, on the networks we are
+        connected to."""
+        channels = []
+        for irc in world.ircs:
+            if irc.zombie or not irc.afterConnect:
+                continue
+            for channel in irc.state.channels:
+                channels.append(('%s@%s' % (channel, irc.network)).lower())
+        return sorted(channels)
+
+    def _readHeartbeat(self, path):
+        """Returns the set of channels in a peer's heartbeat file, or None if
+        it isn't one."""
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            channels = data['channels']
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+        if not isinstance(channels, list):
+            return None
+        return set(channels)
+
+    def heartbeat(self):
+        """Refreshes our heartbeat file and the list of live peers.
+
+        Each bot writes its own file in the election directory, listing the
+        channels it is in, so no locking is needed: a bot is considered live
+        for as long as its file has been modified within the last
+        election.timeout seconds."""
+        path = self._heartbeatPath()
+        if not path:
+            self.peers = None
+            return
+        directory = os.path.dirname(path)
+        timeout = self.registryValue('election.timeout')
+        channels = self._joinedChannels()
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # Write it under another name first, so that the others never
+            # read half a file.
+            tmp = os.path.join(directory, '.%s.tmp' % self._electionId())
+            with open(tmp, 'w') as f:
+                json.dump({'id': self._electionId(), 'channels': channels}, f)
+            replace(tmp, path)
+            now = time.time()
+            peers = {}
+            for name in os.listdir(directory):
+                if not name.endswith('.heartbeat') or name.startswith('.'):
+                    continue
+                peerpath = os.path.join(directory, name)
+                try:
+                    mtime = os.path.getmtime(peerpath)
+                except OSError:  # Removed while we were looking
+                    continue
+                if now - mtime > timeout:
+                    continue
+                peerchannels = self._readHeartbeat(peerpath)
+                if peerchannels is not None:
+                    peers[name[:-len('.heartbeat')]] = peerchannels
+        except (IOError, OSError) as e:
+            # Relaying twice is better than not relaying at all.
+            self.log.warning('RelayNext: Unable to update heartbeat in %s, '
+                             'relaying everything: %s', directory, e)
+            self.peers = None
+            return
+        peers[self._electionId()] = set(channels)
+        if peers != self.peers:
+            self.log.debug('RelayNext: live bots in election: %s', peers)
+        self.peers = peers
+
+    def _isLeader(self, rid, source, target=None):
+        """Returns whether we are the bot elected to relay <rid> from the
+        #channel@network <source> (to <target>, if given).
+
+        Only bots that are in <source> (and <target>) take part, so a bot
+        that drops off a network hands those relays over to the others. The
+        leader is chosen among them by rendezvous hashing on <rid>, so every
+        bot agrees on it without talking to each other, relays are spread
+        out among the bots, and only the relays of a bot that goes away
+        change hands."""
+        peers = self.peers
+        if not peers:
+            return True
+        candidates = [peer for (peer, channels) in peers.items()
+                      if source in channels and
+                      (target is None or target in channels)]
+        if not candidates:
+            return False
+        def weight(peer):
+            s = '%s %s' % (rid, peer)
+            return hashlib.md5(s.encode('utf-8')).hexdigest()
+        return max(candidates, key=weight) == self._electionId()
+
+    ### Worker pool
+
+    def _startWorkers(self, count):
+        """Starts <count> threads to send out relayed messages.
+
+        Each relay is always handled by the same worker (chosen by a hash of
+        its ID), so messages keep their order within a relay, while separate
+        relays are sent out in parallel. Each worker's queue holds at most
+        workers.queueSize messages; see _queue."""
+        maxsize = self.registryValue('workers.queueSize')
+        for n in range(count):
+            q = queue.Queue(maxsize)
+            t = threading.Thread(target=self._worker, args=(q,),
+                                 name='RelayNext worker %d' % n)
+            t.daemon = True
+            t.start()
+            self.workers.append((q, t))
+        # How many messages each worker has had to drop since it last
+        # caught up.
+        self.dropped = [0] * len(self.workers)
+
+    def _queue(self, rid, job):
+        """Hands <job> to the worker for relay <rid>.
+
+        If the worker's queue is full, the message is dropped rather than
+        letting a stalled network use up memory."""
+        n = hash(rid) % len(self.workers)
+        try:
+            self.workers[n][0].put_nowait(job)
+        except queue.Full:
+            if not self.dropped[n]:
+                self.log.warning('RelayNext: worker %d is %d messages behind, '
+                                 'dropping relayed messages.', n,
+                                 self.workers[n][0].maxsize)
+            self.dropped[n] += 1
+        else:
+            if self.dropped[n]:
+                self.log.warning('RelayNext: worker %d caught up after '
+                                 'dropping %d relayed messages.', n,
+                                 self.dropped[n])
+                self.dropped[n] = 0
+
+    def _stopWorkers(self):
+        # Let the workers finish what they have queued first, unless a
+        # worker is so far behind that its queue is full (a stalled
+        # network): then its backlog is dropped, so that unloading never
+        # waits on it for more than the join timeout.
+        for (n, (q, t)) in enumerate(self.workers):
+            try:
+                q.put_nowait(None)
+            except queue.Full:
+                dropped = 0
+                while True:
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        break
+                    dropped += 1
+                self.log.warning('RelayNext: worker %d is stalled, dropping '
+                                 '%d queued messages.', n, dropped)
+                q.put_nowait(None)
+        for (q, t) in self.workers:
+            t.join(10)
+        self.workers = []
+
+    def _worker(self, q):
+        while True:
+            job = q.get()
+            if job is None:
+                return
+            try:
+                self._deliver(*job)
+            except Exception:
+                self.log.exception('RelayNext: error sending relayed '
+                                   'message:')
+
     ### Relayer core
 
     def simpleHash(self, s):
@@ -199,6 +437,23 @@ class RelayNext(callbacks.Plugin):
             s = s.replace("- -", "-", 1)
         return s
 
+    def _text(self, msg):
+        """Returns the text sent with <msg> as it was sent, and whether it
+        was an ACTION: the message, part or quit reason, new nick, or modes
+        set."""
+        if msg.command == 'PRIVMSG':
+            text = msg.args[1]
+            if re.match('^\x01ACTION .*\x01$', text):
+                return (text[8:-1], True)
+            return (text, False)
+        elif msg.command == 'PART':
+            return (msg.args[1] if len(msg.args) > 1 else '', False)
+        elif msg.command in ('QUIT', 'NICK'):
+            return (msg.args[0], False)
+        elif msg.command == 'MODE':
+            return (' '.join(msg.args[1:]), False)
+        return ('', False)
+
     def relay(self, irc, msg, channel=None):
         channel = channel or msg.args[0]
         # Get the source channel
@@ -206,24 +461,52 @@ class RelayNext(callbacks.Plugin):
         source = source.lower()
         out_s = self._format(irc, msg)
         if out_s:
-            for relay in self.db.values():
-                if source in relay:  # If our channel is in a relay
-                    # Remove ourselves so we don't get duplicated messages
-                    targets = deepcopy(relay)
-                    targets.remove(source)
-                    for cn in targets:
-                        target, net = cn.split("@")
-                        if net not in self.networks.keys():
-                            self.initializeNetworks()
-                        try:
-                            otherIrc = self.networks[net]
-                        except KeyError:
-                            self.log.debug("RelayNext: message to %s dropped, we "
-                                           "are not connected there!", net)
-                        else:
-                            out_msg = ircmsgs.privmsg(target, out_s)
-                            out_msg.tag('relayedMsg')
-                            otherIrc.queueMsg(out_msg)
+            for rid, relay in self.db.items():
+                if source not in relay:
+                    continue
+                # One bot archives each message: the one elected among those
+                # that saw it.
+                if self.archive and self._isLeader(rid, source):
+                    (text, action) = self._text(msg)
+                    self.archive.write({'time': time.time(),
+                        'relay': rid, 'source': source,
+                        'command': msg.command, 'nick': msg.nick,
+                        'text': text, 'action': action,
+                        'line': ircutils.stripFormatting(out_s)})
+                # Send to the channels we're the bot elected to relay to,
+                # leaving out ourselves so we don't get duplicated messages
+                targets = [cn for cn in relay if cn != source and
+                           self._isLeader(rid, source, cn)]
+                if targets:
+                    # Networks are looked up here, so that workers never
+                    # touch self.networks.
+                    job = (self._resolve(targets), out_s)
+                    if self.workers:
+                        self._queue(rid, job)
+                    else:
+                        self._deliver(*job)
+
+    def _resolve(self, targets):
+        """Returns [(irc, channel)] for the #channel@network in <targets>
+        that we are connected to."""
+        resolved = []
+        for cn in targets:
+            target, net = cn.split("@")
+            if net not in self.networks.keys():
+                self.initializeNetworks()
+            try:
+                resolved.append((self.networks[net], target))
+            except KeyError:
+                self.log.debug("RelayNext: message to %s dropped, we "
+                               "are not connected there!", net)
+        return resolved
+
+    def _deliver(self, resolved, out_s):
+        """Sends <out_s> to each (irc, channel) in <resolved>."""
+        for (otherIrc, target) in resolved:
+            out_msg = ircmsgs.privmsg(target, out_s)
+            out_msg.tag('relayedMsg')
+            otherIrc.queueMsg(out_msg)
 
     def doPrivmsg(self, irc, msg):
         self.relay(irc, msg)
@@ -28,9 +28,208 @@
 
 ###
 
+import json
+import os
+import shutil
+import tempfile
+import threading
+
 from supybot.test import *
 
+from . import archive
+
 class RelayNextTestCase(PluginTestCase):
     plugins = ('RelayNext',)
 
+    def setUp(self):
+        PluginTestCase.setUp(self)
+        self.electiondir = tempfile.mkdtemp()
+        conf.supybot.plugins.RelayNext.election.id.setValue('bot1')
+
+    def tearDown(self):
+        conf.supybot.plugins.RelayNext.election.directory.setValue('')
+        conf.supybot.plugins.RelayNext.election.id.setValue('')
+        shutil.rmtree(self.electiondir)
+        PluginTestCase.tearDown(self)
+
+    def testElectionDisabled(self):
+        cb = self.irc.getCallback('RelayNext')
+        cb.heartbeat()
+        self.assertEqual(cb.peers, None)
+        self.assertTrue(cb._isLeader('test', '#one@test', '#two@test'))
+
+    def _peer(self, name, channels):
+        with open(os.path.join(self.electiondir, name + '.heartbeat'),
+                  'w') as f:
+            json.dump({'id': name, 'channels': channels}, f)
+
+    def testElection(self):
+        conf.supybot.plugins.RelayNext.election.directory.setValue(
+            self.electiondir)
+        cb = self.irc.getCallback('RelayNext')
+        self.irc.afterConnect = True
+        for channel in ('#one', '#two'):
+            self.irc.feedMsg(ircmsgs.join(channel, prefix=self.prefix))
+        cb.heartbeat()
+        self.assertEqual(cb.peers, {'bot1': set(['#one@test', '#two@test'])})
+        self.assertTrue(os.path.exists(os.path.join(self.electiondir,
+                                                    'bot1.heartbeat')))
+        # Another live bot in the same channels: relays are split between
+        # the two of us.
+        self._peer('bot2', ['#one@test', '#two@test'])
+        # Files that aren't heartbeats don't count.
+        open(os.path.join(self.electiondir, 'bot3.heartbeat'), 'w').close()
+        open(os.path.join(self.electiondir, 'notes.txt'), 'w').close()
+        cb.heartbeat()
+        self.assertEqual(sorted(cb.peers), ['bot1', 'bot2'])
+        rids = ['relay%d' % n for n in range(20)]
+        ours = [rid for rid in rids
+                if cb._isLeader(rid, '#one@test', '#two@test')]
+        self.assertTrue(0 < len(ours) < len(rids))
+        # The other bot leaves #two: it can't relay there any more, so we
+        # take over.
+        self._peer('bot2', ['#one@test'])
+        cb.heartbeat()
+        self.assertTrue(all(cb._isLeader(rid, '#one@test', '#two@test')
+                            for rid in rids))
+        # And we leave #two too: nobody can relay there.
+        self.irc.feedMsg(ircmsgs.part('#two', prefix=self.prefix))
+        cb.heartbeat()
+        self.assertFalse(any(cb._isLeader(rid, '#one@test', '#two@test')
+                             for rid in rids))
+        # The other bot goes away: we take over everything.
+        self._peer('bot2', ['#one@test', '#two@test'])
+        os.utime(os.path.join(self.electiondir, 'bot2.heartbeat'), (0, 0))
+        cb.heartbeat()
+        self.assertEqual(list(cb.peers), ['bot1'])
+        self.assertTrue(all(cb._isLeader(rid, '#one@test') for rid in rids))
+
+    def testWorkers(self):
+        cb = self.irc.getCallback('RelayNext')
+        cb._startWorkers(3)
+        self.assertNotError('relaynext set test #one@test #two@test')
+        self.assertNotError('relaynext set test2 #three@test #four@test')
+        for n in range(20):
+            self.irc.feedMsg(ircmsgs.privmsg('#one', 'one %d' % n,
+                                             prefix='foo!bar@baz'))
+            self.irc.feedMsg(ircmsgs.privmsg('#three', 'three %d' % n,
+                                             prefix='foo!bar@baz'))
+        cb._stopWorkers()
+        relayed = {'#two': [], '#four': []}
+        msg = self.irc.takeMsg()
+        while msg:
+            relayed[msg.args[0]].append(msg.args[1].split()[-1])
+            msg = self.irc.takeMsg()
+        # Both relays got everything, each in order.
+        self.assertEqual(relayed['#two'], [str(n) for n in range(20)])
+        self.assertEqual(relayed['#four'], [str(n) for n in range(20)])
+
+    def _stalledWorker(self, cb):
+        """Starts one worker with room for two messages, on a stalled
+        network: it can't send anything until the returned event is set.
+        Then relays ten messages through it."""
+        conf.supybot.plugins.RelayNext.workers.queueSize.setValue(2)
+        try:
+            cb._startWorkers(1)
+        finally:
+            conf.supybot.plugins.RelayNext.workers.queueSize.setValue(1000)
+        sending = threading.Event()
+        stalled = threading.Event()
+        deliver = cb._deliver
+        def stalledDeliver(*args):
+            sending.set()
+            stalled.wait()
+            deliver(*args)
+        cb._deliver = stalledDeliver
+        self.assertNotError('relaynext set test #one@test #two@test')
+        for n in range(10):
+            self.irc.feedMsg(ircmsgs.privmsg('#one', 'one %d' % n,
+                                             prefix='foo!bar@baz'))
+            if n == 0:
+                sending.wait(10)
+        return stalled
+
+    def _relayed(self):
+        relayed = []
+        msg = self.irc.takeMsg()
+        while msg:
+            relayed.append(msg.args[1].split()[-1])
+            msg = self.irc.takeMsg()
+        return relayed
+
+    def testWorkersFull(self):
+        cb = self.irc.getCallback('RelayNext')
+        stalled = self._stalledWorker(cb)
+        # One message being sent, two waiting, and the rest dropped.
+        self.assertEqual(cb.dropped, [7])
+        # The network recovers, and the worker catches up.
+        q = cb.workers[0][0]
+        stalled.set()
+        for _ in range(500):
+            if q.empty():
+                break
+            time.sleep(0.01)
+        cb._stopWorkers()
+        del cb._deliver
+        self.assertEqual(self._relayed(), ['0', '1', '2'])
+
+    def testStopStalled(self):
+        cb = self.irc.getCallback('RelayNext')
+        stalled = self._stalledWorker(cb)
+        q = cb.workers[0][0]
+        # Unloading doesn't wait for a full queue: its backlog is dropped.
+        stopper = threading.Thread(target=cb._stopWorkers)
+        stopper.start()
+        for _ in range(500):
+            if q.qsize() == 1:  # just the stop signal.
+                break
+            time.sleep(0.01)
+        self.assertEqual(q.qsize(), 1)
+        stalled.set()
+        stopper.join(10)
+        self.assertFalse(stopper.is_alive())
+        del cb._deliver
+        self.assertEqual(self._relayed(), ['0'])
+
+    def testArchive(self):
+        directory = os.path.join(self.electiondir, 'archive')
+        writer = archive.ArchiveWriter(directory, rotateSize=1)
+        for n in range(5):
+            writer.write({'relay': 'test', 'text': 'message %d' % n})
+            # Let the writer catch up so that writes don't all end up in
+            # the same batch.
+            time.sleep(0.05)
+        writer.close()
+        # Every batch goes over rotateSize, so there should be several files.
+        self.assertTrue(len(os.listdir(directory)) > 1)
+        self.assertEqual([r['text'] for r in archive.readArchive(directory)],
+                         ['message %d' % n for n in range(5)])
+
+    def testArchiveRelay(self):
+        directory = os.path.join(self.electiondir, 'archive')
+        cb = self.irc.getCallback('RelayNext')
+        cb.archive = archive.ArchiveWriter(directory, rotateSize=10000)
+        self.assertNotError('relaynext set test #one@test #two@test')
+        conf.supybot.plugins.RelayNext.noHighlight.setValue(True)
+        try:
+            self.irc.feedMsg(ircmsgs.privmsg('#one', 'hello world',
+                                             prefix='foo!bar@baz'))
+            self.irc.feedMsg(ircmsgs.action('#one', 'waves',
+                                            prefix='foo!bar@baz'))
+        finally:
+            conf.supybot.plugins.RelayNext.noHighlight.setValue(False)
+        self.assertNotError('relaynext clear')
+        cb.archive.close()
+        records = list(archive.readArchive(directory))
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]['relay'], 'test')
+        self.assertEqual(records[0]['source'], '#one@test')
+        self.assertEqual(records[0]['nick'], 'foo')
+        # The message as it was sent, and as it was relayed.
+        self.assertEqual(records[0]['text'], 'hello world')
+        self.assertFalse(records[0]['action'])
+        self.assertTrue(records[0]['line'].endswith('<-foo> hello world'))
+        self.assertEqual(records[1]['text'], 'waves')
+        self.assertTrue(records[1]['action'])
+
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -26,10 +26,24 @@ __contributors__ = {}
 __url__ = '' # 'http://supybot.com/Members/yourname/Weather/download'
 
 from . import config
+from . import cache
+from . import render
+from . import metrics
+from . import extract
+from . import gazetteer
+from . import providers
+from . import userfile
 from . import plugin
 from imp import reload
 # In case we're being reloaded.
 reload(config)
+reload(cache)
+reload(render)
+reload(metrics)
+reload(extract)
+reload(gazetteer)
+reload(providers)
+reload(userfile)
 reload(plugin)
 
 # Add more reloads here if you add third-party modules and want them to be
@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+###
+# Copyright (c) 2012-2014, spline
+# All rights reserved.
+###
+"""
+Latency benchmark for the Weather plugin. Runs against the local fixture
+server, so it needs no API key or network access:
+
+    python benchmark.py [-n REPEAT] [--delay SECONDS]
+
+For each combination of output options it reports median and 95th
+percentile times for:
+
+    parse   decoding the API response (and pruning it, see extract.py)
+    format  building the replies (render.Renderer)
+    old     building the same replies the way the plugin did before
+            render.Renderer, filling in every field on each call (see
+            oldformat(); temperatures are colored the same way in both)
+    total   fetching from the fixture server, parsing and formatting
+
+--delay makes the fixture server wait before every response, to stand in
+for a real network.
+
+    python benchmark.py --decode [FILE] [-n REPEAT]
+
+compares the ways an API response can be decoded (see extract.py) on FILE,
+by default the hourly10day response in fixtures/: CPU time, and with
+python 3 the peak memory while decoding and the memory the result keeps.
+
+    python benchmark.py --users [COUNT] [-n REPEAT]
+
+times WeatherDB, the user store, on a new Weather.db of COUNT users
+(default 50000): loading them into memory, lookups from memory against
+the SQLite query each lookup used to make, and reads mixed with writes
+from 1 and 8 threads sharing the connection pool.
+"""
+
+from __future__ import print_function
+import argparse
+import atexit
+import gc
+import json
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+try:
+    import tracemalloc
+    clock = time.process_time
+except ImportError:  # python2
+    tracemalloc = None
+    clock = time.clock
+try:
+    from urllib.request import urlopen
+except ImportError:  # python2
+    from urllib2 import urlopen
+
+from extract import ijson, prune, stream
+from fixtureserver import FIXTURES, FixtureServer
+from render import Renderer, coloredtemp
+import supybot.ircutils as ircutils
+import supybot.utils as utils
+
+# (name, API features, Renderer options, extra replies).
+COMBINATIONS = [
+    ('default', ['conditions', 'forecast'], dict(imperial=True, both=True, colortemp=True), []),
+    ('--metric', ['conditions', 'forecast'], dict(imperial=False, both=False, colortemp=True), []),
+    ('--nocolortemp', ['conditions', 'forecast'], dict(imperial=True, both=True, colortemp=False), []),
+    ('extras on main line', ['conditions', 'forecast'],
+     dict(imperial=True, both=True, colortemp=True, humidity=True, extras=Renderer.EXTRAS, updated=True), []),
+    ('--forecast', ['conditions', 'forecast'], dict(imperial=True, both=True, colortemp=True), ['forecast']),
+    ('--alerts --almanac --astronomy', ['conditions', 'forecast', 'alerts', 'almanac', 'astronomy'],
+     dict(imperial=True, both=True, colortemp=True), ['alerts', 'almanac', 'astronomy']),
+    ('everything', ['conditions', 'forecast', 'alerts', 'almanac', 'astronomy'],
+     dict(imperial=True, both=True, colortemp=True, humidity=True, extras=Renderer.EXTRAS, updated=True),
+     ['alerts', 'almanac', 'astronomy', 'forecast']),
+]
+
+
+def wind(angle):
+    """Stand-in for Weather._wind."""
+    return ['N', 'NE', 'E', 'SE', 'S', 'SW', 'W', 'NW'][int(round(angle / 45.0)) % 8]
+
+
+def oldformat(data, imperial, both, colortemp, humidity=False, extras=(), updated=False, replies=()):
+    """The replies as the plugin's wunderground() built them before render.Renderer."""
+
+    bold = ircutils.bold
+    def bu(string):
+        return ircutils.underline(ircutils.bold(string))
+    def tw(x):
+        return coloredtemp(x) if colortemp else x
+    co = data['current_observation']
+    outdata = {}
+    outdata['weather'] = co['weather']
+    outdata['location'] = co['display_location']['full']
+    outdata['humidity'] = co['relative_humidity']
+    outdata['uv'] = co['UV']
+    if co['wind_mph'] < 1:  # no wind.
+        outdata['wind'] = "None"
+    elif imperial:
+        outdata['wind'] = "{0}@{1}mph".format(wind(co['wind_degrees']), co['wind_mph'])
+        if int(co['wind_gust_mph']) > 0:
+            outdata['wind'] += " ({0}mph gusts)".format(co['wind_gust_mph'])
+    else:
+        outdata['wind'] = "{0}@{1}kph".format(wind(co['wind_degrees']), co['wind_kph'])
+        if int(co['wind_gust_kph']) > 0:
+            outdata['wind'] += " ({0}kph gusts)".format(co['wind_gust_kph'])
+    observationTime = co.get('observation_epoch')
+    localTime = co.get('local_epoch')
+    if not observationTime or not localTime:
+        outdata['observation'] = co.get('observation_time', 'unknown').lstrip('Last Updated on ')
+    else:
+        s = int(localTime) - int(observationTime)
+        if s <= 1:
+            outdata['observation'] = 'just now'
+        elif s < 60:
+            outdata['observation'] = '{0}s ago'.format(s)
+        elif s < 120:
+            outdata['observation'] = '1m ago'
+        elif s < 3600:
+            outdata['observation'] = '{0}m ago'.format(s // 60)
+        elif s < 7200:
+            outdata['observation'] = '1hr ago'
+        else:
+            outdata['observation'] = '{0}hrs ago'.format(s // 3600)
+    for (name, base, isTemp) in [('temp', 'temp', True), ('dewpoint', 'dewpoint', True), ('heatindex', 'heat_index', True),
+                                 ('windchill', 'windchill', True), ('feelslike', 'feelslike', True)]:
+        f, c = tw(str(co[base + '_f']) + 'F'), tw(str(co[base + '_c']) + 'C')
+        outdata[name] = "{0}/{1}".format(f, c) if both else (f if imperial else c)
+    (pin, pmb) = (str(co['pressure_in']) + 'in', str(co['pressure_mb']) + 'mb')
+    outdata['pressure'] = "{0}/{1}".format(pin, pmb) if both else (pin if imperial else pmb)
+    (vmi, vkm) = (str(co['visibility_mi']) + 'mi', str(co['visibility_km']) + 'km')
+    outdata['visibility'] = "{0}/{1}".format(vmi, vkm) if both else (vmi if imperial else vkm)
+    forecastdata = {}
+    for forecastday in data['forecast']['txt_forecast']['forecastday']:
+        forecastdata[int(forecastday['period'])] = {'day': forecastday['title'],
+            'text': forecastday['fcttext'] if imperial else forecastday['fcttext_metric']}
+    output = "{0} :: {1} ::".format(bold(outdata['location']), outdata['weather'])
+    output += " {0}".format(outdata['temp'])
+    if humidity:
+        output += " (Humidity: {0}) ".format(outdata['humidity'])
+    else:
+        output += " "
+    if not outdata['windchill'].startswith("NA"):
+        output += "| {0} {1} ".format(bold('Wind Chill:'), outdata['windchill'])
+    if not outdata['heatindex'].startswith("NA"):
+        output += "| {0} {1} ".format(bold('Heat Index:'), outdata['heatindex'])
+    for k in extras:
+        output += "| {0}: {1} ".format(bold(k.title()), outdata[k])
+    output += "| {0}: {1}".format(bold(forecastdata[0]['day']), forecastdata[0]['text'])
+    output += " {0}: {1}".format(bold(forecastdata[1]['day']), forecastdata[1]['text'])
+    if updated:
+        output += " | {0} {1}".format(bold('Updated:'), outdata['observation'])
+    output = [output]
+    unit, scale = ('F', 'fahrenheit') if imperial else ('C', 'celsius')
+    if 'alerts' in replies:
+        if data['alerts']:
+            alert = utils.str.normalizeWhitespace(data['alerts'][0]['message'].replace('\n', ' ')[:300])
+        else:
+            alert = "No alerts."
+        output.append("{0} :: {1}".format(bu("Alerts:"), alert))
+    if 'almanac' in replies:
+        high, low = data['almanac']['temp_high'], data['almanac']['temp_low']
+        highyear, lowyear = high.get('recordyear', 'NA'), low.get('recordyear', 'NA')
+        if highyear != "NA" and lowyear != "NA":
+            highrecord, lowrecord = high['record'][unit] + unit, low['record'][unit] + unit
+        else:
+            highrecord, lowrecord = "NA", "NA"
+        output.append("{0} :: Normal High: {1} (Record: {2} in {3}) | Normal Low: {4} (Record: {5} in {6})".format(
+            bu('Almanac:'), tw(high['normal'][unit] + unit), tw(highrecord), highyear,
+            tw(low['normal'][unit] + unit), tw(lowrecord), lowyear))
+    if 'astronomy' in replies:
+        moon = data['moon_phase']
+        sunriseh, sunrisem = moon['sunrise']['hour'], moon['sunrise']['minute']
+        sunseth, sunsetm = moon['sunset']['hour'], moon['sunset']['minute']
+        lengthofday = "%dh%dm" % divmod((((int(sunseth)-int(sunriseh))+float((int(sunsetm)-int(sunrisem))/60.0))*60),60)
+        output.append("{0} :: Moon illum: {1}%   Moon age: {2}d   Sunrise: {3}  Sunset: {4}  Length of Day: {5}".format(
+            bu('Astronomy:'), moon['percentIlluminated'], moon['ageOfMoon'], "{0}:{1}".format(sunriseh, sunrisem),
+            "{0}:{1}".format(sunseth, sunsetm), lengthofday))
+    if 'forecast' in replies:
+        outforecast = []
+        for forecastday in data['forecast']['simpleforecast']['forecastday']:
+            outforecast.append("{0}: {1} ({2}/{3})".format(bold(forecastday['date']['weekday_short']), forecastday['conditions'],
+                tw(forecastday['high'][scale] + unit), tw(forecastday['low'][scale] + unit)))
+        output.append("{0} :: {1}".format(bu('Forecast:'), " | ".join(outforecast)))
+    return output
+
+
+def renderer(imperial, both, colortemp, humidity=False, extras=(), updated=False):
+    return Renderer(imperial, both, colortemp, humidity, extras, updated, wind)
+
+
+def percentiles(times):
+    times = sorted(times)
+    return (times[len(times) // 2], times[min(len(times) - 1, int(len(times) * 0.95))])
+
+
+def run(server, features, options, replies, repeat):
+    url = '%sapi/KEY/%slang:EN/bestfct:1/pws:0/q/10002.json' % (server.url, ''.join(f + '/' for f in features))
+    r = renderer(**options)
+    parse, format, old, total = [], [], [], []
+    for _ in range(repeat):
+        start = time.time()
+        body = urlopen(url).read()
+        fetched = time.time()
+        data = prune(json.loads(body.decode('utf-8')))
+        parsed = time.time()
+        output = [r.main(data)]
+        for reply in replies:
+            output.append(getattr(r, reply)(data))
+        done = time.time()
+        oldformat(data, replies=replies, **options)
+        old.append(time.time() - done)
+        parse.append(parsed - fetched)
+        format.append(done - parsed)
+        total.append(done - start)
+    return (percentiles(parse), percentiles(format), percentiles(old), percentiles(total))
+
+
+# (name, function decoding a response).
+DECODERS = [
+    ('json', lambda page: json.loads(page.decode('utf-8'))),
+    ('json, pruned', lambda page: prune(json.loads(page.decode('utf-8')))),
+    ('stream', stream),
+]
+
+
+def decode(filename, repeat):
+    with open(filename, 'rb') as f:
+        page = f.read()
+    print('{0}: {1} bytes'.format(filename, len(page)))
+    print('{0:<16} {1:>17} {2:>9} {3:>9} {4:>8}'.format('decoder', 'cpu p50/p95 ms', 'peak KB', 'kept KB', 'JSON KB'))
+    for (name, decoder) in DECODERS:
+        if decoder is stream and ijson is None:
+            print('{0:<16} needs ijson.'.format(name))
+            continue
+        cpu = []
+        for _ in range(repeat):
+            start = clock()
+            decoder(page)
+            cpu.append(clock() - start)
+        cpu = percentiles(cpu)
+        peak = kept = float('nan')
+        if tracemalloc:
+            gc.collect()
+            tracemalloc.start()
+            data = decoder(page)
+            (kept, peak) = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        else:
+            data = decoder(page)
+        print('{0:<16} {1:>8.2f}/{2:<8.2f} {3:>9.0f} {4:>9.0f} {5:>8.0f}'.format(
+            name, cpu[0] * 1e3, cpu[1] * 1e3, peak / 1024.0, kept / 1024.0, len(json.dumps(data)) / 1024.0))
+
+
+def userdb():
+    """Return the WeatherDB class and a temporary directory for it.
+
+    Importing the plugin starts supybot, which writes its conf/, data/ and
+    logs/ to the current directory, so this moves there first."""
+
+    tmpdir = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, tmpdir, True)  # after supybot logs its shutdown.
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    os.chdir(tmpdir)
+    import supybot.log
+    import supybot.conf as conf
+    conf.supybot.log.stdout.setValue(False)
+    from Weather.plugin import WeatherDB
+    return (WeatherDB, tmpdir)
+
+
+def percall(func, nicks):
+    start = time.time()
+    for nick in nicks:
+        func(nick)
+    return (time.time() - start) / len(nicks)
+
+
+def users(count, repeat):
+    (WeatherDB, tmpdir) = userdb()
+    filename = os.path.join(tmpdir, 'Weather.db')
+    db = WeatherDB(filename)
+    start = time.time()
+    db.importusers({'nick': 'user%d' % n, 'location': '%05d' % (n % 100000), 'metric': n % 2} for n in range(count))
+    print('{0} users, imported in {1:.0f} ms'.format(count, (time.time() - start) * 1e3))
+    db.close()
+    db = WeatherDB(filename)
+    if tracemalloc:
+        tracemalloc.start()
+    start = time.time()
+    db.getweather('user0')
+    loaded = time.time() - start
+    memory = tracemalloc.get_traced_memory()[0] if tracemalloc else float('nan')
+    if tracemalloc:
+        tracemalloc.stop()
+    print('load into memory: {0:.0f} ms, {1:.1f} MB'.format(loaded * 1e3, memory / 1048576.0))
+    nicks = ['user%d' % random.randrange(count) for _ in range(repeat * 50)]
+
+    def sqlite(nick):  # what each getweather did before users were kept in memory.
+        with db._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute("""SELECT * from users where nick=?""", (nick,))
+            row = cursor.fetchone()
+            conn.row_factory = None
+            return dict(row) if row else None
+    print('{0:<28} {1:>8}'.format('lookup', 'us/call'))
+    for (name, func) in [('getweather, from SQLite', sqlite),
+                         ('getweather', db.getweather),
+                         ('getsettings + getuser', lambda nick: (db.getsettings(), db.getuser(nick)))]:
+        print('{0:<28} {1:>8.1f}'.format(name, percall(func, nicks) * 1e6))
+    print('{0:<28} {1:>8}'.format('threads, 9 reads : 1 write', 'ops/s'))
+    for threads in (1, 8):
+        def worker(n):
+            for (i, nick) in enumerate(nicks[n::threads]):
+                if i % 10:
+                    db.getweather(nick)
+                else:
+                    db.setsetting(nick, 'metric', i % 2)
+        workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+        start = time.time()
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        print('{0:<28} {1:>8.0f}'.format(threads, len(nicks) / (time.time() - start)))
+    db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Weather plugin latency benchmark.')
+    parser.add_argument('-n', '--repeat', type=int, default=200, help='requests per combination (default: 200)')
+    parser.add_argument('--delay', type=float, default=0, help='seconds the fixture server waits before answering')
+    parser.add_argument('--decode', nargs='?', const=os.path.join(FIXTURES, 'hourly10day.json'), metavar='FILE',
+                        help='compare response decoders on FILE (default: the hourly10day fixture) instead')
+    parser.add_argument('--users', nargs='?', type=int, const=50000, metavar='COUNT',
+                        help='time the user store with COUNT users (default: 50000) instead')
+    args = parser.parse_args()
+    if args.users:
+        users(args.users, args.repeat)
+        return
+    if args.decode:
+        decode(args.decode, args.repeat)
+        return
+    server = FixtureServer(delay=args.delay)
+    server.start()
+    try:
+        print('{0:<32} {1:>17} {2:>17} {3:>17} {4:>17}'.format('options', 'parse p50/p95 us', 'format p50/p95 us',
+                                                             'old p50/p95 us', 'total p50/p95 ms'))
+        for (name, features, options, replies) in COMBINATIONS:
+            parse, format, old, total = run(server, features, options, replies, args.repeat)
+            print('{0:<32} {1:>8.0f}/{2:<8.0f} {3:>8.0f}/{4:<8.0f} {5:>8.0f}/{6:<8.0f} {7:>8.2f}/{8:<8.2f}'.format(
+                name, parse[0] * 1e6, parse[1] * 1e6, format[0] * 1e6, format[1] * 1e6, old[0] * 1e6, old[1] * 1e6,
+                total[0] * 1e3, total[1] * 1e3))
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=250:
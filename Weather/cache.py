@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+###
+# Copyright (c) 2012-2014, spline
+# All rights reserved.
+###
+# Caching and request helpers for the Weather plugin.
+from __future__ import unicode_literals
+from collections import OrderedDict
+import threading
+import time
+
+
+class TTLCache():
+    """Thread-safe key->value cache with a per-entry TTL and an LRU bound.
+
+    Expired entries are treated as misses but are kept around until they are
+    overwritten or evicted, so callers can still fall back on them."""
+
+    def __init__(self, ttl, maxentries, clock=time.time):
+        self.ttl = ttl
+        self.maxentries = maxentries
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (value, stored, expires)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the cached value for key, or None if missing or expired."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[2] <= self.clock():
+                self.misses += 1
+                return None
+            # mark as most recently used.
+            del self._entries[key]
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None, stored=None):
+        """Store value under key for ttl seconds (default: self.ttl).
+
+        stored is when value was fetched, if not now."""
+
+        if ttl is None:
+            ttl = self.ttl
+        if stored is None:
+            stored = self.clock()
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, stored, stored + ttl)
+            while len(self._entries) > self.maxentries:
+                self._entries.popitem(last=False)  # least recently used.
+                self.evictions += 1
+
+    def peek(self, key):
+        """Return (value, stored, expires) for key, expired or not, or None.
+
+        Unlike get(), this doesn't count as a lookup or as a use of the entry."""
+
+        with self._lock:
+            return self._entries.get(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return a dict of counters."""
+
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+class QuotaGovernor():
+    """Keeps API calls within a per-minute and a per-day limit.
+
+    The per-minute limit is a token bucket, so short bursts are fine as long
+    as the average stays under it. The per-day limit is a count that resets
+    at midnight UTC. 0 means no limit. Background calls (prefetching and
+    refreshing) only go ahead while at least half of both budgets is left,
+    so they never lock users out.
+    """
+
+    def __init__(self, perminute, perday, clock=time.time):
+        self.perminute = perminute
+        self.perday = perday
+        self.clock = clock
+        self.tokens = float(perminute)
+        self.today = 0  # calls made today.
+        self.denied = 0
+        self._day = int(clock() // 86400)
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.perminute, self.tokens + (now - self._updated) * self.perminute / 60.0)
+        self._updated = now
+        day = int(now // 86400)
+        if day != self._day:
+            self._day = day
+            self.today = 0
+
+    def _allowed(self, background):
+        self._refill()
+        if self.perminute and self.tokens < (max(1, self.perminute / 2.0) if background else 1):
+            return False
+        if self.perday and self.today >= (self.perday / 2.0 if background else self.perday):
+            return False
+        return True
+
+    def available(self, background=False):
+        """Return True if a call would be allowed right now."""
+        with self._lock:
+            return self._allowed(background)
+
+    def acquire(self, background=False):
+        """Take a call from the budget. Return False if there's none left."""
+
+        with self._lock:
+            if not self._allowed(background):
+                self.denied += 1
+                return False
+            self.tokens -= 1
+            self.today += 1
+            return True
+
+
+class CircuitBreaker():
+    """Fails calls fast while a service is down, instead of waiting on it each time.
+
+    After threshold consecutive failures the breaker opens: allow() refuses
+    calls for timeout seconds. Then one call is let through as a probe;
+    success() closes the breaker again, failure() keeps it open for another
+    timeout. A probe that never reports back is replaced after a timeout.
+    """
+
+    def __init__(self, threshold, timeout, clock=time.time):
+        self.threshold = threshold
+        self.timeout = timeout
+        self.clock = clock
+        self.failures = 0  # consecutive.
+        self.rejected = 0  # calls failed fast.
+        self._opened = None  # when it opened, or last let a probe through.
+        self._lock = threading.Lock()
+
+    def _state(self):
+        if self._opened is None:
+            return 'closed'
+        elif self.clock() >= self._opened + self.timeout:
+            return 'half-open'
+        else:
+            return 'open'
+
+    @property
+    def state(self):
+        """'closed' (working), 'open' (failing fast) or 'half-open' (next call is a probe)."""
+        with self._lock:
+            return self._state()
+
+    def retryin(self):
+        """Seconds until the next probe is let through (0 unless open)."""
+        with self._lock:
+            if self._opened is None:
+                return 0
+            return max(0, self._opened + self.timeout - self.clock())
+
+    def allow(self):
+        """Return True if a call may go ahead."""
+
+        with self._lock:
+            state = self._state()
+            if state == 'closed':
+                return True
+            elif state == 'half-open':
+                self._opened = self.clock()  # one probe per timeout.
+                return True
+            self.rejected += 1
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self._opened = None
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._opened is not None or self.failures >= self.threshold:
+                self._opened = self.clock()
+
+
+class Popularity():
+    """Thread-safe counter of lookups, to tell what's worth keeping warm.
+
+    decay() halves every count, so the ranking follows recent traffic, and
+    forgets keys that have dropped below half a lookup."""
+
+    def __init__(self):
+        self._counts = {}  # key -> [count, set of features]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._counts)
+
+    def hit(self, key, features, weight=1):
+        """Count a lookup of key for features."""
+
+        with self._lock:
+            entry = self._counts.get(key)
+            if entry is None:
+                entry = self._counts[key] = [0, set()]
+            entry[0] += weight
+            entry[1].update(features)
+
+    def top(self, n):
+        """Return [(key, features)] for the n most looked up keys, most popular first."""
+
+        with self._lock:
+            entries = sorted(self._counts.items(), key=lambda item: item[1][0], reverse=True)[:n]
+            return [(key, set(features)) for (key, (count, features)) in entries]
+
+    def forget(self, key):
+        with self._lock:
+            self._counts.pop(key, None)
+
+    def decay(self):
+        with self._lock:
+            for key in list(self._counts):
+                entry = self._counts[key]
+                entry[0] /= 2.0
+                if entry[0] < 0.5:
+                    del self._counts[key]
+
+
+class SingleFlight():
+    """Collapses concurrent calls for the same key into one.
+
+    The first caller for a key runs the function; callers arriving while it
+    is in flight wait for it and get the same result, or the same exception.
+    """
+
+    class _Call():
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.shared = 0  # number of calls answered by someone else's fetch.
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args):
+        """Return func(*args), sharing the call with anyone else doing key."""
+
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = self._Call()
+                leader = True
+            else:
+                self.shared += 1
+                leader = False
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=250:
@@ -32,6 +32,45 @@ conf.registerGlobalValue(Weather,'showWind', registry.Boolean(False, ("""Show wi
 conf.registerGlobalValue(Weather,'showUpdated', registry.Boolean(False, ("""Show updated in output?""")))
 conf.registerChannelValue(Weather,'showImperialAndMetric', registry.Boolean(True, ("""In channel, display output with Imperial and Metric?""")))
 conf.registerGlobalValue(Weather,'lang', registry.String('EN', ("""language to use. See docs for available codes.""")))
+conf.registerGlobalValue(Weather,'apiUrl', registry.String('http://api.wunderground.com/api/', ("""Base URL of the Wunderground API. Point this at a compatible service or a local stand-in (see fixtureserver.py).""")))
+conf.registerGlobalValue(Weather,'autocompleteUrl', registry.String('http://autocomplete.wunderground.com/aq', ("""URL of the Wunderground location autocomplete API.""")))
+conf.registerGlobalValue(Weather,'providers', registry.SpaceSeparatedListOfStrings(['wunderground'], ("""Where weather data comes from, in order of preference. Only wunderground (the Wunderground API) ships with the plugin; more can be added in providers.py. With more than one, a provider that's down is skipped, and a request the first one hasn't answered within its usual (95th percentile) time is also sent to the next one; whichever answers first is used. Reload Weather after changing this.""")))
+conf.registerGlobalValue(Weather,'hedgeDelay', registry.PositiveFloat(2.0, ("""Seconds to wait for a provider before also asking the next one, until there are enough timings to go by its 95th percentile instead. Only used with several providers.""")))
+conf.registerGlobalValue(Weather,'streamAbove', registry.NonNegativeInteger(0, ("""Decode API responses bigger than this many bytes incrementally with ijson, if it's installed, keeping only the fields Weather uses. That takes about a fifth of the memory for a big response like hourly10day, but two to three times the CPU time. 0 always decodes responses in full.""")))
+conf.registerGroup(Weather, 'cache')
+conf.registerGroup(Weather.cache, 'ttl')
+conf.registerGlobalValue(Weather.cache.ttl,'conditions', registry.NonNegativeInteger(600, ("""Seconds to cache current conditions for. 0 disables caching them.""")))
+conf.registerGlobalValue(Weather.cache.ttl,'forecast', registry.NonNegativeInteger(3600, ("""Seconds to cache forecasts for. 0 disables caching them.""")))
+conf.registerGlobalValue(Weather.cache.ttl,'hourly10day', registry.NonNegativeInteger(3600, ("""Seconds to cache hourly and 10 day forecasts (--hourly, --10day) for. 0 disables caching them.""")))
+conf.registerGlobalValue(Weather.cache.ttl,'alerts', registry.NonNegativeInteger(120, ("""Seconds to cache alerts for. 0 disables caching them. (almanac and astronomy are always cached until midnight.)""")))
+conf.registerGlobalValue(Weather.cache.ttl,'notFound', registry.NonNegativeInteger(300, ("""Seconds to remember that a location doesn't exist. 0 disables this.""")))
+conf.registerGlobalValue(Weather.cache,'locationTTL', registry.NonNegativeInteger(2592000, ("""Seconds to remember what a location query resolved to (stored in Weather.db). 0 disables this.""")))
+conf.registerGlobalValue(Weather.cache,'maxEntries', registry.PositiveInteger(500, ("""Maximum number of API responses to keep cached. The least recently used ones are dropped first.""")))
+conf.registerGlobalValue(Weather.cache,'maxStale', registry.NonNegativeInteger(21600, ("""Seconds past their expiry that cached responses can still be shown, marked with their age, when the API can't be used (out of calls or down). They're refreshed in the background once it can. 0 disables this.""")))
+conf.registerGlobalValue(Weather.cache,'persist', registry.Boolean(True, ("""Keep a copy of cached responses in the plugin's database, so they survive reloads and restarts. Rows more than maxStale past their expiry are deleted every hour.""")))
+conf.registerGroup(Weather, 'gazetteer')
+conf.registerGlobalValue(Weather.gazetteer,'dumps', registry.SpaceSeparatedListOfStrings([], ("""GeoNames dumps of cities (like cities15000.txt) and/or postal codes (like US.txt from the zip directory), from http://download.geonames.org/export/, to look place names and postal codes up in without asking the autocomplete API. They're indexed into Weather.gaz in the data directory whenever they change. Reload Weather after changing this.""")))
+conf.registerGlobalValue(Weather.gazetteer,'snap', registry.NonNegativeInteger(10, ("""Coordinates within this many km of a place in the gazetteer are looked up as that place, so lookups for nearby spots share cached responses. 0 disables this.""")))
+conf.registerGroup(Weather, 'quota')
+conf.registerGlobalValue(Weather.quota,'perMinute', registry.NonNegativeInteger(10, ("""Maximum number of API calls per minute, shared by everything the plugin does. 0 means no limit. Reload Weather after changing this.""")))
+conf.registerGlobalValue(Weather.quota,'perDay', registry.NonNegativeInteger(500, ("""Maximum number of API calls per day (UTC), shared by everything the plugin does. 0 means no limit. Reload Weather after changing this.""")))
+conf.registerGroup(Weather, 'breaker')
+conf.registerGlobalValue(Weather.breaker,'threshold', registry.PositiveInteger(5, ("""Number of failed requests in a row after which the API (or autocomplete) is considered down, and requests to it fail straight away.""")))
+conf.registerGlobalValue(Weather.breaker,'timeout', registry.PositiveInteger(60, ("""Seconds to fail requests straight away for, once the API is considered down. After that, one request is let through to see if it's back.""")))
+conf.registerGroup(Weather, 'prefetch')
+conf.registerGlobalValue(Weather.prefetch,'locations', registry.NonNegativeInteger(0, ("""Number of the most looked up locations to keep fresh in the cache, by refreshing them shortly before they expire. Users' saved locations count as lookups. 0 disables prefetching.""")))
+conf.registerGlobalValue(Weather.prefetch,'interval', registry.PositiveInteger(60, ("""Seconds between checks for locations that need refreshing. Reload Weather after changing this.""")))
+conf.registerGlobalValue(Weather.prefetch,'lead', registry.PositiveInteger(120, ("""Refresh cached entries this many seconds before they expire.""")))
+conf.registerGlobalValue(Weather.prefetch,'maxPerMinute', registry.PositiveInteger(4, ("""Maximum number of API calls per minute to spend on prefetching. Leave room within your API key's limit for normal lookups.""")))
+conf.registerGroup(Weather, 'metrics')
+conf.registerGlobalValue(Weather.metrics,'logInterval', registry.NonNegativeInteger(3600, ("""Seconds between log lines with lookup timings and API call counts (the same as in the stats command). 0 disables them. Reload Weather after changing this.""")))
+conf.registerGroup(Weather, 'multi')
+conf.registerGlobalValue(Weather.multi,'maxLocations', registry.PositiveInteger(5, ("""Maximum number of locations the multi command will look up at once, and a digest can have. Each one costs an API call, so keep this within your API key's per-minute limit.""")))
+conf.registerGlobalValue(Weather.multi,'threads', registry.PositiveInteger(4, ("""Number of locations the multi command (and digests and alert subscriptions) fetches at the same time.""")))
+conf.registerGroup(Weather, 'subscriptions')
+conf.registerGlobalValue(Weather.subscriptions,'interval', registry.PositiveInteger(300, ("""Seconds between checks for new alerts for the locations channels subscribe to. Each location is fetched once per check, however many channels subscribe to it. Reload Weather after changing this.""")))
+conf.registerGlobalValue(Weather.subscriptions,'maxPerChannel', registry.PositiveInteger(5, ("""Maximum number of locations a channel can subscribe to alerts for.""")))
+conf.registerGlobalValue(Weather.subscriptions,'remember', registry.PositiveInteger(1000, ("""Number of announced alerts to remember, so they aren't announced again. Each is forgotten a day after it expires, or when more recent ones push it out.""")))
 
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=250:
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+###
+# Copyright (c) 2012-2014, spline
+# All rights reserved.
+###
+# Decoding API responses down to the fields the Weather plugin uses.
+from __future__ import unicode_literals
+import io
+import json
+try:
+    import ijson
+    from ijson.common import ObjectBuilder
+except ImportError:  # optional. everything is decoded with json then.
+    ijson = None
+
+# which top level keys of a response each API feature fills in.
+FEATUREKEYS = {'conditions': ['current_observation'],
+               'forecast': ['forecast'],
+               'alerts': ['alerts'],
+               'almanac': ['almanac'],
+               'astronomy': ['moon_phase', 'sun_phase'],
+               'hourly10day': ['hourly_forecast']}
+
+# the fields read from each top level key of a response, as paths with
+# 'item' for list elements; each keeps everything below it. keys that
+# aren't listed (response, current_observation, almanac, ...) are small
+# and kept whole.
+FIELDS = {'forecast': ['txt_forecast.forecastday.item.period',
+                       'txt_forecast.forecastday.item.title',
+                       'txt_forecast.forecastday.item.fcttext',
+                       'txt_forecast.forecastday.item.fcttext_metric',
+                       'simpleforecast.forecastday.item.date.weekday_short',
+                       'simpleforecast.forecastday.item.conditions',
+                       'simpleforecast.forecastday.item.high',
+                       'simpleforecast.forecastday.item.low'],
+          'hourly_forecast': ['item.FCTTIME.epoch',
+                              'item.FCTTIME.civil',
+                              'item.FCTTIME.weekday_name_abbrev',
+                              'item.temp',
+                              'item.condition',
+                              'item.pop'],
+          'alerts': ['item.type',
+                     'item.description',
+                     'item.date_epoch',
+                     'item.expires',
+                     'item.expires_epoch',
+                     'item.phenomena',
+                     'item.significance',
+                     'item.message']}
+
+
+def _tree(paths):
+    """['a.b', 'a.c'] -> {'a': {'b': None, 'c': None}}. None keeps everything below."""
+
+    tree = {}
+    for path in paths:
+        node = tree
+        parts = path.split('.')
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = None
+    return tree
+
+_TREES = dict((key, _tree(paths)) for (key, paths) in FIELDS.items())
+# for streaming: ijson prefixes of the containers on the way to kept fields, and of the fields.
+_PARENTS = set()
+_KEPT = set()
+for (key, paths) in FIELDS.items():
+    _PARENTS.add(key)
+    for path in paths:
+        parts = (key + '.' + path).split('.')
+        _KEPT.add('.'.join(parts))
+        _PARENTS.update('.'.join(parts[:i]) for i in range(1, len(parts)))
+
+
+def _prune(value, tree):
+    if tree is None:
+        return value
+    if isinstance(value, list):
+        return [_prune(item, tree['item']) for item in value] if 'item' in tree else []
+    if isinstance(value, dict):
+        return dict((k, _prune(v, tree[k])) for (k, v) in value.items() if k in tree)
+    return value
+
+
+def prune(data):
+    """Return decoded response data with only FIELDS."""
+
+    return dict((key, _prune(value, _TREES.get(key))) for (key, value) in data.items())
+
+
+def _add(container, key, value):
+    if isinstance(container, list):
+        container.append(value)
+    else:
+        container[key] = value
+
+
+def stream(page, bufsize=4096):
+    """Decode only FIELDS from page (bytes), reading it bufsize bytes at a time.
+
+    Fields that aren't needed are skipped as they're read, so the whole
+    response never exists as objects at once. Needs ijson."""
+
+    root = {}
+    stack, keys = [root], [None]  # containers being filled, and the key for the next value in each.
+    names = {}  # one copy of each key, like json does.
+    builder, depth = None, 0
+    for (prefix, event, value) in ijson.parse(io.BytesIO(page), buf_size=bufsize, use_float=True):
+        if builder is not None:  # inside a value that's kept whole.
+            if event == 'map_key':
+                value = names.setdefault(value, value)
+            builder.event(event, value)
+            if event == 'start_map' or event == 'start_array':
+                depth += 1
+            elif event == 'end_map' or event == 'end_array':
+                depth -= 1
+                if depth == 0:
+                    _add(stack[-1], keys[-1], builder.value)
+                    builder = None
+        elif event == 'map_key':
+            keys[-1] = names.setdefault(value, value)
+        elif prefix in _PARENTS:
+            if event == 'start_map' or event == 'start_array':
+                container = {} if event == 'start_map' else []
+                _add(stack[-1], keys[-1], container)
+                stack.append(container)
+                keys.append(None)
+            elif event == 'end_map' or event == 'end_array':
+                stack.pop()
+                keys.pop()
+            else:  # null or such where a container was expected.
+                _add(stack[-1], keys[-1], value)
+        elif prefix in _KEPT or (len(stack) == 1 and prefix):  # a kept field, or a top level key kept whole.
+            if event == 'start_map' or event == 'start_array':
+                builder, depth = ObjectBuilder(), 1
+                builder.event(event, value)
+            else:
+                _add(stack[-1], keys[-1], value)
+    return root
+
+
+def extract(page, streamabove=0):
+    """Decode an API response (bytes) down to FIELDS.
+
+    Responses larger than streamabove bytes are streamed (see stream()) if
+    ijson is installed. That needs much less memory for big responses, but
+    takes longer: json is faster at decoding everything. 0 never streams.
+    Anything the stream can't handle is decoded in full instead.
+    """
+
+    if streamabove and len(page) > streamabove and ijson is not None:
+        try:
+            return stream(page)
+        except Exception:  # whatever ijson makes of it, json says what's wrong.
+            pass
+    return prune(json.loads(page.decode('utf-8')))
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=250:
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+###
+# Copyright (c) 2012-2014, spline
+# All rights reserved.
+###
+"""
+Local stand-in for the Wunderground API, serving the recorded responses in
+fixtures/. Used by the tests and benchmark.py; it can also be run on its own
+to point a bot at it:
+
+    python fixtureserver.py [port]
+
+then set plugins.Weather.apiUrl to http://127.0.0.1:<port>/api/ and
+plugins.Weather.autocompleteUrl to http://127.0.0.1:<port>/aq
+
+fixtures/locations.json maps each location the API is asked for to a
+recorded response holding every feature; only the requested features are
+sent back. fixtures/autocomplete.json maps queries to autocomplete results.
+"""
+
+from __future__ import print_function
+import json
+import os
+import sys
+import threading
+import time
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, unquote, urlparse
+except ImportError:  # python2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+    from urlparse import parse_qs, urlparse
+try:
+    from .extract import FEATUREKEYS
+except (ImportError, ValueError):  # run on its own, or from benchmark.py.
+    from extract import FEATUREKEYS
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+NOTFOUND = {'response': {'version': '0.1', 'features': {},
+                         'error': {'type': 'querynotfound', 'description': 'No cities match your search query'}}}
+
+
+class Fixtures():
+    """The recorded responses in directory, answering like the API would."""
+
+    def __init__(self, directory=FIXTURES):
+        self.directory = directory
+        self._responses = {}
+        with open(os.path.join(directory, 'locations.json')) as f:
+            self.locations = json.load(f)
+        with open(os.path.join(directory, 'autocomplete.json')) as f:
+            self._autocomplete = json.load(f)
+
+    def _load(self, name):
+        if name not in self._responses:
+            with open(os.path.join(self.directory, name)) as f:
+                self._responses[name] = json.load(f)
+        return self._responses[name]
+
+    def response(self, location):
+        """Return the recorded response for location, or None.
+
+        A location can map to a list of recordings, to make up one response
+        from several: each key comes from the first one that has it."""
+        names = self.locations.get(location)
+        if names is None:
+            return None
+        if not isinstance(names, list):
+            return self._load(names)
+        recorded = {}
+        for name in names:
+            for (key, value) in self._load(name).items():
+                recorded.setdefault(key, value)
+        return recorded
+
+    def autocomplete(self, query):
+        """Autocomplete API response for query."""
+        query = ' '.join(query.lower().split())
+        return {'RESULTS': self._autocomplete.get(query, [])}
+
+    def api(self, location, features):
+        """API response for features of location."""
+        recorded = self.response(location)
+        if recorded is None:
+            return NOTFOUND
+        response = recorded['response']
+        if 'error' in response or 'results' in response:
+            return recorded
+        data = {'response': dict(response, features=dict((feature, 1) for feature in features))}
+        for feature in features:
+            for key in FEATUREKEYS.get(feature, []):
+                if key in recorded:
+                    data[key] = recorded[key]
+        return data
+
+
+class FixtureServer(ThreadingMixIn, HTTPServer):
+    """HTTP server answering API and autocomplete requests from fixtures.
+
+    delay adds that many seconds to every response, to stand in for the
+    network. Request paths are kept in requests."""
+
+    daemon_threads = True
+
+    def __init__(self, directory=FIXTURES, port=0, delay=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), FixtureHandler)
+        self.fixtures = Fixtures(directory)
+        self.delay = delay
+        self.requests = []
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+    def start(self):
+        """Serve requests from a background thread."""
+        thread = threading.Thread(target=self.serve_forever, name='Weather fixture server')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass  # keep test output quiet.
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        url = urlparse(self.path)
+        if url.path == '/aq':
+            self._autocomplete(parse_qs(url.query).get('query', [''])[0])
+        elif url.path.startswith('/api/'):
+            self._api(url.path.split('/')[2:])
+        else:
+            self.send_error(404)
+
+    def _send(self, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _autocomplete(self, query):
+        self._send(self.server.fixtures.autocomplete(query))
+
+    def _api(self, parts):
+        # <key>/<feature>/.../<arg>:<value>/.../q/<location>.json
+        if 'q' not in parts or not parts[-1].endswith('.json'):
+            self.send_error(404)
+            return
+        q = parts.index('q')
+        features = [part for part in parts[1:q] if ':' not in part]
+        location = unquote('/'.join(parts[q + 1:])[:-len('.json')])
+        self._send(self.server.fixtures.api(location, features))
+
+
+if __name__ == '__main__':
+    server = FixtureServer(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8080)
+    print('Serving fixtures from %s at %s' % (server.fixtures.directory, server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=250:
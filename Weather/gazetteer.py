@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+###
+# Copyright (c) 2012-2014, spline
+# All rights reserved.
+###
+"""
+Offline gazetteer for the Weather plugin: resolves place names and postal
+codes to coordinates without asking the autocomplete API.
+
+It is built from GeoNames dumps (http://download.geonames.org/export/):
+the cities files (cities1000.txt, cities15000.txt, ...; 19 columns) and
+the postal code files (zip/US.txt, ...; 12 columns). Several can be
+combined:
+
+    python gazetteer.py Weather.gaz cities15000.txt US.txt
+
+The index is one file that is used through mmap, so opening it costs
+nothing and only the pages lookups touch are read:
+
+    header   magic, version, place and key counts, signature of the dumps
+    places   fixed size records: lat, lon, population, label, ordered as
+             an implicit k-d tree (each range's middle record splits it,
+             on latitude at even depths and longitude at odd ones)
+    keys     (name, place) pairs sorted by name, then most populous first,
+             for exact and prefix lookups by binary search
+    strings  UTF-8 names and labels
+"""
+
+from __future__ import print_function, unicode_literals
+import io
+import math
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+MAGIC = b'WGAZ'
+VERSION = 1
+HEADER = struct.Struct('<4sHxxIII')  # magic, version, places, keys, signature.
+PLACE = struct.Struct('<ffIIH2x')  # lat, lon, population, label offset, label length.
+KEY = struct.Struct('<IH2xI')  # name offset, name length, place.
+KMPERDEGREE = 111.2
+
+
+def normalize(name):
+    """Lookup key for a place name or postal code: 'New York,US' -> 'new york, us'."""
+    return ", ".join(" ".join(part.split()) for part in name.lower().split(','))
+
+
+def latlon(lat, lon):
+    """Coordinates as the API takes them."""
+    return "{0:.4f},{1:.4f}".format(lat, lon)
+
+
+def signature(dumps):
+    """Identifies a list of dumps, so an index knows what it was built from."""
+    return zlib.crc32("\n".join(dumps).encode('utf-8')) & 0xffffffff
+
+
+def parse(filename):
+    """Yield (names, label, lat, lon, population) for each place in a GeoNames dump."""
+
+    with io.open(filename, encoding='utf-8') as f:
+        for line in f:
+            row = line.rstrip('\n').split('\t')
+            try:
+                if len(row) == 19:  # cities: id, name, asciiname, alternatenames, lat, lon, ..., country (8), ..., population (14).
+                    name, country = row[1], row[8]
+                    names = set([name, row[2]])
+                    yield (names | set("{0}, {1}".format(n, country) for n in names), "{0}, {1}".format(name, country),
+                           float(row[4]), float(row[5]), int(row[14] or 0))
+                elif len(row) == 12:  # postal codes: country, code, place, admin1 name, admin1 code, ..., lat (9), lon (10).
+                    country, code = row[0], row[1]
+                    yield (set([code, "{0}, {1}".format(code, country)]), "{0} {1}, {2}".format(code, row[2], country),
+                           float(row[9]), float(row[10]), 0)
+            except ValueError:  # header or broken line.
+                continue
+
+
+def _kdorder(places):
+    """Reorder places in place into an implicit k-d tree on (lat, lon)."""
+
+    stack = [(0, len(places), 0)]
+    while stack:
+        (lo, hi, depth) = stack.pop()
+        if hi - lo < 2:
+            continue
+        places[lo:hi] = sorted(places[lo:hi], key=lambda place: place[2 + depth % 2])
+        mid = (lo + hi) // 2
+        stack.append((lo, mid, depth + 1))
+        stack.append((mid + 1, hi, depth + 1))
+
+
+def build(target, dumps):
+    """Build the index in target from the GeoNames dumps. Returns the number of places."""
+
+    places = []
+    for dump in dumps:
+        places.extend(parse(dump))
+    _kdorder(places)
+    strings = io.BytesIO()
+    offsets = {}
+
+    def string(s):
+        if s not in offsets:
+            data = s.encode('utf-8')
+            offsets[s] = (strings.tell(), len(data))
+            strings.write(data)
+        return offsets[s]
+
+    records, keys = [], []
+    for (i, (names, label, lat, lon, population)) in enumerate(places):
+        records.append(PLACE.pack(lat, lon, population, *string(label)))
+        for name in names:
+            keys.append((normalize(name).encode('utf-8'), -population, i))
+    keys.sort()
+    with open(target + '.tmp', 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(records), len(keys), signature(dumps)))
+        f.write(b''.join(records))
+        for (name, _, i) in keys:
+            f.write(KEY.pack(*(string(name.decode('utf-8')) + (i,))))
+        f.write(strings.getvalue())
+    os.rename(target + '.tmp', target)  # readers never see half a file.
+    return len(records)
+
+
+class Gazetteer():
+    """A built index, memory-mapped. Safe to share between threads."""
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.places, self.keys, self.signature) = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            self._mm.close()
+            raise ValueError("{0} is not a Weather gazetteer index.".format(filename))
+        self._places = HEADER.size
+        self._keys = self._places + self.places * PLACE.size
+        self._strings = self._keys + self.keys * KEY.size
+
+    def __len__(self):
+        return self.places
+
+    def close(self):
+        self._mm.close()
+
+    def _string(self, offset, length):
+        start = self._strings + offset
+        return self._mm[start:start + length]
+
+    def _key(self, i):
+        (offset, length, place) = KEY.unpack_from(self._mm, self._keys + i * KEY.size)
+        return (self._string(offset, length), place)
+
+    def _place(self, i):
+        (lat, lon, population, offset, length) = PLACE.unpack_from(self._mm, self._places + i * PLACE.size)
+        return (self._string(offset, length).decode('utf-8'), lat, lon)
+
+    def _search(self, name):
+        """Index of the first key >= name."""
+
+        (lo, hi) = (0, self.keys)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid)[0] < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def lookup(self, name):
+        """Return (label, lat, lon) of the most populous place called name, or None."""
+
+        name = normalize(name).encode('utf-8')
+        i = self._search(name)
+        if i < self.keys:
+            (key, place) = self._key(i)
+            if key == name:
+                return self._place(place)
+        return None
+
+    def prefix(self, prefix, limit=10):
+        """Return up to limit (label, lat, lon) of places with a name starting with prefix, in name order."""
+
+        prefix = normalize(prefix).encode('utf-8')
+        output, seen = [], set()
+        i = self._search(prefix)
+        while i < self.keys and len(output) < limit:
+            (key, place) = self._key(i)
+            if not key.startswith(prefix):
+                break
+            if place not in seen:
+                seen.add(place)
+                output.append(self._place(place))
+            i += 1
+        return output
+
+    def nearest(self, lat, lon):
+        """Return (label, lat, lon, km) of the place closest to lat, lon, or None if there are none.
+
+        Distances are on a flat map scaled to lat, which is close enough at city distances.
+        Longitudes wrap around at 180 degrees, so places across the antimeridian are found too."""
+
+        if not self.places:
+            return None
+        scale = math.cos(math.radians(lat))
+        best = [None, float('inf')]
+
+        def search(lo, hi, depth):
+            if lo >= hi:
+                return
+            mid = (lo + hi) // 2
+            (plat, plon) = PLACE.unpack_from(self._mm, self._places + mid * PLACE.size)[:2]
+            dlon = abs(plon - lon)
+            d = (plat - lat) ** 2 + (min(dlon, 360 - dlon) * scale) ** 2
+            if d < best[1]:
+                best[:] = [mid, d]
+            if depth % 2 == 0:
+                diff = bound = lat - plat
+            else:
+                diff = lon - plon
+                # the other side also reaches round the antimeridian, to -180 (west of us) or 180 (east).
+                bound = min(abs(diff), (lon + 180) if diff < 0 else (180 - lon)) * scale
+            (near, far) = (((lo, mid), (mid + 1, hi)) if diff < 0 else ((mid + 1, hi), (lo, mid)))
+            search(near[0], near[1], depth + 1)
+            if bound * bound < best[1]:  # the other side could be closer.
+                search(far[0], far[1], depth + 1)
+
+        search(0, self.places, 0)
+        return self._place(best[0]) + (math.sqrt(best[1]) * KMPERDEGREE,)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('usage: python gazetteer.py INDEX DUMP [DUMP ...]')
+        sys.exit(1)
+    print('{0} places.'.format(build(sys.argv[1], sys.argv[2:])))
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=250:
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+###
+# Copyright (c) 2012-2014, spline
+# All rights reserved.
+###
+# Timing instrumentation for the Weather plugin.
+from __future__ import unicode_literals
+from collections import deque
+from contextlib import contextmanager
+import threading
+import time
+
+
+class Metrics():
+    """Rolling timings for each phase of a lookup, plus counters.
+
+    Only the last size samples of each phase are kept, so percentiles
+    follow recent traffic and memory stays bounded."""
+
+    # phases in the order they're reported in.
+    PHASES = ('total', 'autocomplete', 'fetch', 'api', 'decode', 'zmw', 'format')
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, size=1000, clock=time.time):
+        self.size = size
+        self.clock = clock
+        self.counters = {}
+        self._samples = {}  # phase -> deque of seconds.
+        self._recorded = 0  # samples ever recorded.
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def time(self, phase):
+        """Time the block as phase."""
+
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.record(phase, self.clock() - start)
+
+    def record(self, phase, seconds):
+        with self._lock:
+            samples = self._samples.get(phase)
+            if samples is None:
+                samples = self._samples[phase] = deque(maxlen=self.size)
+            samples.append(seconds)
+            self._recorded += 1
+
+    def count(self, counter, n=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    @property
+    def recorded(self):
+        return self._recorded
+
+    def percentiles(self, phase):
+        """Return (samples, p50, p95, p99) for phase, in seconds, or None if it has no samples."""
+
+        with self._lock:
+            samples = sorted(self._samples.get(phase, ()))
+        if not samples:
+            return None
+        return (len(samples),) + tuple(samples[min(len(samples) - 1, len(samples) * p // 100)] for p in self.PERCENTILES)
+
+    def report(self):
+        """One line summary: 'phase p50/p95/p99ms (samples) | ...'."""
+
+        phases = list(self.PHASES) + sorted(set(self._samples) - set(self.PHASES))
+        output = []
+        for phase in phases:
+            stats = self.percentiles(phase)
+            if stats:
+                output.append("{0} {1:.1f}/{2:.1f}/{3:.1f}ms ({4})".format(phase, stats[1] * 1e3, stats[2] * 1e3, stats[3] * 1e3, stats[0]))
+        return " | ".join(output) or "no lookups yet"
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=250:
@@ -5,21 +5,35 @@
 ###
 # my libs
 from __future__ import unicode_literals
+from collections import OrderedDict  # digests, user exports.
+from contextlib import contextmanager  # userdb.
 import json  # json.
+import os  # gazetteer.
+import re  # coordinates.
 from math import floor  # for wind.
 import sqlite3  # userdb.
+import threading  # userdb cache.
+import time  # location cache.
+import zlib  # response cache.
 try:
     from itertools import izip
 except ImportError:  # python3
     izip = zip
+try:
+    import queue
+except ImportError:  # python2
+    import Queue as queue
 # extra supybot libs
 import supybot.conf as conf
 import supybot.log as log
+import supybot.schedule as schedule
+import supybot.world as world
 # supybot libs
 import supybot.utils as utils
 from supybot.commands import *
 import supybot.plugins as plugins
 import supybot.ircutils as ircutils
+import supybot.ircmsgs as ircmsgs
 import supybot.callbacks as callbacks
 try:
     from supybot.i18n import PluginInternationalization
@@ -29,24 +43,125 @@ except ImportError:
     # without the i18n module
     _ = lambda x:x
 
+# digest times.
+HHMM = re.compile(r'^([01]?\d|2[0-3]):([0-5]\d)$')
+
+# "lat,lon" locations.
+COORDINATES = re.compile(r'^\s*(-?\d+(?:\.\d+)?)\s*,\s*(-?\d+(?:\.\d+)?)\s*$')
+
+from .cache import CircuitBreaker, Popularity, QuotaGovernor, SingleFlight, TTLCache
+from .extract import FEATUREKEYS
+from .gazetteer import Gazetteer, build, latlon, signature
+from .metrics import Metrics
+from .providers import PROVIDERS
+from .render import Hourly, Renderer, alertline
+from .userfile import readusers, writeusers
 
 class WeatherDB():
-    """WeatherDB class to store our users and their settings."""
+    """WeatherDB class to store our users and their settings.
 
-    def __init__(self):
-        self.filename = conf.supybot.directories.data.dirize("Weather.db")
+    Connections are kept in a small pool and handed to one thread at a time,
+    so concurrent commands never share a connection, and each pooled
+    connection keeps its own cache of prepared statements. The DB is in WAL
+    mode so that readers don't wait on writers.
+    """
+
+    def __init__(self, filename=None, poolsize=5):
+        self.filename = filename or conf.supybot.directories.data.dirize("Weather.db")
         self.log = log.getPluginLogger('Weather')
-        self._conn = sqlite3.connect(self.filename, check_same_thread=False)
-        self._conn.text_factory = str
+        self._pool = queue.Queue(poolsize)
+        # in-memory copy of the users table, loaded on first use and kept
+        # up to date by our own writes: nick -> row tuple (see _columns).
+        # writes hold _lock so the copy always matches the DB.
+        self._users = None
+        self._columns = None
+        self._settings = None
+        self._lock = threading.Lock()
         self.makeDb()
 
+    @contextmanager
+    def _connect(self):
+        """Check out a pooled connection. Commits on success, rolls back on error."""
+
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+            conn.text_factory = str
+        try:
+            with conn:
+                yield conn
+        finally:
+            try:
+                self._pool.put_nowait(conn)
+            except queue.Full:  # enough spare connections already.
+                conn.close()
+
+    def close(self):
+        """Close all pooled connections."""
+
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def _loadusers(self):
+        """Load the users table into memory, if not done yet. Call with self._lock held."""
+
+        if self._users is None:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""SELECT * from users""")
+                self._columns = [d[0] for d in cursor.description]
+                self._users = dict((row[0], tuple(row)) for row in cursor.fetchall())
+
+    def _reloaduser(self, conn, username):
+        """Refresh one user's cached row from the DB. Call with self._lock held."""
+
+        if self._users is not None:
+            cursor = conn.cursor()
+            cursor.execute("""SELECT * from users where nick=?""", (username,))
+            row = cursor.fetchone()
+            if row:
+                self._users[username] = tuple(row)
+            else:
+                self._users.pop(username, None)
+
     def makeDb(self):
-        """Create our DB."""
+        """Create our DB, or bring it up to date.
+
+        The schema's version is kept in PRAGMA user_version. The migrations
+        it's behind on (see MIGRATIONS) are all applied in one transaction,
+        so a DB is never left half upgraded.
+        """
 
         self.log.info("WeatherDB: Checking/Creating DB.")
-        with self._conn as conn:
-            cursor = conn.cursor()
-            cursor.execute("""CREATE TABLE IF NOT EXISTS users (
+        with self._connect() as conn:
+            # WAL is persistent, so this only needs to be done once. it can't be done in a transaction.
+            conn.execute("PRAGMA journal_mode=WAL")
+            # manage the transaction ourselves: sqlite3 would commit before each CREATE/ALTER on its own.
+            conn.isolation_level = None
+            try:
+                conn.execute("BEGIN IMMEDIATE")  # other bots/reloads wait here, then see our version.
+                try:
+                    version = conn.execute("PRAGMA user_version").fetchone()[0]
+                    for (i, migration) in enumerate(self.MIGRATIONS[version:], version + 1):
+                        self.log.info("WeatherDB: upgrading the DB to version {0}.".format(i))
+                        migration(self, conn.cursor())
+                    if version < len(self.MIGRATIONS):
+                        conn.execute("PRAGMA user_version=%d" % len(self.MIGRATIONS))
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+            finally:
+                conn.isolation_level = ''
+
+    def _migration1(self, cursor):
+        """The schema from before versions: create the tables, and add the newer settings to old (4 column) users tables."""
+
+        cursor.execute("""CREATE TABLE IF NOT EXISTS users (
                           nick TEXT PRIMARY KEY,
                           location TEXT NOT NULL,
                           metric INTEGER DEFAULT 0,
@@ -62,70 +177,255 @@ class WeatherDB():
                           dewpoint INTEGER DEFAULT 0,
                           humidity INTEGER DEFAULT 0,
                           updated INTEGER DEFAULT 0)""")
-            self._conn.commit()  # this fails silently if already there.
-            # next, we see if we need to upgrade the old table structure.
-            cursor = conn.cursor()  # the old table is 4.
-            tablelength = len([l[1] for l in cursor.execute("pragma table_info('users')").fetchall()])
-            if tablelength == 4:  # old table is 4: users, location, metric, colortemp.
-                self.log.info("Table length is 4. We need to upgrade.")
-                columns = ['alerts', 'almanac', 'astronomy', 'forecast', 'pressure', 'wind', 'uv', 'visibility', 'dewpoint', 'humidity', 'updated']
-                for column in columns:
-                    try:
-                        cursor.execute('ALTER TABLE users ADD COLUMN %s INTEGER DEFAULT 0' % column)
-                        self._conn.commit()
-                    except:  # fail silently.
-                        pass
+        # cache of resolved locations (query -> zmw).
+        cursor.execute("""CREATE TABLE IF NOT EXISTS locations (
+                          query TEXT PRIMARY KEY,
+                          location TEXT NOT NULL,
+                          updated INTEGER NOT NULL)""")
+        # API responses, one row per feature, so the cache survives restarts.
+        # data is zlib compressed json; it expires at fetched + ttl.
+        cursor.execute("""CREATE TABLE IF NOT EXISTS responses (
+                          location TEXT NOT NULL,
+                          feature TEXT NOT NULL,
+                          lang TEXT NOT NULL,
+                          data BLOB NOT NULL,
+                          fetched REAL NOT NULL,
+                          ttl REAL NOT NULL,
+                          PRIMARY KEY (location, feature, lang))""")
+        # daily digests: locations (a json list) posted in a channel at a time of day (HH:MM).
+        cursor.execute("""CREATE TABLE IF NOT EXISTS digests (
+                          network TEXT NOT NULL,
+                          channel TEXT NOT NULL,
+                          time TEXT NOT NULL,
+                          locations TEXT NOT NULL,
+                          PRIMARY KEY (network, channel, time))""")
+        # old tables are 4 columns: users, location, metric, colortemp.
+        existing = [row[1] for row in cursor.execute("pragma table_info('users')").fetchall()]
+        for column in ['alerts', 'almanac', 'astronomy', 'forecast', 'pressure', 'wind', 'uv', 'visibility', 'dewpoint', 'humidity', 'updated']:
+            if column not in existing:
+                cursor.execute('ALTER TABLE users ADD COLUMN %s INTEGER DEFAULT 0' % column)
+
+    def _migration2(self, cursor):
+        """Alert subscriptions: the locations (normalized queries) each channel gets alerts for."""
+
+        cursor.execute("""CREATE TABLE subscriptions (
+                          network TEXT NOT NULL,
+                          channel TEXT NOT NULL,
+                          location TEXT NOT NULL,
+                          PRIMARY KEY (network, channel, location))""")
+
+    # schema changes, in order; a DB at version N has had the first N. add new ones at the end.
+    MIGRATIONS = [_migration1, _migration2]
 
     def setweather(self, username, location):
         """Stores or update a user's location. Adds user if not found."""
-        with self._conn as conn:
-            cursor = conn.cursor()
-            if self.getuser(username):  # username exists.
-                cursor.execute("""UPDATE users SET location=? WHERE nick=?""", (location, username,))
-            else:  # username does not exist so add it in.
-                cursor.execute("""INSERT OR REPLACE INTO users (nick, location) VALUES (?,?)""", (username, location,))
-            self._conn.commit()  # commit.
+        with self._lock:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                # add the user if they're new, otherwise update them. no need to check first.
+                cursor.execute("""INSERT OR IGNORE INTO users (nick, location) VALUES (?,?)""", (username, location,))
+                if cursor.rowcount == 0:  # username exists.
+                    cursor.execute("""UPDATE users SET location=? WHERE nick=?""", (location, username,))
+                # new users get the column defaults, so read the row back.
+                self._reloaduser(conn, username)
 
     def setsetting(self, username, setting, value):
         """Set one of the user settings."""
 
-        with self._conn as conn:
-            cursor = conn.cursor()
-            query = "UPDATE users SET %s=? WHERE nick=?" % setting
-            cursor.execute(query, (value, username,))
-            self._conn.commit()
+        with self._lock:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                query = "UPDATE users SET %s=? WHERE nick=?" % setting
+                cursor.execute(query, (value, username,))
+            if self._users is not None and username in self._users:
+                row = list(self._users[username])
+                row[self._columns.index(setting)] = value
+                self._users[username] = tuple(row)
 
     def getsettings(self):
         """Get all 'user' settings that can be set."""
 
-        with self._conn as conn:
-            cursor = conn.cursor()  # below, we get all column names that are settings (INTEGERS)
-            settings = [str(l[1]) for l in cursor.execute("pragma table_info('users')").fetchall() if l[2] == "INTEGER"]
-            return settings
+        if self._settings is None:
+            with self._connect() as conn:
+                cursor = conn.cursor()  # below, we get all column names that are settings (INTEGERS)
+                self._settings = [str(l[1]) for l in cursor.execute("pragma table_info('users')").fetchall() if l[2] == "INTEGER"]
+        return list(self._settings)
+
+    def exportusers(self):
+        """Return every user, by nick, as an OrderedDict of column -> value (in table order)."""
+
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""SELECT * from users ORDER BY nick""")
+            columns = [d[0] for d in cursor.description]
+            return [OrderedDict(izip(columns, row)) for row in cursor.fetchall()]
+
+    def importusers(self, users, overwrite=False):
+        """Add users (dicts of column -> value, like exportusers returns) in one transaction. Returns how many were written.
+
+        nick and location are needed; settings that are left out get their
+        defaults. Users who are already here are left alone, unless
+        overwrite. If any user is invalid, nothing is written (ValueError).
+        """
+
+        with self._connect() as conn:
+            info = conn.execute("pragma table_info('users')").fetchall()
+        columns = [str(row[1]) for row in info]
+        defaults = dict((row[1], row[4]) for row in info)
+        rows = []
+        for (i, user) in enumerate(users, 1):
+            row = []
+            for column in columns:
+                value = user.get(column)
+                if column in ('nick', 'location'):
+                    value = ('' if value is None else '{0}'.format(value)).strip()  # zip codes can come as numbers.
+                    if not value:
+                        raise ValueError("user {0} has no {1}.".format(i, column))
+                    row.append(value.lower() if column == 'nick' else value)
+                elif value is None or value == '':
+                    row.append(int(defaults[column] or 0))
+                elif str(value).lower() in ('1', 'true', 'yes', 'on'):
+                    row.append(1)
+                elif str(value).lower() in ('0', 'false', 'no', 'off'):
+                    row.append(0)
+                else:
+                    raise ValueError("user {0} has {1} '{2}'. It should be 1 or 0.".format(i, column, value))
+            rows.append(row)
+        with self._lock:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.executemany("""INSERT OR %s INTO users (%s) VALUES (%s)""" % ('REPLACE' if overwrite else 'IGNORE',
+                                   ",".join(columns), ",".join("?" * len(columns))), rows)
+                count = cursor.rowcount
+            if self._users is not None:  # too many changes to patch in. load it again.
+                self._users = None
+                self._loadusers()
+        return count
 
     def getweather(self, user):
         """Return a dict of user's settings."""
-        self._conn.row_factory = sqlite3.Row
-        with self._conn as conn:
+        with self._lock:
+            self._loadusers()
+            row = self._users.get(user)
+        if not row:  # user does not exist.
+            return None
+        else:  # user exists.
+            rowdict = dict(izip(self._columns, row))
+            return rowdict
+
+    def getlocation(self, query, maxage):
+        """Return the cached location for query, or None if missing or older than maxage seconds."""
+        with self._connect() as conn:
             cursor = conn.cursor()
-            cursor.execute("""SELECT * from users where nick=?""", (user,))
+            cursor.execute("""SELECT location from locations where query=? AND updated>?""", (query, int(time.time()) - maxage,))
             row = cursor.fetchone()
-            if not row:  # user does not exist.
+            if row:
+                return row[0]
+            else:
                 return None
-            else:  # user exists.
-                rowdict = dict(izip(row.keys(), row))
-                return rowdict
 
-    def getuser(self, user):
-        """Returns a boolean if a user exists."""
-        with self._conn as conn:
+    def setlocation(self, query, location):
+        """Stores or updates the location a query resolves to."""
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""INSERT OR REPLACE INTO locations (query, location, updated) VALUES (?,?,?)""", (query, location, int(time.time()),))
+
+    def getresponse(self, location, feature, lang):
+        """Return (data, fetched, ttl) for a cached API response, or None."""
+        with self._connect() as conn:
             cursor = conn.cursor()
-            cursor.execute("""SELECT location from users where nick=?""", (user,))
+            cursor.execute("""SELECT data, fetched, ttl from responses where location=? AND feature=? AND lang=?""", (location, feature, lang,))
             row = cursor.fetchone()
-            if row:
-                return True
-            else:
-                return False
+        if not row:
+            return None
+        return (json.loads(zlib.decompress(bytes(row[0])).decode('utf-8')), row[1], row[2])
+
+    def setresponses(self, rows):
+        """Stores or updates API responses: a list of (location, feature, lang, data, fetched, ttl)."""
+        rows = [(location, feature, lang, sqlite3.Binary(zlib.compress(json.dumps(data).encode('utf-8'))), fetched, ttl)
+                for (location, feature, lang, data, fetched, ttl) in rows]
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.executemany("""INSERT OR REPLACE INTO responses (location, feature, lang, data, fetched, ttl) VALUES (?,?,?,?,?,?)""", rows)
+
+    def pruneresponses(self, before):
+        """Delete API responses that expired before the time before. Returns how many were deleted."""
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""DELETE FROM responses WHERE fetched + ttl < ?""", (before,))
+            return cursor.rowcount
+
+    def setdigest(self, network, channel, at, locations):
+        """Stores or replaces the digest posted in channel at HH:MM."""
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""INSERT OR REPLACE INTO digests (network, channel, time, locations) VALUES (?,?,?,?)""",
+                           (network, channel, at, json.dumps(locations),))
+
+    def deldigest(self, network, channel, at):
+        """Deletes the digest posted in channel at HH:MM. Returns False if there was none."""
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""DELETE FROM digests WHERE network=? AND channel=? AND time=?""", (network, channel, at,))
+            return cursor.rowcount > 0
+
+    def getdigests(self, network, channel):
+        """Return [(time, locations)] for channel's digests, in time order."""
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""SELECT time, locations FROM digests WHERE network=? AND channel=? ORDER BY time""", (network, channel,))
+            return [(row[0], json.loads(row[1])) for row in cursor.fetchall()]
+
+    def duedigests(self, times):
+        """Return [(network, channel, time, locations)] for every digest due at one of times (HH:MM)."""
+        if not times:
+            return []
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""SELECT network, channel, time, locations FROM digests WHERE time IN (%s) ORDER BY time, network, channel""" %
+                           ",".join("?" * len(times)), tuple(times))
+            return [tuple(row[:3]) + (json.loads(row[3]),) for row in cursor.fetchall()]
+
+    def addsubscription(self, network, channel, location):
+        """Subscribes channel to alerts for location. Returns False if it already was."""
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""INSERT OR IGNORE INTO subscriptions (network, channel, location) VALUES (?,?,?)""", (network, channel, location,))
+            return cursor.rowcount > 0
+
+    def delsubscription(self, network, channel, location):
+        """Unsubscribes channel from alerts for location. Returns False if it wasn't subscribed."""
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""DELETE FROM subscriptions WHERE network=? AND channel=? AND location=?""", (network, channel, location,))
+            return cursor.rowcount > 0
+
+    def getsubscriptions(self, network, channel):
+        """Return the locations channel is subscribed to, in order."""
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""SELECT location FROM subscriptions WHERE network=? AND channel=? ORDER BY location""", (network, channel,))
+            return [row[0] for row in cursor.fetchall()]
+
+    def allsubscriptions(self):
+        """Return [(network, channel, location)] for every subscription."""
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""SELECT network, channel, location FROM subscriptions ORDER BY location, network, channel""")
+            return [tuple(row) for row in cursor.fetchall()]
+
+    def getlocations(self):
+        """Return every user's location (one per user, so popular ones repeat)."""
+        with self._lock:
+            self._loadusers()
+            index = self._columns.index('location')
+            return [row[index] for row in self._users.values()]
+
+    def getuser(self, user):
+        """Returns a boolean if a user exists."""
+        with self._lock:  # importusers empties and reloads _users under the lock.
+            self._loadusers()
+            return user in self._users
 
 
 class Weather(callbacks.Plugin):
@@ -138,22 +438,90 @@ class Weather(callbacks.Plugin):
         self.__parent.__init__(irc)
         self.APIKEY = self.registryValue('apiKey')
         self.db = WeatherDB()
+        # decoded API responses, keyed by (location, feature, lang).
+        self.cache = TTLCache(self.registryValue('cache.ttl.conditions'), self.registryValue('cache.maxEntries'))
+        # concurrent identical API calls share one request.
+        self.flights = SingleFlight()
+        # keys (as for cache) already looked for in the DB's copy of the cache.
+        self._diskchecked = set()
+        self.diskhits = 0
+        # locations that don't exist: ('wuac', query) or ('api', location).
+        self.notfound = TTLCache(self.registryValue('cache.ttl.notFound'), self.registryValue('cache.maxEntries'))
+        # the API key's call limits.
+        self.quota = QuotaGovernor(self.registryValue('quota.perMinute'), self.registryValue('quota.perDay'))
+        # expired entries we've shown instead, to refresh: (location, lang) -> set of features.
+        self.revalidate = {}
+        self._revalidatelock = threading.Lock()
+        self.staleserved = 0
+        # output renderers, keyed by the settings they were built for.
+        self._renderers = {}
+        # lookups by (location, lang), for prefetching the popular ones.
+        self.popular = Popularity()
+        self.prefetched = 0
+        self._seeded = False
+        self._decayed = time.time()
+        self._prefetching = threading.Lock()
+        self._stopping = threading.Event()
+        schedule.addPeriodicEvent(self._prefetch, self.registryValue('prefetch.interval'), name='Weather.prefetch', now=False)
+        # expired responses are deleted from the DB every hour.
+        schedule.addPeriodicEvent(self._prune, 3600, name='Weather.prune', now=False)
+        # how long each phase of a lookup takes.
+        self.metrics = Metrics()
+        self._logged = 0
+        self._loginterval = self.registryValue('metrics.logInterval')
+        if self._loginterval:
+            schedule.addPeriodicEvent(self._logmetrics, self._loginterval, name='Weather.metrics', now=False)
+        # place names and postal codes we can resolve ourselves. loaded (and built, if needed) in the background.
+        self.gazetteer = None
+        self.locallookups = 0
+        if self.registryValue('gazetteer.dumps'):
+            thread = threading.Thread(target=self._loadgazetteer, name='Weather gazetteer')
+            thread.daemon = True
+            thread.start()
+        # digests. checked twice a minute; _digested is the last minute (since the epoch) posted.
+        self._digested = int(time.time() // 60) - 1
+        schedule.addPeriodicEvent(self._digest, 30, name='Weather.digest', now=False)
+        # alert subscriptions. all of them are checked every interval, each location once.
+        # seenalerts has the alerts already announced (see _alertkey), until a day after they expire.
+        self.seenalerts = TTLCache(86400, self.registryValue('subscriptions.remember'))
+        self._polled = set()  # locations checked since we loaded. the alerts they had then aren't new.
+        self._polling = threading.Lock()
+        schedule.addPeriodicEvent(self._poll, self.registryValue('subscriptions.interval'), name='Weather.subscriptions', now=False)
+        # where the data comes from, in order of preference.
+        providers = []
+        for name in self.registryValue('providers'):
+            if name in PROVIDERS:
+                providers.append(PROVIDERS[name](self.registryValue, self.metrics))
+            else:
+                self.log.error("Weather: unknown provider {0}. Valid providers are: {1}".format(name, ", ".join(sorted(PROVIDERS))))
+        if not providers:
+            providers.append(PROVIDERS['wunderground'](self.registryValue, self.metrics))
+        self._setproviders(providers)
 
-    def die(self):
-        self.__parent.die()
-
-    ##############
-    # FORMATTING #
-    ##############
-
-    def _bold(self, string):
-        return ircutils.bold(string)
+    def _setproviders(self, providers):
+        """Use providers (Provider instances, in order of preference), each with its own circuit breakers."""
 
-    def _bu(self, string):
-        return ircutils.underline(ircutils.bold(string))
+        self.providers = providers
+        # fail fast while a provider's API or autocomplete is down: (provider, 'api' or 'autocomplete') -> breaker.
+        self.breakers = {}
+        for provider in self.providers:
+            for kind in ('api', 'autocomplete'):
+                self.breakers[(provider.name, kind)] = CircuitBreaker(self.registryValue('breaker.threshold'), self.registryValue('breaker.timeout'))
 
-    def _strip(self, string):
-        return ircutils.stripFormatting(string)
+    def die(self):
+        schedule.removePeriodicEvent('Weather.prefetch')
+        schedule.removePeriodicEvent('Weather.prune')
+        schedule.removePeriodicEvent('Weather.digest')
+        schedule.removePeriodicEvent('Weather.subscriptions')
+        if self._loginterval:
+            schedule.removePeriodicEvent('Weather.metrics')
+        self._stopping.set()
+        # lookups already under way keep their own reference; see _local.
+        (gazetteer, self.gazetteer) = (self.gazetteer, None)
+        if gazetteer:
+            gazetteer.close()
+        self.db.close()
+        self.__parent.die()
 
     ############################
     # INTERNAL WEATHER HELPERS #
@@ -209,58 +577,17 @@ class Weather(callbacks.Plugin):
         # return.
         return symbol
 
-    def _temp(self, x):
-        """Returns a colored string based on the temperature."""
+    def _renderer(self, args):
+        """Return the (cached) Renderer for the output settings in args."""
 
-        # lets be safe and wrap in a try/except because we can't always trust data purity.
-        try:
-            if x.startswith('NA'): # Wunderground sends a field that's not available
-                return x
-            # first, convert into F so we only have one table.
-            if x.endswith('C'):  # c.
-                x = float(x[:-1]) * 9 / 5 + 32  # remove C + math into float(F).
-                unit = "C"
-            else:  # f.
-                x = float(x[:-1])  # remove F. str->float.
-                unit = "F"
-            # determine color.
-            if x < 10.0:
-                color = 'light blue'
-            elif 10.0 <= x <= 32.0:
-                color = 'teal'
-            elif 32.1 <= x <= 50.0:
-                color = 'blue'
-            elif 50.1 <= x <= 60.0:
-                color = 'light green'
-            elif 60.1 <= x <= 70.0:
-                color = 'green'
-            elif 70.1 <= x <= 80.0:
-                color = 'yellow'
-            elif 80.1 <= x <= 90.0:
-                color = 'orange'
-            elif x > 90.0:
-                color = 'red'
-            else:
-                color = 'light grey'
-            # return.
-            if unit == "F":  # no need to convert back.
-                return ircutils.mircColor(("{0:.0f}F".format(x)), color)
-            else:  # temp is in F and we need to go back to C.
-                return ircutils.mircColor(("{0:.0f}C".format((x - 32) * 5 / 9)),color)
-        except Exception as e:  # rutroh. something went wrong.
-            self.log.info("_temp: ERROR trying to convert temp: {0} message: {1}".format(x, e))
-            return x
-
-    def _tw(self, bol, x):
-        """This is a convenience handle that wraps _temp."""
-
-        # make sure we have 'bol', which should come in from args['nocolortemp'].
-        # since the option is a negation, we assume NO.
-        if not bol:  # COLOR IT.
-            x = self._temp(x)
-            return x
-        else:
-            return x
+        key = (args['imperial'], args['showImperialAndMetric'], args['nocolortemp'], args['humidity'],\
+               tuple(k for k in Renderer.EXTRAS if args[k]), args['updated'])
+        renderer = self._renderers.get(key)
+        if renderer is None:
+            renderer = Renderer(args['imperial'], args['showImperialAndMetric'], not args['nocolortemp'],\
+                                args['humidity'], key[4], args['updated'], self._wind)
+            self._renderers[key] = renderer
+        return renderer
 
     def _wind(self, angle, useSymbols=False):
         """Converts degrees to direction for wind. Can optionally return a symbol."""
@@ -324,86 +651,519 @@ class Weather(callbacks.Plugin):
 
     setweather = wrap(setweather, [('text')])
 
+    def exportusers(self, irc, msg, args, filename):
+        """<file>
+
+        Writes every user's location and settings to <file> (in the data directory unless it's a full path), as CSV or JSON depending on whether it ends in .csv or .json.
+        """
+
+        filename = conf.supybot.directories.data.dirize(filename)
+        try:
+            users = self.db.exportusers()
+            writeusers(filename, users)
+        except (EnvironmentError, ValueError) as e:
+            irc.error("Could not export users to {0} :: {1}".format(filename, e), Raise=True)
+        irc.reply("Exported {0} users to {1}".format(len(users), filename))
+
+    exportusers = wrap(exportusers, ['owner', 'somethingWithoutSpaces'])
+
+    def importusers(self, irc, msg, args, optlist, filename):
+        """[--overwrite] <file>
+
+        Adds the users in <file> (CSV or JSON, like exportusers writes; only nick and location are needed), all at once.
+        Users who are already known keep their location and settings, unless --overwrite is given.
+        Nothing is imported if any user in <file> is invalid.
+        """
+
+        filename = conf.supybot.directories.data.dirize(filename)
+        overwrite = 'overwrite' in [key for (key, value) in optlist]
+        try:
+            count = self.db.importusers(readusers(filename), overwrite)
+        except (EnvironmentError, ValueError, sqlite3.Error) as e:
+            irc.error("Could not import users from {0} :: {1}".format(filename, e), Raise=True)
+        irc.reply("Imported {0} users from {1}".format(count, filename))
+
+    importusers = wrap(importusers, ['owner', getopts({'overwrite':''}), 'somethingWithoutSpaces'])
+
     ##########################
     # WUNDERGROUND API CALLS #
     ##########################
 
-    def _wuac(self, q):
-        """Internal helper to find a location via Wunderground's autocomplete API."""
+    def _normquery(self, q):
+        """Normalize a location query for the location cache."""
+
+        return " ".join(q.lower().split())
+
+    def _resolved(self, location):
+        """Return what location was last resolved to, or location itself."""
+
+        ttl = self.registryValue('cache.locationTTL')
+        if ttl:
+            return self.db.getlocation(self._normquery(location), ttl) or location
+        return location
 
-        url = 'http://autocomplete.wunderground.com/aq?query=%s' % utils.web.urlquote(q)
-        #self.log.info("WUAC URL: {0}".format(url))
-        # try and fetch.
+    def _loadgazetteer(self):
+        """Open the gazetteer index, building it first if the dumps changed since it was built."""
+
+        dumps = self.registryValue('gazetteer.dumps')
+        filename = conf.supybot.directories.data.dirize('Weather.gaz')
         try:
-            page = utils.web.getUrl(url)
-        except Exception as e:  # something didn't work.
-            self.log.info("_wuac: ERROR: Trying to open {0} message: {1}".format(url, e))
+            try:
+                gazetteer = Gazetteer(filename)
+            except Exception:  # missing, or not an index.
+                gazetteer = None
+            if gazetteer is None or gazetteer.signature != signature(dumps) or \
+               os.path.getmtime(filename) < max([os.path.getmtime(dump) for dump in dumps]):
+                if gazetteer:
+                    gazetteer.close()
+                self.log.info("Weather: building the gazetteer from {0}".format(", ".join(dumps)))
+                places = build(filename, dumps)
+                self.log.info("Weather: gazetteer built with {0} places.".format(places))
+                gazetteer = Gazetteer(filename)
+        except Exception as e:
+            self.log.error("Weather: ERROR loading the gazetteer from {0} :: {1}".format(", ".join(dumps), e))
+            return
+        if self._stopping.is_set():  # unloaded meanwhile.
+            gazetteer.close()
+        else:
+            self.gazetteer = gazetteer
+
+    def _local(self, q):
+        """Resolve q with the gazetteer, if there is one. Returns "lat,lon" or None.
+
+        Place names and postal codes resolve to the most populous match.
+        Coordinates resolve to a place within gazetteer.snap km of them, so
+        lookups for nearby spots share cache entries.
+        """
+
+        gazetteer = self.gazetteer
+        if gazetteer is None:
             return None
-        # now process json and return.
+        coordinates = COORDINATES.match(q)
+        if coordinates:
+            snap = self.registryValue('gazetteer.snap')
+            if not snap:
+                return None
         try:
-            data = json.loads(page.decode('utf-8'))
-            loc = data['RESULTS'][0]['zmw']  # find the first zmw.
-            loc = "zmw:%s" % loc  # return w/zmw: attached.
+            if coordinates:
+                place = gazetteer.nearest(float(coordinates.group(1)), float(coordinates.group(2)))
+                if place is not None and place[3] > snap:
+                    place = None
+            else:
+                place = gazetteer.lookup(q)
+        except ValueError:  # die() closed it under us: let the API answer.
+            if self.gazetteer is gazetteer:
+                raise
+            return None
+        if place is None:
+            return None
+        self.locallookups += 1
+        return latlon(place[1], place[2])
+
+    def _wuac(self, q):
+        """Internal helper to find a location via the gazetteer or Wunderground's autocomplete API."""
+
+        loc = self._local(q)
+        if loc:
             return loc
-        except Exception as e:
-            self.log.info("_wuac: ERROR processing json in {0} :: {1}".format(url, e))
+        # check the location cache first.
+        query = self._normquery(q)
+        ttl = self.registryValue('cache.locationTTL')
+        if ttl:
+            loc = self.db.getlocation(query, ttl)
+            if loc:
+                return loc
+        if self.notfound.get(('wuac', query)):
+            return None
+        return self.flights.do(('wuac', query), self._wuacfetch, q, query)
+
+    def _wuacfetch(self, q, query):
+        """Look q up with the first provider that answers and cache it under query. Returns a location or None."""
+
+        for provider in self.providers:
+            breaker = self.breakers[(provider.name, 'autocomplete')]
+            if not breaker.allow():  # it's down. don't wait on it.
+                continue
+            self.metrics.count('autocomplete')
+            try:
+                loc = provider.geocode(q)
+            except Exception as e:  # something didn't work. try the next one.
+                breaker.failure()
+                self.log.info("_wuac: ERROR: looking up {0} with {1} :: {2}".format(q, provider.name, e))
+                continue
+            breaker.success()
+            break
+        else:  # none of them could.
             return None
+        if not loc:  # no such location. remember that for a bit.
+            if self.notfound.ttl:
+                self.notfound.set(('wuac', query), True)
+            return None
+        if self.registryValue('cache.locationTTL'):
+            self.db.setlocation(query, loc)
+        return loc
 
-    def _wunderjson(self, url, location):
-        """Fetch wunderground JSON and return."""
+    def _notfound(self, q):
+        """Error message for when q could not be looked up."""
 
-        # first, construct the url properly.
-        if url.endswith('/'):  # cheap way to strip the tailing /
-            url = '%sq/%s.json' % (url, utils.web.urlquote(location))
-        else:
-            url = '%s/q/%s.json' % (url, utils.web.urlquote(location))
-        # now actually fetch the url.
+        if self._down('autocomplete'):
+            return "Location lookups are unavailable right now. Try again in a bit."
+        return "I could not find a valid location for: {0}".format(q)
+
+    def _featurettl(self, feature, data):
+        """Return how long to cache feature for, in seconds.
+
+        almanac and astronomy only change once a day, so they're kept until
+        midnight, local to the location if data has its timezone.
+        """
+
+        if feature in ('almanac', 'astronomy'):
+            offset = data.get('current_observation', {}).get('local_tz_offset')
+            try:  # +HHMM/-HHMM.
+                sign = -1 if offset[0] == '-' else 1
+                offset = sign * (int(offset[1:3]) * 3600 + int(offset[3:5]) * 60)
+            except Exception:  # fall back on our own timezone.
+                offset = -(time.altzone if time.localtime().tm_isdst else time.timezone)
+            return 86400 - (time.time() + offset) % 86400
+        return self.registryValue('cache.ttl.%s' % feature)
+
+    def _wunderjson(self, urlArgs, location):
+        """Fetch wunderground JSON for location and return it decoded.
+
+        Each feature is cached separately (by location and language), so
+        only the features we don't have yet are fetched, and any units or
+        output settings can be served from the same entries.
+        """
+
+        notfound = self.notfound.get(('api', location))
+        if notfound is not None:
+            return notfound
+        lang = urlArgs['lang']
+        if self.registryValue('prefetch.locations'):
+            self.popular.hit((location, lang), urlArgs['features'])
+        data = {'response': {}}
+        missing = []
+        for feature in urlArgs['features']:
+            part = self.cache.get((location, feature, lang))
+            if part is None:
+                part = self._fromdisk((location, feature, lang))
+            if part is None:
+                missing.append(feature)
+            else:
+                data.update(part)
+        if not missing:
+            return data
+        fetchArgs = dict(urlArgs, features=missing)
+        fetched = self.flights.do(('wunderjson', location, tuple(sorted(missing)), lang), self._wunderfetch, fetchArgs, location, data)
+        if not fetched:  # out of API calls, or it's down. fall back on what we had.
+            return self._stale(urlArgs, location, missing, data)
+        if 'error' in fetched.get('response', {}) or 'results' in fetched.get('response', {}):
+            return fetched  # let the caller deal with these.
+        data.update(fetched)
+        return data
+
+    def _wunderfetch(self, urlArgs, location, cached, background=False):
+        """Fetch and decode wunderground JSON, and cache each feature in it.
+
+        cached holds what we already have for this location (for its timezone).
+        background calls (prefetching, refreshing) get a smaller share of the API quota.
+        """
+
+        data = self._fetch(urlArgs['features'], location, urlArgs['lang'], background)
+        if data is None:
+            return None
+        # only cache good responses, but remember locations that don't exist.
+        if 'error' in data.get('response', {}) or 'results' in data.get('response', {}):
+            if data['response'].get('error', {}).get('type') == 'querynotfound' and self.notfound.ttl:
+                self.notfound.set(('api', location), data)
+            return data
+        merged = dict(cached, **data)
+        rows = []
+        now = self.cache.clock()
+        for feature in urlArgs['features']:
+            part = dict((k, data[k]) for k in FEATUREKEYS[feature] if k in data)
+            derived = self._derive(feature, part)
+            data.update(derived)
+            ttl = self._featurettl(feature, merged)
+            if ttl:
+                key = (location, feature, urlArgs['lang'])
+                self.cache.set(key, derived, ttl, stored=now)
+                rows.append(key + (part, now, ttl))
+                self._diskchecked.add(key)  # the DB copy is older than this.
+        if rows and self.registryValue('cache.persist'):
+            try:
+                self.db.setresponses(rows)
+            except Exception as e:  # the reply doesn't depend on it.
+                self.log.error("_wunderjson: ERROR saving responses for {0} :: {1}".format(location, e))
+        return data
+
+    def _derive(self, feature, part):
+        """Return part with what's worked out from it added, so it's done once per cache entry rather than per reply.
+
+        For hourly10day, that's a render.Hourly under 'hourly'. Only the
+        plain part is written to the DB.
+        """
+
+        if feature == 'hourly10day' and 'hourly_forecast' in part:
+            return dict(part, hourly=Hourly(part['hourly_forecast']))
+        return part
+
+    def _nextprovider(self, providers, location, background):
+        """Return the next provider in providers that's up, as long as there's quota to ask it, or None."""
+
+        for provider in providers:
+            if not self.breakers[(provider.name, 'api')].allow():  # it's down. don't wait on it.
+                continue
+            if not self.quota.acquire(background):  # out of API calls for now.
+                self.log.info("_wunderjson: over the API quota, not fetching {0}".format(location))
+                return None
+            self.metrics.count('api')
+            return provider
+        return None
+
+    def _fetchfrom(self, provider, features, location, lang):
+        """Fetch features for location from provider. Returns data, or None if it failed."""
+
+        breaker = self.breakers[(provider.name, 'api')]
+        start = time.time()
         try:
-            self.log.info("URL: {0}".format(url))
-            page = utils.web.getUrl(url)
-            return page
+            data = provider.fetch(location, features, lang)
         except Exception as e:  # something didn't work.
-            self.log.info("_wunderjson: ERROR Trying to open {0} message: {1}".format(url, e))
+            breaker.failure()
+            self.log.info("_wunderjson: ERROR fetching {0} from {1} :: {2}".format(location, provider.name, e))
             return None
+        breaker.success()
+        if len(self.providers) > 1:  # for hedging.
+            self.metrics.record('api:' + provider.name, time.time() - start)
+        return data
 
-    ####################
-    # PUBLIC FUNCTIONS #
-    ####################
+    def _hedgeafter(self, provider):
+        """Seconds to give provider before asking the next one as well: its 95th percentile latency."""
 
-    def wunderground(self, irc, msg, args, optlist, optinput):
-        """[--options] <location>
+        stats = self.metrics.percentiles('api:' + provider.name)
+        if stats and stats[0] >= 20:
+            return stats[2]
+        return self.registryValue('hedgeDelay')  # not enough timings yet.
 
-        Fetch weather and forcast information for <location>
+    def _fetch(self, features, location, lang, background=False):
+        """Fetch features for location from the providers. Returns data, or None.
 
-        Location must be one of: US state/city (CA/San_Francisco), zipcode, country/city (Australia/Sydney), airport code (KJFK)
-        Use --help to list all options.
-        Ex: 10021 or Sydney, Australia or KJFK
+        Providers that are down are skipped, and when one fails the next is
+        asked. If one is slower to answer than usual (see _hedgeafter), the
+        next is asked as well and whichever answers first is used.
         """
 
-        # first, check if we have an API key. Useless w/o this.
-        if len(self.APIKEY) < 1 or not self.APIKEY or self.APIKEY == "Not set":
-            irc.error("Need a Wunderground API key. Set config plugins.Weather.apiKey and reload Weather.", Raise=True)
+        providers = iter(self.providers)
+        provider = self._nextprovider(providers, location, background)
+        if provider is None:
+            return None
+        if len(self.providers) == 1:  # nothing to hedge with.
+            return self._fetchfrom(provider, features, location, lang)
+        results = queue.Queue()
+        pending = 0
+        while provider is not None or pending:
+            wait = None
+            if provider is not None:
+                thread = threading.Thread(target=lambda p: results.put(self._fetchfrom(p, features, location, lang)),
+                                          args=(provider,), name='Weather fetch ({0})'.format(provider.name))
+                thread.daemon = True
+                thread.start()
+                pending += 1
+                wait = self._hedgeafter(provider)
+                provider = None
+            try:
+                data = results.get(timeout=wait)
+            except queue.Empty:  # slow. ask the next one too.
+                provider = self._nextprovider(providers, location, background)
+                continue
+            pending -= 1
+            if data is not None:
+                return data
+            provider = self._nextprovider(providers, location, background)  # that failed. fail over.
+        return None
+
+    def _needskey(self):
+        """True if the Wunderground provider is used, but there's no API key."""
+
+        if 'wunderground' not in [provider.name for provider in self.providers]:
+            return False
+        return len(self.APIKEY) < 1 or not self.APIKEY or self.APIKEY == "Not set"
+
+    def _down(self, kind):
+        """True if kind ('api' or 'autocomplete') isn't available from any provider right now."""
+
+        return [provider for provider in self.providers if self.breakers[(provider.name, kind)].state == 'closed'] == []
+
+    def _fromdisk(self, key):
+        """Load key from the DB's copy of the cache, the first time it's looked up.
+
+        The entry goes into cache even if it has expired, for _stale. Returns
+        its value if it's still fresh, or None.
+        """
+
+        if key in self._diskchecked or not self.registryValue('cache.persist'):
+            return None
+        if len(self._diskchecked) >= 10 * self.cache.maxentries:  # keep this bounded.
+            self._diskchecked.clear()
+        self._diskchecked.add(key)
+        try:
+            row = self.db.getresponse(*key)
+        except Exception as e:
+            self.log.error("_fromdisk: ERROR loading {0} :: {1}".format(key, e))
+            return None
+        if row is None:
+            return None
+        (part, fetched, ttl) = row
+        part = self._derive(key[1], part)
+        self.cache.set(key, part, ttl, stored=fetched)
+        if fetched + ttl <= self.cache.clock():
+            return None
+        self.diskhits += 1
+        return part
+
+    def _prune(self):
+        """Periodic event: delete responses from the DB that are too old to be shown even stale."""
+
+        thread = threading.Thread(target=self._prunerun, name='Weather prune')
+        thread.daemon = True
+        thread.start()
+
+    def _prunerun(self):
+        try:
+            pruned = self.db.pruneresponses(self.cache.clock() - self.registryValue('cache.maxStale'))
+            if pruned:
+                self.log.info("_prune: deleted {0} expired responses.".format(pruned))
+        except Exception as e:
+            self.log.info("_prune: ERROR deleting expired responses :: {0}".format(e))
+
+    def _prefetch(self):
+        """Periodic event: refresh stale and popular locations in the background, unless that's still going."""
+
+        if (self.revalidate or self.registryValue('prefetch.locations')) and self._prefetching.acquire(False):
+            thread = threading.Thread(target=self._prefetchrun, name='Weather prefetch')
+            thread.daemon = True
+            thread.start()
+
+    def _prefetchrun(self):
+        """Refresh entries that were shown stale, then those of the most popular locations that are about to expire.
+
+        Prefetch API calls are spread out to at most prefetch.maxPerMinute.
+        """
+
+        try:
+            self._revalidaterun()
+            if not self.registryValue('prefetch.locations'):
+                return
+            lang = self.registryValue('lang')
+            if not self._seeded:  # saved locations are what users will most likely ask for.
+                for location in self.db.getlocations():
+                    self.popular.hit((self._resolved(location), lang), ['conditions', 'forecast'])
+                self._seeded = True
+            if time.time() - self._decayed >= 3600:
+                self.popular.decay()
+                self._decayed = time.time()
+            lead = self.registryValue('prefetch.lead')
+            perminute = self.registryValue('prefetch.maxPerMinute')
+            budget = max(1, perminute * self.registryValue('prefetch.interval') // 60)
+            for ((location, lang), features) in self.popular.top(self.registryValue('prefetch.locations')):
+                if budget <= 0 or self._stopping.is_set() or not self.quota.available(background=True):
+                    break
+                now = time.time()
+                cached = {'response': {}}
+                due = []
+                for feature in features:
+                    entry = self.cache.peek((location, feature, lang))
+                    if entry is not None and entry[2] - now > lead:
+                        cached.update(entry[0])
+                    elif self._featurettl(feature, {}):  # skip features that aren't cached at all.
+                        due.append(feature)
+                if not due:
+                    continue
+                due.sort()
+                urlArgs = {'features':due, 'lang':lang, 'bestfct':'1', 'pws':'0'}
+                data = self.flights.do(('wunderjson', location, tuple(due), lang), self._wunderfetch, urlArgs, location, cached, True)
+                if data and ('error' in data['response'] or 'results' in data['response']):
+                    self.popular.forget((location, lang))  # not worth retrying.
+                self.prefetched += 1
+                budget -= 1
+                self._stopping.wait(60.0 / perminute)
+        except Exception as e:
+            self.log.info("_prefetch: ERROR refreshing locations :: {0}".format(e))
+        finally:
+            self._prefetching.release()
+
+    def _revalidaterun(self):
+        """Refresh the entries we had to show stale, as far as the quota allows."""
+
+        with self._revalidatelock:
+            pending, self.revalidate = self.revalidate, {}
+        pending = list(pending.items())
+        while pending and not self._stopping.is_set() and self.quota.available(background=True):
+            ((location, lang), features) = pending.pop()
+            features = sorted(features)
+            entry = self.cache.peek((location, 'conditions', lang))  # for its timezone.
+            cached = dict(entry[0], response={}) if entry else {'response': {}}
+            urlArgs = {'features':features, 'lang':lang, 'bestfct':'1', 'pws':'0'}
+            self.flights.do(('wunderjson', location, tuple(features), lang), self._wunderfetch, urlArgs, location, cached, True)
+        # whatever is left waits for the next run.
+        with self._revalidatelock:
+            for (key, features) in pending:
+                self.revalidate.setdefault(key, set()).update(features)
+
+    def _stale(self, urlArgs, location, missing, data):
+        """Complete data with expired cache entries for the missing features, and queue them for a refresh.
+
+        Returns None if any of them is missing or more than cache.maxStale past its expiry.
+        """
+
+        maxstale = self.registryValue('cache.maxStale')
+        lang = urlArgs['lang']
+        now = self.cache.clock()
+        age = 0
+        for feature in missing:
+            entry = self.cache.peek((location, feature, lang))
+            if entry is None or now - entry[2] > maxstale:
+                return None
+            data.update(entry[0])
+            age = max(age, now - entry[1])
+        data['stale'] = age  # seconds. shown with the output.
+        self.staleserved += 1
+        with self._revalidatelock:
+            self.revalidate.setdefault((location, lang), set()).update(missing)
+        return data
+
+    def _metricsreport(self):
+        return "Timings (p50/p95/p99 of the last {0}): {1} | {2} API calls, {3} autocomplete calls".format(\
+            self.metrics.size, self.metrics.report(), self.metrics.counters.get('api', 0), self.metrics.counters.get('autocomplete', 0))
+
+    def _logmetrics(self):
+        """Periodic event: log timings, if there were any lookups since last time."""
+
+        if self.metrics.recorded != self._logged:
+            self._logged = self.metrics.recorded
+            self.log.info("Weather: {0}".format(self._metricsreport()))
+
+    def _settings(self, nick, channel):
+        """Return (args, location) for nick in channel: the output options, and the user's location or None.
+
+        The order will always go global->channel (supybot config) -> user.
+        """
 
-        # urlargs will be used to build the url to query the API.
-        # besides lang, these are unmutable values that should not be changed.
-        urlArgs = {'features':['conditions', 'forecast'],
-                   'lang':self.registryValue('lang'),
-                   'bestfct':'1',
-                   'pws':'0' }
         # now, figure out the rest of the options for fetching and displaying weather.
         # some of these are for the query and the others are for output.
-        # the order will always go global->channel (supybot config) -> user.
         loc = None
-        args = {'imperial':self.registryValue('useImperial', msg.args[0]),
-                'nocolortemp':self.registryValue('disableColoredTemp', msg.args[0]),
+        args = {'imperial':self.registryValue('useImperial', channel),
+                'nocolortemp':self.registryValue('disableColoredTemp', channel),
                 'alerts':self.registryValue('alerts'),
                 'almanac':self.registryValue('almanac'),
                 'astronomy':self.registryValue('astronomy'),
                 'pressure':self.registryValue('showPressure'),
                 'wind':self.registryValue('showWind'),
                 'updated':self.registryValue('showUpdated'),
-                'showImperialAndMetric':self.registryValue('showImperialAndMetric', msg.args[0]),
+                'showImperialAndMetric':self.registryValue('showImperialAndMetric', channel),
                 'forecast':False,
+                'hourly':False,
+                'tenday':False,
                 'humidity':False,
                 'strip':False,
                 'uv':False,
@@ -412,7 +1172,7 @@ class Weather(callbacks.Plugin):
 
         # instead of doing optlist, we need to handle the location/options to set initially.
         # first, check if there is a user so we can grab their settings.
-        usersetting = self.db.getweather(msg.nick.lower())  # check the db.
+        usersetting = self.db.getweather(nick.lower())  # check the db.
         if usersetting:  # user is found. lets grab their location and settings.
                 for (k, v) in usersetting.items():  # iterate over settings dict returned from getweather row.
                      # set specific settings based on keys that won't 1:1 match.
@@ -433,9 +1193,241 @@ class Weather(callbacks.Plugin):
                             args[k] = True
                         else:  # argument is 0 or False.
                             args[k] = False
-        else:  # user was not found.
-            if not optinput:  # location was also not specified, so we must bail.
-                irc.error("I did not find a preset location for you. Set via setweather <location>", Raise=True)
+        return (args, loc)
+
+    def _weatherdata(self, urlArgs, location, name):
+        """Fetch weather for location, following ambiguous results to the first match.
+
+        Returns (data, None), or (None, error) with an error message mentioning name.
+        """
+
+        with self.metrics.time('fetch'):
+            data = self._wunderjson(urlArgs, location)
+        if not data:
+            if self._down('api'):
+                return (None, "Wunderground API is unavailable right now. Try again in a bit.")
+            if not self.quota.available():
+                return (None, "I'm out of Wunderground API calls for now. Try again in a bit.")
+            return (None, "Failed to load Wunderground API. Check the logs for more information.")
+
+        # now, a series of sanity checks before we process.
+        if 'error' in data['response']:  # check if there are errors.
+            errortype = data['response']['error']['type']  # type. description is below.
+            errordesc = data['response']['error'].get('description', 'no description')
+            return (None, "I got an error searching '{0}'. ({1}: {2})".format(name, errortype, errordesc))
+        # if there is more than one city matching (Ambiguous Results).  we now go with the first (best?) match.
+        # this should no longer be the case with our autocomplete routine above but we'll keep this anyways.
+        if 'results' in data['response']:  # we grab the first location's "ZMW" which then gets constructed as location.
+            first = 'zmw:%s' % data['response']['results'][0]['zmw']  # grab the "first" location and create the
+            # remember it so that next time we don't need two lookups.
+            if self.registryValue('cache.locationTTL'):
+                self.db.setlocation(self._normquery(location), first)
+            # grab this first location and search again.
+            with self.metrics.time('zmw'):
+                data = self._wunderjson(urlArgs, first)
+            if not data:
+                return (None, "Failed to load Wunderground API.")
+        return (data, None)
+
+    def _lookup(self, urlArgs, location):
+        """Resolve and fetch location. Returns (data, None) or (None, error message)."""
+
+        try:
+            wloc = self._wuac(location)
+            if not wloc:
+                return (None, self._notfound(location))
+            return self._weatherdata(urlArgs, self._resolved(wloc), location)
+        except Exception as e:
+            self.log.info("_lookup: ERROR looking up {0} :: {1}".format(location, e))
+            return self._lookupfailed(location)
+
+    def _lookupfailed(self, location):
+        """What _lookup returns when looking up location went wrong."""
+
+        return (None, "Failed to get weather for: {0}".format(location))
+
+    def _duetimes(self, minute):
+        """Return the times of day (HH:MM, local) from after the last minute digests were posted for up to minute.
+
+        Catches up on minutes the scheduler skipped, but only the last ten."""
+
+        minutes = range(max(self._digested + 1, minute - 9), minute + 1)
+        self._digested = max(self._digested, minute)
+        return [time.strftime('%H:%M', time.localtime(m * 60)) for m in minutes]
+
+    def _digest(self):
+        """Periodic event: post the digests that are due, from a thread."""
+
+        due = self.db.duedigests(self._duetimes(int(time.time() // 60)))
+        if due:
+            thread = threading.Thread(target=self._digestrun, args=(due,), name='Weather digest')
+            thread.daemon = True
+            thread.start()
+
+    def _digestrun(self, due):
+        """Post the digests in due, [(network, channel, time, locations)].
+
+        Each location is fetched once, however many of the digests have it,
+        and then rendered with each channel's settings.
+        """
+
+        try:
+            urlArgs = {'features':['conditions', 'forecast'],
+                       'lang':self.registryValue('lang'),
+                       'bestfct':'1',
+                       'pws':'0' }
+            locations = OrderedDict()  # normalized query -> location as given.
+            for (network, channel, at, wanted) in due:
+                for location in wanted:
+                    locations.setdefault(self._normquery(location), location)
+            results = dict(zip(locations, self._parallel(lambda location: self._lookup(urlArgs, location), list(locations.values()), self._lookupfailed)))
+        except Exception as e:
+            self.log.error("_digest: ERROR fetching digests :: {0}".format(e))
+            return
+        for (network, channel, at, wanted) in due:  # one that fails doesn't stop the others.
+            try:
+                irc = world.getIrc(network)
+                if irc is None or channel not in irc.state.channels:  # not there right now.
+                    continue
+                renderer = self._renderer(self._settings('', channel)[0])
+                for location in wanted:
+                    (data, error) = results[self._normquery(location)]
+                    if not error:
+                        try:
+                            reply = renderer.main(data)
+                        except Exception as e:  # odd data for this one.
+                            self.log.error("_digest: ERROR rendering {0} :: {1}".format(location, e))
+                            (reply, error) = (None, self._lookupfailed(location)[1])
+                    irc.queueMsg(ircmsgs.privmsg(channel, error or reply))
+            except Exception as e:
+                self.log.error("_digest: ERROR posting {0} digest in {1} on {2} :: {3}".format(at, channel, network, e))
+
+    def _alertkey(self, location, alert):
+        """What an alert of location's is known by: what it's about, when it was issued, and when it expires.
+
+        Wunderground alerts have no id of their own. An alert that's
+        extended gets a new key, so it's announced again.
+        """
+
+        return (location, alert.get('phenomena') or alert.get('type'), alert.get('significance'),
+                alert.get('description'), alert.get('date_epoch'), alert.get('expires_epoch'))
+
+    def _poll(self):
+        """Periodic event: check subscribed locations for new alerts in the background, unless that's still going."""
+
+        if self._polling.acquire(False):
+            thread = threading.Thread(target=self._pollrun, name='Weather alerts')
+            thread.daemon = True
+            thread.start()
+
+    def _pollrun(self):
+        """Fetch alerts for every subscribed location once, and announce the new ones in the channels subscribed to it.
+
+        On the first check of a location after loading, its alerts are only
+        remembered: they could have been announced before.
+        """
+
+        try:
+            urlArgs = {'features':['conditions', 'alerts'],
+                       'lang':self.registryValue('lang'),
+                       'bestfct':'1',
+                       'pws':'0' }
+            subscribers = OrderedDict()  # location -> [(network, channel)].
+            for (network, channel, location) in self.db.allsubscriptions():
+                subscribers.setdefault(location, []).append((network, channel))
+            locations = list(subscribers)
+            self._polled.intersection_update(locations)  # forget unsubscribed ones.
+            results = self._parallel(lambda location: self._lookup(urlArgs, location), locations, self._lookupfailed)
+            now = time.time()
+            announce = OrderedDict()  # (network, channel) -> alert -> line. an alert for several of a channel's locations goes out once.
+            for (location, (data, error)) in zip(locations, results):
+                if error:
+                    self.log.info("_poll: not checking {0} for alerts this time :: {1}".format(location, error))
+                    continue
+                primed = location in self._polled
+                self._polled.add(location)
+                name = data.get('current_observation', {}).get('display_location', {}).get('full', location)
+                for alert in data.get('alerts') or []:
+                    key = self._alertkey(location, alert)
+                    if self.seenalerts.get(key):
+                        continue
+                    try:
+                        ttl = max(0, float(alert['expires_epoch']) - now) + 86400
+                    except (KeyError, TypeError, ValueError):
+                        ttl = None
+                    self.seenalerts.set(key, True, ttl)
+                    if primed:
+                        for subscriber in subscribers[location]:
+                            announce.setdefault(subscriber, OrderedDict()).setdefault(key[1:], alertline(name, alert))
+            for ((network, channel), lines) in announce.items():
+                irc = world.getIrc(network)
+                if irc is None or channel not in irc.state.channels:  # not there right now.
+                    continue
+                for line in lines.values():
+                    irc.queueMsg(ircmsgs.privmsg(channel, line))
+        except Exception as e:
+            self.log.error("_poll: ERROR checking for alerts :: {0}".format(e))
+        finally:
+            self._polling.release()
+
+    def _parallel(self, func, items, failed):
+        """Return [func(item) for item in items], running at most multi.threads calls at a time.
+
+        If func(item) raises, failed(item) is used instead."""
+
+        results = [None] * len(items)
+        work = queue.Queue()
+        for job in enumerate(items):
+            work.put(job)
+
+        def worker():
+            while True:
+                try:
+                    (i, item) = work.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    results[i] = func(item)
+                except Exception as e:
+                    self.log.error("_parallel: ERROR with {0} :: {1}".format(item, e))
+                    results[i] = failed(item)
+
+        threads = [threading.Thread(target=worker, name='Weather lookup') for _ in range(min(len(items), self.registryValue('multi.threads')))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    ####################
+    # PUBLIC FUNCTIONS #
+    ####################
+
+    def wunderground(self, irc, msg, args, optlist, optinput):
+        """[--options] <location>
+
+        Fetch weather and forcast information for <location>
+
+        Location must be one of: US state/city (CA/San_Francisco), zipcode, country/city (Australia/Sydney), airport code (KJFK)
+        Use --help to list all options.
+        Ex: 10021 or Sydney, Australia or KJFK
+        """
+
+        # first, check if we have an API key. Useless w/o this.
+        if self._needskey():
+            irc.error("Need a Wunderground API key. Set config plugins.Weather.apiKey and reload Weather.", Raise=True)
+        start = time.time()
+
+        # urlargs will be used to build the url to query the API.
+        # besides lang, these are unmutable values that should not be changed.
+        urlArgs = {'features':['conditions', 'forecast'],
+                   'lang':self.registryValue('lang'),
+                   'bestfct':'1',
+                   'pws':'0' }
+        args, loc = self._settings(msg.nick, msg.args[0])
+        if loc is None and not optinput:  # user was not found and location was also not specified, so we must bail.
+            irc.error("I did not find a preset location for you. Set via setweather <location>", Raise=True)
 
         # handle optlist (getopts). this will manipulate output via args dict.
         # we must do this after the dblookup for users as it would always override.
@@ -447,6 +1439,10 @@ class Weather(callbacks.Plugin):
                     args['alerts'] = True
                 if key == 'forecast':
                     args['forecast'] = True
+                if key == 'hourly':
+                    args['hourly'] = True
+                if key == '10day':
+                    args['tenday'] = True
                 if key == 'almanac':
                     args['almanac'] = True
                 if key == 'pressure':
@@ -466,7 +1462,7 @@ class Weather(callbacks.Plugin):
                 if key == 'nocolortemp':
                     args['nocolortemp'] = True
                 if key == 'help':  # make shift help because the docstring is overloaded above.
-                    irc.reply("Options: --metric --alerts --forecast --almanac --pressure --wind --uv --visibility --dewpoint --astronomy --nocolortemp")
+                    irc.reply("Options: --metric --alerts --forecast --hourly --10day --almanac --pressure --wind --uv --visibility --dewpoint --astronomy --nocolortemp")
                     irc.reply("WeatherDB options: setweather <location> (set user's location). setmetric True/False (set metric option) setcolortemp True/False (display color temp?")
                     return
 
@@ -476,287 +1472,56 @@ class Weather(callbacks.Plugin):
         # loc = the location that can come back if a user is known and this is set.
         # both of these might not be valid locations. however, if a user specifies a location, we should look it up.
         if optinput:  # if we have optinput, regardless if the user is known or not, autocomplete it.
-            wloc = self._wuac(optinput)
+            with self.metrics.time('autocomplete'):
+                wloc = self._wuac(optinput)
             if not wloc:  # error looking up the location.
-                irc.error("I could not find a valid location for: {0}".format(optinput), Raise=True)
+                irc.error(self._notfound(optinput), Raise=True)
         elif loc and not optinput:  # user is known. location is set. no optinput.
             wloc = loc   # set wloc as their location. worst case, the user gets an error for setting it wrong.
         else:  # no optinput. no location. error out. this should happen above but lets be redundant.
             irc.error("You must specify a city to search for weather.", Raise=True)
+        # if this location was ambiguous before, go straight to what it resolved to.
+        wloc = self._resolved(wloc)
 
-        # build url now. first, apikey. then, iterate over urlArgs and insert.
-        url = 'http://api.wunderground.com/api/%s/' % (self.APIKEY) # first part of url, w/APIKEY
         # now we need to set certain things for urlArgs based on args.
         for check in ['alerts', 'almanac', 'astronomy']:
             if args[check]: # if args['value'] is True, either via config or getopts.
                 urlArgs['features'].append(check) # append to dict->key (list)
-        # now, we use urlArgs dict to append to url.
-        for (key, value) in urlArgs.items():
-            if key == "features": # will always be at least conditions.
-                url += "".join([item + '/' for item in value]) # listcmp the features/
-            if key == "lang" or key == "bestfct" or key == "pws": # rest added with key:value
-                url += "{0}:{1}/".format(key, value)
+        if args['hourly'] or args['tenday']:  # both come from the same hourly10day response.
+            urlArgs['features'].append('hourly10day')
 
         # now that we're done, lets finally make our API call.
-        page = self._wunderjson(url, wloc)
-        if not page:
-            irc.error("Failed to load Wunderground API. Check the logs for more information.", Raise=True)
-
-        # process json.
-        try:
-            data = json.loads(page.decode('utf-8'))
-        except Exception as e:
-            self.log.error("ERROR: could not process JSON from: {0} :: {1}".format(url, e))
-            irc.error("Could not process JSON from Weather Underground. Check the logs.", Raise=True)
-
-        # now, a series of sanity checks before we process.
-        if 'error' in data['response']:  # check if there are errors.
-            errortype = data['response']['error']['type']  # type. description is below.
-            errordesc = data['response']['error'].get('description', 'no description')
-            irc.error("I got an error searching '{0}'. ({1}: {2})".format(loc, errortype, errordesc), Raise=True)
-        # if there is more than one city matching (Ambiguous Results).  we now go with the first (best?) match.
-        # this should no longer be the case with our autocomplete routine above but we'll keep this anyways.
-        if 'results' in data['response']:  # we grab the first location's "ZMW" which then gets constructed as location.
-            first = 'zmw:%s' % data['response']['results'][0]['zmw']  # grab the "first" location and create the
-            # grab this first location and search again.
-            page = self._wunderjson(url, first)
-            if not page:
-                irc.error("Failed to load Wunderground API.", Raise=True)
-            # we're here if we got the second search (best?) now lets reload the json and continue.
-            data = json.loads(page.decode('utf-8'))
+        data, error = self._weatherdata(urlArgs, wloc, optinput or loc)
+        if error:
+            irc.error(error, Raise=True)
 
         # no errors so we start the main part of processing.
-        outdata = {}
-        outdata['weather'] = data['current_observation']['weather']
-        outdata['location'] = data['current_observation']['display_location']['full']
-        outdata['humidity'] = data['current_observation']['relative_humidity']
-        outdata['uv'] = data['current_observation']['UV']
-
-        # handle wind. check if there is none first.
-        if data['current_observation']['wind_mph'] < 1:  # no wind.
-            outdata['wind'] = "None"
-        else:  # we do have wind. process differently.
-            if args['imperial']:  # imperial units for wind.
-                outdata['wind'] = "{0}@{1}mph".format(self._wind(data['current_observation']['wind_degrees']), data['current_observation']['wind_mph'])
-                if int(data['current_observation']['wind_gust_mph']) > 0:   # gusts?
-                    outdata['wind'] += " ({0}mph gusts)".format(data['current_observation']['wind_gust_mph'])
-            else:  # handle metric units for wind.
-                outdata['wind'] = "{0}@{1}kph".format(self._wind(data['current_observation']['wind_degrees']),data['current_observation']['wind_kph'])
-                if int(data['current_observation']['wind_gust_kph']) > 0:  # gusts?
-                    outdata['wind'] += " ({0}kph gusts)".format(data['current_observation']['wind_gust_kph'])
-
-        # handle the time. concept/method from WunderWeather plugin.
-        observationTime = data['current_observation'].get('observation_epoch')
-        localTime = data['current_observation'].get('local_epoch')
-        # if we don't have the epoches from above, default to obs_time
-        if not observationTime or not localTime:
-            outdata['observation'] = data.get('observation_time', 'unknown').lstrip('Last Updated on ')
-        else:  # we do have so format for relative time.
-            s = int(localTime) - int(observationTime)  # format into seconds.
-            if s <= 1:
-                outdata['observation'] = 'just now'
-            elif s < 60:
-                outdata['observation'] = '{0}s ago'.format(s)
-            elif s < 120:
-                outdata['observation'] = '1m ago'
-            elif s < 3600:
-                outdata['observation'] = '{0}m ago'.format(s/60)
-            elif s < 7200:
-                outdata['observation'] = '1hr ago'
-            else:
-                outdata['observation'] = '{0}hrs ago'.format(s/3600)
-
-        # handle basics like temp/pressure/dewpoint. big conditional here
-        # as we can display Imperial + Metric, or one or the other.
-        if args['showImperialAndMetric']:
-            # lets put C and F into strings to make it easier.
-            tf = str(data['current_observation']['temp_f']) + 'F'
-            tc = str(data['current_observation']['temp_c']) + 'C'
-            outdata['temp'] = "{0}/{1}".format(self._tw(args['nocolortemp'], tf), self._tw(args['nocolortemp'], tc))
-            # now lets do pressure.
-            pin = str(data['current_observation']['pressure_in']) + 'in'
-            pmb = str(data['current_observation']['pressure_mb']) + 'mb'
-            outdata['pressure'] = "{0}/{1}".format(pin, pmb)
-            # dewpoint.
-            dpf = str(data['current_observation']['dewpoint_f']) + 'F'
-            dpc = str(data['current_observation']['dewpoint_c']) + 'C'
-            outdata['dewpoint'] = "{0}/{1}".format(self._tw(args['nocolortemp'], dpf), self._tw(args['nocolortemp'], dpc))
-            # heatindex.
-            hif = str(data['current_observation']['heat_index_f']) + 'F'
-            hic = str(data['current_observation']['heat_index_c']) + 'C'
-            outdata['heatindex'] = "{0}/{1}".format(self._tw(args['nocolortemp'], hif), self._tw(args['nocolortemp'], hic))
-            # windchill.
-            wcf = str(data['current_observation']['windchill_f']) + 'F'
-            wcc = str(data['current_observation']['windchill_c']) + 'C'
-            outdata['windchill'] = "{0}/{1}".format(self._tw(args['nocolortemp'], wcf), self._tw(args['nocolortemp'], wcc))
-            # feels like
-            flf = str(data['current_observation']['feelslike_f']) + 'F'
-            flc = str(data['current_observation']['feelslike_c']) + 'C'
-            outdata['feelslike'] = "{0}/{1}".format(self._tw(args['nocolortemp'], flf), self._tw(args['nocolortemp'], flc))
-            # visibility.
-            vmi = str(data['current_observation']['visibility_mi']) + 'mi'
-            vkm = str(data['current_observation']['visibility_km']) + 'km'
-            outdata['visibility'] = "{0}/{1}".format(vmi, vkm)
-        else:  # don't display both (default)
-            if args['imperial']:  # assigns the symbol based on metric.
-                outdata['temp'] = self._tw(args['nocolortemp'], str(data['current_observation']['temp_f']) + 'F')
-                outdata['pressure'] = str(data['current_observation']['pressure_in']) + 'in'
-                outdata['dewpoint'] = self._tw(args['nocolortemp'], str(data['current_observation']['dewpoint_f']) + 'F')
-                outdata['heatindex'] = self._tw(args['nocolortemp'], str(data['current_observation']['heat_index_f']) + 'F')
-                outdata['windchill'] = self._tw(args['nocolortemp'], str(data['current_observation']['windchill_f']) + 'F')
-                outdata['feelslike'] = self._tw(args['nocolortemp'], str(data['current_observation']['feelslike_f']) + 'F')
-                outdata['visibility'] = str(data['current_observation']['visibility_mi']) + 'mi'
-            else:  # metric.
-                outdata['temp'] = self._tw(args['nocolortemp'], str(data['current_observation']['temp_c']) + 'C')
-                outdata['pressure'] = str(data['current_observation']['pressure_mb']) + 'mb'
-                outdata['dewpoint'] = self._tw(args['nocolortemp'], str(data['current_observation']['dewpoint_c']) + 'C')
-                outdata['heatindex'] = self._tw(args['nocolortemp'], str(data['current_observation']['heat_index_c']) + 'C')
-                outdata['windchill'] = self._tw(args['nocolortemp'], str(data['current_observation']['windchill_c']) + 'C')
-                outdata['feelslike'] = self._tw(args['nocolortemp'], str(data['current_observation']['feelslike_c']) + 'C')
-                outdata['visibility'] = str(data['current_observation']['visibility_km']) + 'km'
-
-        # handle forecast data part. output will be below. (not --forecast)
-        forecastdata = {}  # key = int(day), value = forecast dict.
-        for forecastday in data['forecast']['txt_forecast']['forecastday']:
-            tmpdict = {}
-            tmpdict['day'] = forecastday['title']
-            # tmpdict['symbol'] = self._weatherSymbol(forecastday['icon'])
-            if args['imperial']:   # imperial.
-                tmpdict['text'] = forecastday['fcttext']
-            else:  # metric.
-                tmpdict['text'] = forecastday['fcttext_metric']
-            forecastdata[int(forecastday['period'])] = tmpdict
-
-        # now this is the --forecast part.
-        if args['forecast']:  # only if we get this in getopts.
-            fullforecastdata = {}  # key = day (int), value = dict of forecast data.
-            for forecastday in data['forecast']['simpleforecast']['forecastday']:
-                tmpdict = {}
-                tmpdict['day'] = forecastday['date']['weekday_short']
-                tmpdict['symbol'] = self._weatherSymbol(forecastday['icon'])
-                tmpdict['text'] = forecastday['conditions']
-                if args['imperial']:  # imperial.
-                    tmpdict['high'] = forecastday['high']['fahrenheit'] + "F"
-                    tmpdict['low'] = forecastday['low']['fahrenheit'] + "F"
-                else:  # metric.
-                    tmpdict['high'] = forecastday['high']['celsius'] + "C"
-                    tmpdict['low'] = forecastday['low']['celsius'] + "C"
-                fullforecastdata[int(forecastday['period'])] = tmpdict
-
-        # handle almanac
-        if args['almanac']:
-            outdata['highyear'] = data['almanac']['temp_high'].get('recordyear', 'NA')
-            outdata['lowyear'] = data['almanac']['temp_low'].get('recordyear', 'NA')
-            if args['imperial']:  # imperial.
-                outdata['highnormal'] = data['almanac']['temp_high']['normal']['F'] + "F"
-                outdata['lownormal'] = data['almanac']['temp_low']['normal']['F'] + "F"
-                if outdata['highyear'] != "NA" and outdata['lowyear'] != "NA":
-                    outdata['highrecord'] = data['almanac']['temp_high']['record']['F']
-                    outdata['lowrecord'] = data['almanac']['temp_low']['record']['F']
-                else:
-                    outdata['highrecord'] = "NA"
-                    outdata['lowrecord'] = "NA"
-            else:  # metric.
-                outdata['highnormal'] = data['almanac']['temp_high']['normal']['C'] + "C"
-                outdata['lownormal'] = data['almanac']['temp_low']['normal']['C'] + "C"
-                if outdata['highyear'] != "NA" and outdata['lowyear'] != "NA":
-                    outdata['highrecord'] = data['almanac']['temp_high']['record']['C']
-                    outdata['lowrecord'] = data['almanac']['temp_low']['record']['C']
-                else:
-                    outdata['highrecord'] = "NA"
-                    outdata['lowrecord'] = "NA"
-
-        # handle astronomy
-        if args['astronomy']:
-            outdata['moonilluminated'] = data['moon_phase']['percentIlluminated']
-            outdata['moonage'] = data['moon_phase']['ageOfMoon']
-            sunriseh = data['moon_phase']['sunrise']['hour']
-            sunrisem = data['moon_phase']['sunrise']['minute']
-            sunseth = data['moon_phase']['sunset']['hour']
-            sunsetm = data['moon_phase']['sunset']['minute']
-            outdata['sunrise'] = "{0}:{1}".format(sunriseh, sunrisem)  # construct sunrise.
-            outdata['sunset'] = "{0}:{1}".format(sunseth, sunsetm)  # construct sunset. calc "time of day" below.
-            outdata['lengthofday'] = "%dh%dm" % divmod((((int(sunseth)-int(sunriseh))+float((int(sunsetm)-int(sunrisem))/60.0))*60),60)
-
-        # handle alerts
-        if args['alerts']:  # only look for alerts if there.
-            if data['alerts']:  # alerts is a list. it can also be empty.
-                outdata['alerts'] = data['alerts'][0]['message']  # need to do some formatting below.
-                outdata['alerts'] = outdata['alerts'].replace('\n', ' ')[:300]  # \n->' ' and max 300 chars.
-                outdata['alerts'] = utils.str.normalizeWhitespace(outdata['alerts'])  # fix pesky double whitespacing.
-            else:  # no alerts found (empty).
-                outdata['alerts'] = "No alerts."
-
-        # OUTPUT.
-        # we go step-by-step to build the proper string. ° u" \u00B0C"
-        output = "{0} :: {1} ::".format(self._bold(outdata['location']), outdata['weather'])
-        # add in temperature.
-        output += " {0}".format(outdata['temp'])
-        # humidity.
-        if args['humidity']:  # display humidity?
-            output += " (Humidity: {0}) ".format(outdata['humidity'])
-        else:
-            output += " "
-        # windchill/heatindex are conditional on season but test with startswith to see what to include
-        if not outdata['windchill'].startswith("NA"):  # windchill.
-            output += "| {0} {1} ".format(self._bold('Wind Chill:'), outdata['windchill'])
-        if not outdata['heatindex'].startswith("NA"):  # heatindex.
-            output += "| {0} {1} ".format(self._bold('Heat Index:'), outdata['heatindex'])
-        # now get into the args dict for what to include (extras)
-        for (k, v) in args.items():
-            if k in ['wind', 'visibility', 'uv', 'pressure', 'dewpoint']: # if key is in extras
-                if v: # if that key's value is True, we add it.
-                    output += "| {0}: {1} ".format(self._bold(k.title()), outdata[k])
-        # add in the first two forecast item in conditions + updated time.
-        output += "| {0}: {1}".format(self._bold(forecastdata[0]['day']), forecastdata[0]['text'])
-        output += " {0}: {1}".format(self._bold(forecastdata[1]['day']), forecastdata[1]['text'])
-         # show Updated?
-        if args['updated']:
-            output += " | {0} {1}".format(self._bold('Updated:'), outdata['observation'])
-        # finally, output the basic weather.
-        irc.reply(output)
-
-        # next, for outputting, handle the extras like alerts, almanac, astronomy, forecast.
-        if args['alerts']:  # if --alerts issued.
-            irc.reply("{0} :: {1}".format(self._bu("Alerts:"), outdata['alerts']))
-        # handle almanac if --almanac is given.
-        if args['almanac']:
-            if args['nocolortemp']:  # disable colored temp?
-                output = "{0} :: Normal High: {1} (Record: {2} in {3}) | Normal Low: {4} (Record: {5} in {6})".format(\
-                    self._bu('Almanac:'), outdata['highnormal'], outdata['highrecord'], outdata['highyear'],\
-                    outdata['lownormal'], outdata['lowrecord'], outdata['lowyear'])
-            else:  # colored temp.
-                output = "{0} :: Normal High: {1} (Record: {2} in {3}) | Normal Low: {4} (Record: {5} in {6})".format(\
-                    self._bu('Almanac:'), self._temp(outdata['highnormal']), self._temp(outdata['highrecord']),\
-                    outdata['highyear'], self._temp(outdata['lownormal']), self._temp(outdata['lowrecord']), outdata['lowyear'])
-            # now output to irc.
-            irc.reply(output)
-        # handle astronomy if --astronomy is given.
-        if args['astronomy']:
-            output = "{0} :: Moon illum: {1}%   Moon age: {2}d   Sunrise: {3}  Sunset: {4}  Length of Day: {5}".format(\
-                self._bu('Astronomy:'), outdata['moonilluminated'], outdata['moonage'],outdata['sunrise'],\
-                outdata['sunset'], outdata['lengthofday'])
-            # irc output now.
-            irc.reply(output)
-        # handle main forecast if --forecast is given.
-        if args['forecast']:
-            outforecast = [] # prep string for output.
-            for (k, v) in fullforecastdata.items(): # iterate through forecast data.
-                if args['nocolortemp']:
-                    outforecast.append("{0}: {1} ({2}/{3})".format(self._bold(v['day']),\
-                        v['text'], v['high'], v['low']))
-                else:
-                    outforecast.append("{0}: {1} ({2}/{3})".format(self._bold(v['day']),\
-                        v['text'], self._temp(v['high']), self._temp(v['low'])))
-            # construct our string to output.
-            output = "{0} :: {1}".format(self._bu('Forecast:'), " | ".join(outforecast))
-            # now output to irc.
-            irc.reply(output)
+        with self.metrics.time('format'):
+            renderer = self._renderer(args)
+            output = [renderer.main(data)]
+            # next, for outputting, handle the extras like alerts, almanac, astronomy, forecast.
+            if args['alerts']:  # if --alerts issued.
+                output.append(renderer.alerts(data))
+            if args['almanac']:  # handle almanac if --almanac is given.
+                output.append(renderer.almanac(data))
+            if args['astronomy']:  # handle astronomy if --astronomy is given.
+                output.append(renderer.astronomy(data))
+            if args['forecast']:  # handle main forecast if --forecast is given.
+                output.append(renderer.forecast(data))
+            if args['hourly']:  # the next 24 hours, if --hourly is given.
+                output.append(renderer.hourly(data, self.cache.clock()))
+            if args['tenday']:  # daily highs/lows, if --10day is given.
+                output.append(renderer.tenday(data, self.cache.clock()))
+        for line in output:
+            irc.reply(line)
+        self.metrics.record('total', time.time() - start)
 
     wunderground = wrap(wunderground, [getopts({'alerts':'',
                                                 'almanac':'',
                                                 'astronomy':'',
                                                 'forecast':'',
+                                                'hourly':'',
+                                                '10day':'',
                                                 'pressure':'',
                                                 'wind':'',
                                                 'uv':'',
@@ -767,6 +1532,185 @@ class Weather(callbacks.Plugin):
                                                 'nocolortemp':'',
                                                 'help':''}), optional('text')])
 
+    def multi(self, irc, msg, args, optinput):
+        """<location> | <location> [| <location> ...]
+
+        Fetch current conditions for several locations at once, one line each.
+        Ex: 10002 | London, UK | KSFO
+        """
+
+        # first, check if we have an API key. Useless w/o this.
+        if self._needskey():
+            irc.error("Need a Wunderground API key. Set config plugins.Weather.apiKey and reload Weather.", Raise=True)
+        # every location costs an API call, so keep within the key's limits.
+        locations = self._locations(irc, optinput)
+        # output follows the user's settings, but only conditions are needed.
+        renderer = self._renderer(self._settings(msg.nick, msg.args[0])[0])
+        urlArgs = {'features':['conditions'],
+                   'lang':self.registryValue('lang'),
+                   'bestfct':'1',
+                   'pws':'0' }
+
+        def lookup(location):
+            data, error = self._lookup(urlArgs, location)
+            return error or renderer.summary(data)
+
+        # all locations are looked up at the same time, and answered in the order given.
+        for reply in self._parallel(lookup, locations, lambda location: self._lookupfailed(location)[1]):
+            irc.reply(reply)
+
+    multi = wrap(multi, ['text'])
+
+    def _locations(self, irc, text):
+        """Split text into locations, or reply with an error."""
+
+        locations = []
+        for location in text.split('|'):
+            location = location.strip()
+            if location and location not in locations:  # skip blanks and repeats.
+                locations.append(location)
+        if not locations:
+            irc.error("You must specify a city to search for weather.", Raise=True)
+        maxlocations = self.registryValue('multi.maxLocations')
+        if len(locations) > maxlocations:
+            irc.error("I can only look up {0} locations at once.".format(maxlocations), Raise=True)
+        return locations
+
+    def _digesttime(self, irc, at):
+        """Validate a digest's HH:MM, and zero-pad it the way digests are stored."""
+
+        match = HHMM.match(at)
+        if not match:
+            irc.errorInvalid('time (HH:MM)', at, Raise=True)
+        return "{0:02d}:{1}".format(int(match.group(1)), match.group(2))
+
+    def adddigest(self, irc, msg, args, channel, at, optinput):
+        """[<channel>] <HH:MM> <location> [| <location> ...]
+
+        Every day at HH:MM (the bot's local time), post the weather and forecast for each location in channel.
+        Replaces any digest channel already has at that time.
+        Ex: 07:00 10002 | London, UK
+        """
+
+        at = self._digesttime(irc, at)
+        locations = self._locations(irc, optinput)
+        self.db.setdigest(irc.network, channel, at, locations)
+        irc.replySuccess()
+
+    adddigest = wrap(adddigest, ['op', 'somethingWithoutSpaces', 'text'])
+
+    def deldigest(self, irc, msg, args, channel, at):
+        """[<channel>] <HH:MM>
+
+        Stop posting the digest channel has at HH:MM.
+        """
+
+        at = self._digesttime(irc, at)
+        if not self.db.deldigest(irc.network, channel, at):
+            irc.error("{0} has no digest at {1}.".format(channel, at), Raise=True)
+        irc.replySuccess()
+
+    deldigest = wrap(deldigest, ['op', 'somethingWithoutSpaces'])
+
+    def digests(self, irc, msg, args, channel):
+        """[<channel>]
+
+        List the daily weather digests posted in channel.
+        """
+
+        digests = self.db.getdigests(irc.network, channel)
+        if not digests:
+            irc.reply("{0} has no digests.".format(channel))
+        else:
+            irc.reply("; ".join("{0}: {1}".format(at, " | ".join(locations)) for (at, locations) in digests))
+
+    digests = wrap(digests, ['channel'])
+
+    def subscribe(self, irc, msg, args, channel, optinput):
+        """[<channel>] <location>
+
+        Announce new weather alerts for <location> in channel. Locations are checked every few minutes, whichever channels subscribe to them.
+        Ex: 10002
+        """
+
+        if self._needskey():
+            irc.error("Need a Wunderground API key. Set config plugins.Weather.apiKey and reload Weather.", Raise=True)
+        location = self._normquery(optinput)
+        subscriptions = self.db.getsubscriptions(irc.network, channel)
+        if location in subscriptions:
+            irc.error("{0} already gets alerts for {1}.".format(channel, location), Raise=True)
+        maxsubscriptions = self.registryValue('subscriptions.maxPerChannel')
+        if len(subscriptions) >= maxsubscriptions:
+            irc.error("{0} can only get alerts for {1} locations.".format(channel, maxsubscriptions), Raise=True)
+        if not self._wuac(optinput):
+            irc.error(self._notfound(optinput), Raise=True)
+        self.db.addsubscription(irc.network, channel, location)
+        irc.replySuccess()
+
+    subscribe = wrap(subscribe, ['op', 'text'])
+
+    def unsubscribe(self, irc, msg, args, channel, optinput):
+        """[<channel>] <location>
+
+        Stop announcing weather alerts for <location> in channel.
+        """
+
+        if not self.db.delsubscription(irc.network, channel, self._normquery(optinput)):
+            irc.error("{0} doesn't get alerts for {1}.".format(channel, optinput), Raise=True)
+        irc.replySuccess()
+
+    unsubscribe = wrap(unsubscribe, ['op', 'text'])
+
+    def subscriptions(self, irc, msg, args, channel):
+        """[<channel>]
+
+        List the locations channel gets weather alerts for.
+        """
+
+        subscriptions = self.db.getsubscriptions(irc.network, channel)
+        if not subscriptions:
+            irc.reply("{0} doesn't get alerts for any locations.".format(channel))
+        else:
+            irc.reply(" | ".join(subscriptions))
+
+    subscriptions = wrap(subscriptions, ['channel'])
+
+    def stats(self, irc, msg, args):
+        """takes no arguments.
+
+        Shows response cache, request coalescing, API health, quota and prefetch statistics, and how long each phase of a lookup takes.
+        """
+
+        stats = self.cache.stats()
+        lookups = stats['hits'] + stats['misses']
+        hitrate = (100.0 * stats['hits'] / lookups) if lookups else 0.0
+        output = "Cache: {0} entries | {1} hits, {2} misses ({3:.1f}% hit rate) | {4} evictions | {5} coalesced requests".format(\
+            stats['entries'], stats['hits'], stats['misses'], hitrate, stats['evictions'], self.flights.shared)
+        output += " | {0} loaded from disk | {1} unknown locations remembered | {2} stale replies".format(\
+            self.diskhits, len(self.notfound), self.staleserved)
+        if self.quota.perminute or self.quota.perday:
+            self.quota.available()  # brings the counts up to date.
+            output += " | Quota: {0:.0f}/{1} calls left this minute, {2}/{3} used today, {4} over quota".format(\
+                self.quota.tokens, self.quota.perminute or 'unlimited', self.quota.today, self.quota.perday or 'unlimited', self.quota.denied)
+        for provider in self.providers:
+            for (kind, label) in (('api', 'API'), ('autocomplete', 'Autocomplete')):
+                if len(self.providers) > 1:
+                    label += " ({0})".format(provider.name)
+                breaker = self.breakers[(provider.name, kind)]
+                output += " | {0}: {1}".format(label, breaker.state)
+                if breaker.state != 'closed':
+                    output += " (retry in {0:.0f}s)".format(breaker.retryin())
+                if breaker.rejected:
+                    output += ", {0} failed fast".format(breaker.rejected)
+        if self.gazetteer:
+            output += " | Gazetteer: {0} places, {1} local lookups".format(len(self.gazetteer), self.locallookups)
+        if self.registryValue('prefetch.locations'):
+            output += " | Prefetch: {0} refreshes, {1} locations tracked".format(self.prefetched, len(self.popular))
+        irc.reply(output)
+        irc.reply(self._metricsreport())
+
+    stats = wrap(stats, ['admin'])
+
 Class = Weather
 
 # vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=250:
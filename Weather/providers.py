@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+###
+# Copyright (c) 2012-2014, spline
+# All rights reserved.
+###
+# Weather data sources for the Weather plugin.
+from __future__ import unicode_literals
+import json
+import logging
+import supybot.utils as utils
+
+from .extract import extract
+from .metrics import Metrics
+
+log = logging.getLogger('supybot.plugins.Weather')
+
+
+class Provider():
+    """A source of weather data.
+
+    There's no provider-neutral model yet: whatever a provider talks to, it
+    returns data laid out like Wunderground API responses, with only the
+    fields in extract.FIELDS, because that's what render.Renderer, the
+    response cache in Weather.db and the recorded fixtures all use: the
+    response key (with any error or ambiguous results) and, for each feature,
+    the keys in extract.FEATUREKEYS. Locations are what geocode() returns;
+    providers used together must understand each other's.
+
+    Subclasses implement geocode() and fetch(). Failures (network, bad
+    data) are raised; the plugin counts them against the provider's
+    circuit breaker and fails over to the next provider.
+    """
+
+    name = None
+
+    def __init__(self, registryValue=None, metrics=None):
+        self.registryValue = registryValue
+        self.metrics = metrics or Metrics()
+
+    def geocode(self, query):
+        """Return the location for query, or None if there's no such place."""
+        raise NotImplementedError
+
+    def fetch(self, location, features, lang):
+        """All of features for location, in one response."""
+        raise NotImplementedError
+
+
+class WundergroundProvider(Provider):
+    """The Wunderground API (apiUrl, autocompleteUrl and apiKey)."""
+
+    name = 'wunderground'
+
+    def geocode(self, query):
+        url = '%s?query=%s' % (self.registryValue('autocompleteUrl'), utils.web.urlquote(query))
+        data = json.loads(utils.web.getUrl(url).decode('utf-8'))
+        if not data['RESULTS']:
+            return None
+        return "zmw:%s" % data['RESULTS'][0]['zmw']  # the first one, w/zmw: attached.
+
+    def fetch(self, location, features, lang):
+        # build url now. first, apikey. then, the features and the rest of the args.
+        url = '%s/%s/' % (self.registryValue('apiUrl').rstrip('/'), self.registryValue('apiKey'))
+        url += "".join([item + '/' for item in features])
+        url += "lang:{0}/bestfct:1/pws:0/".format(lang)
+        url += 'q/%s.json' % utils.web.urlquote(location)
+        log.info("URL: {0}".format(url))
+        with self.metrics.time('api'):
+            page = utils.web.getUrl(url)
+        with self.metrics.time('decode'):
+            return extract(page, self.registryValue('streamAbove'))
+
+
+PROVIDERS = dict((provider.name, provider) for provider in (WundergroundProvider,))
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=250:
@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+###
+# Copyright (c) 2012-2014, spline
+# All rights reserved.
+###
+# Output formatting for the Weather plugin.
+from __future__ import unicode_literals
+from bisect import bisect_left
+import logging
+import supybot.utils as utils
+import supybot.ircutils as ircutils
+
+# the plugin's own logger, without importing supybot.log (which sets up log
+# files), so this module can be used outside the bot. see benchmark.py.
+log = logging.getLogger('supybot.plugins.Weather')
+
+# temperature colors: below 10F, then up to and including each threshold, then above the last.
+TEMPTHRESHOLDS = (32, 50, 60, 70, 80, 90)
+TEMPCOLORS = ('light blue', 'teal', 'blue', 'light green', 'green', 'yellow', 'orange', 'red')
+# the color codes only need working out once.
+_TEMPFORMATS = [ircutils.mircColor('{0}', color) for color in TEMPCOLORS]
+# hourly temperatures, lowest to highest.
+SPARKS = '\u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588'
+# chance of precipitation (%) from which it's worth mentioning.
+POPTHRESHOLD = 40
+
+
+def _bold(string):
+    return ircutils.bold(string)
+
+def _bu(string):
+    return ircutils.underline(ircutils.bold(string))
+
+def _literal(string):
+    """Escape string for use as literal text in a format string."""
+    return string.replace('{', '{{').replace('}', '}}')
+
+def _asof(data):
+    """' (as of N min ago)' if data is from an expired cache entry, else nothing."""
+    if 'stale' not in data:
+        return ""
+    return " (as of {0} min ago)".format(max(1, int(data['stale'] // 60)))
+
+def coloredtemp(x):
+    """Returns temperature string x (ex: 64F or -3C) colored by how warm it is."""
+
+    if x.startswith('NA'):  # Wunderground sends a field that's not available
+        return x
+    try:
+        value = float(x[:-1])
+    except ValueError as e:  # we can't always trust data purity.
+        log.info("coloredtemp: ERROR trying to convert temp: {0} message: {1}".format(x, e))
+        return x
+    if x.endswith('C'):  # the table is in F.
+        unit, f = 'C', value * 9 / 5 + 32
+    else:
+        unit, f = 'F', value
+    if f < 10.0:
+        fmt = _TEMPFORMATS[0]
+    else:
+        fmt = _TEMPFORMATS[bisect_left(TEMPTHRESHOLDS, f) + 1]
+    return fmt.format("{0:.0f}{1}".format(value, unit))
+
+
+def alertline(name, alert):
+    """Announcement of a new alert for the place called name."""
+
+    message = utils.str.normalizeWhitespace(alert.get('message', '').replace('\n', ' '))[:300].strip()
+    until = " until {0}".format(alert['expires']) if alert.get('expires') else ""
+    return "{0} {1} :: {2}{3} :: {4}".format(_bu('Weather alert:'), _bold(name), alert.get('description', 'Alert'), until, message)
+
+
+def _number(value):
+    """A number from the API, or None for the ways it says there isn't one ('', 'NA', -9999)."""
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if value <= -999 else value
+
+
+class Hourly():
+    """What the hourly and 10 day replies show, worked out once from an hourly10day response.
+
+    hours is its hourly_forecast. Replies start from the first hour that
+    hasn't begun yet (by its FCTTIME.epoch), so the ones gone by are left out.
+    """
+
+    def __init__(self, hours):
+        self.epochs = [_number(hour['FCTTIME']['epoch']) for hour in hours]
+        self.times = [hour['FCTTIME']['civil'] for hour in hours]
+        self.weekdays = [hour['FCTTIME']['weekday_name_abbrev'] for hour in hours]
+        self.temps = {'F': [_number(hour['temp']['english']) for hour in hours],
+                      'C': [_number(hour['temp']['metric']) for hour in hours]}
+        pops = [int(_number(hour['pop']) or 0) for hour in hours]
+        conditions = [hour['condition'] for hour in hours]
+        # each day's hours (start to end), high, low, most common conditions and highest chance of precipitation.
+        self.days = []
+        start = 0
+        for end in range(1, len(hours) + 1):
+            if end < len(hours) and self.weekdays[end] == self.weekdays[start]:
+                continue
+            day = {'weekday': self.weekdays[start], 'start': start, 'end': end, 'high': {}, 'low': {},
+                   'conditions': max(conditions[start:end], key=conditions[start:end].count), 'pop': max(pops[start:end])}
+            for (unit, temps) in self.temps.items():
+                known = [temp for temp in temps[start:end] if temp is not None]
+                day['high'][unit] = max(known) if known else None
+                day['low'][unit] = min(known) if known else None
+            self.days.append(day)
+            start = end
+        # runs of hours with precipitation likely: (start, end, highest chance).
+        self.windows = []
+        start = None
+        for (i, pop) in enumerate(pops + [0]):
+            if pop >= POPTHRESHOLD and start is None:
+                start = i
+            elif pop < POPTHRESHOLD and start is not None:
+                self.windows.append((start, i, max(pops[start:i])))
+                start = None
+
+    def start(self, now):
+        """Index of the first hour starting at or after now. Hours without a time count as not started."""
+        for (i, epoch) in enumerate(self.epochs):
+            if epoch is None or epoch >= now:
+                return i
+        return len(self.epochs)
+
+
+class Renderer():
+    """Formats API data for one combination of output settings.
+
+    Everything that depends only on the settings (units, colors, which
+    extras to show and the labels around them) is worked out once, when the
+    renderer is built: the main line becomes a single format string plus a
+    list of field getters, so rendering a reply is one pass over the data.
+    """
+
+    # extras that can be shown on the main line, in display order.
+    EXTRAS = ('pressure', 'wind', 'uv', 'visibility', 'dewpoint')
+
+    def __init__(self, imperial, both, colortemp, humidity, extras, updated, wind):
+        """wind turns degrees into a direction."""
+
+        self.imperial = imperial
+        self.colortemp = colortemp
+        self._wind = wind
+        self.unit = 'F' if imperial else 'C'
+        color = coloredtemp if colortemp else (lambda x: x)
+
+        def tempfield(base):
+            """Getter for a temperature field, in the right units and colors."""
+            f, c = base + '_f', base + '_c'
+            if both:
+                return lambda co, days=None: "{0}/{1}".format(color(str(co[f]) + 'F'), color(str(co[c]) + 'C'))
+            elif imperial:
+                return lambda co, days=None: color(str(co[f]) + 'F')
+            else:
+                return lambda co, days=None: color(str(co[c]) + 'C')
+
+        def unitfield(f, fsuffix, c, csuffix):
+            """Getter for any other field with imperial/metric variants."""
+            if both:
+                return lambda co, days=None: "{0}{1}/{2}{3}".format(co[f], fsuffix, co[c], csuffix)
+            elif imperial:
+                return lambda co, days=None: "{0}{1}".format(co[f], fsuffix)
+            else:
+                return lambda co, days=None: "{0}{1}".format(co[c], csuffix)
+
+        def optional(label, base):
+            """Getter for '| label value ', or nothing when the API says NA."""
+            check = base + ('_c' if not (both or imperial) else '_f')
+            label = "| {0} ".format(_bold(label))
+            value = tempfield(base)
+            return lambda co, days=None: "" if str(co[check]).startswith("NA") else "{0}{1} ".format(label, value(co))
+
+        getters = {'pressure': unitfield('pressure_in', 'in', 'pressure_mb', 'mb'),
+                   'visibility': unitfield('visibility_mi', 'mi', 'visibility_km', 'km'),
+                   'dewpoint': tempfield('dewpoint'),
+                   'uv': lambda co, days=None: co['UV'],
+                   'wind': self._windfield}
+
+        # now build the main line: literal text goes straight into the format
+        # string, data goes in through a getter.
+        fmt = []
+        fields = []
+
+        def field(getter, bold=False):
+            placeholder = '{%d}' % len(fields)
+            fmt.append(_bold(placeholder) if bold else placeholder)
+            fields.append(getter)
+
+        def text(string):
+            fmt.append(_literal(string))
+
+        field(lambda co, days: co['display_location']['full'], bold=True)
+        text(" :: ")
+        field(lambda co, days: co['weather'])
+        text(" :: ")
+        field(tempfield('temp'))
+        if humidity:
+            text(" (Humidity: ")
+            field(lambda co, days: co['relative_humidity'])
+            text(") ")
+        else:
+            text(" ")
+        # windchill/heatindex are conditional on season.
+        field(optional('Wind Chill:', 'windchill'))
+        field(optional('Heat Index:', 'heat_index'))
+        for extra in self.EXTRAS:
+            if extra in extras:
+                text("| {0}: ".format(_bold(extra.title())))
+                field(getters[extra])
+                text(" ")
+        # the first two forecast periods.
+        fcttext = 'fcttext' if imperial else 'fcttext_metric'
+        text("| ")
+        field(lambda co, days: days[0]['title'], bold=True)
+        text(": ")
+        field(lambda co, days: days[0][fcttext])
+        text(" ")
+        field(lambda co, days: days[1]['title'], bold=True)
+        text(": ")
+        field(lambda co, days: days[1][fcttext])
+        if updated:
+            text(" | {0} ".format(_bold('Updated:')))
+            field(self._observed)
+        self._format = "".join(fmt)
+        self._fields = fields
+        # just the temperature, for summaries.
+        self._summarytemp = tempfield('temp')
+
+    def _windfield(self, co, days=None):
+        if co['wind_mph'] < 1:  # no wind.
+            return "None"
+        if self.imperial:
+            wind = "{0}@{1}mph".format(self._wind(co['wind_degrees']), co['wind_mph'])
+            if int(co['wind_gust_mph']) > 0:   # gusts?
+                wind += " ({0}mph gusts)".format(co['wind_gust_mph'])
+        else:
+            wind = "{0}@{1}kph".format(self._wind(co['wind_degrees']), co['wind_kph'])
+            if int(co['wind_gust_kph']) > 0:  # gusts?
+                wind += " ({0}kph gusts)".format(co['wind_gust_kph'])
+        return wind
+
+    def _observed(self, co, days=None):
+        """How long ago the observation was made. Concept/method from WunderWeather plugin."""
+
+        observationTime = co.get('observation_epoch')
+        localTime = co.get('local_epoch')
+        # if we don't have the epoches from above, default to obs_time
+        if not observationTime or not localTime:
+            return co.get('observation_time', 'unknown').lstrip('Last Updated on ')
+        s = int(localTime) - int(observationTime)  # format into seconds.
+        if s <= 1:
+            return 'just now'
+        elif s < 60:
+            return '{0}s ago'.format(s)
+        elif s < 120:
+            return '1m ago'
+        elif s < 3600:
+            return '{0}m ago'.format(s // 60)
+        elif s < 7200:
+            return '1hr ago'
+        else:
+            return '{0}hrs ago'.format(s // 3600)
+
+    def _colored(self, temps):
+        return [coloredtemp(x) for x in temps] if self.colortemp else temps
+
+    def main(self, data):
+        """The main weather line: conditions and the next two forecast periods."""
+
+        days = {}
+        for day in data['forecast']['txt_forecast']['forecastday']:
+            days[int(day['period'])] = day
+        co = data['current_observation']
+        return self._format.format(*[getter(co, days) for getter in self._fields]) + _asof(data)
+
+    def summary(self, data):
+        """A compact one line summary: location, temperature and conditions."""
+
+        co = data['current_observation']
+        return "{0}: {1} {2}".format(_bold(co['display_location']['full']), self._summarytemp(co), co['weather']) + _asof(data)
+
+    def alerts(self, data):
+        if data['alerts']:  # alerts is a list. it can also be empty.
+            alert = data['alerts'][0]['message'].replace('\n', ' ')[:300]  # \n->' ' and max 300 chars.
+            alert = utils.str.normalizeWhitespace(alert).strip()  # fix pesky double whitespacing.
+        else:  # no alerts found (empty).
+            alert = "No alerts."
+        return "{0} :: {1}".format(_bu("Alerts:"), alert)
+
+    def almanac(self, data):
+        high, low = data['almanac']['temp_high'], data['almanac']['temp_low']
+        highyear = high.get('recordyear', 'NA')
+        lowyear = low.get('recordyear', 'NA')
+        temps = [high['normal'][self.unit] + self.unit, low['normal'][self.unit] + self.unit]
+        if highyear != "NA" and lowyear != "NA":
+            temps += [high['record'][self.unit] + self.unit, low['record'][self.unit] + self.unit]
+        else:
+            temps += ["NA", "NA"]
+        highnormal, lownormal, highrecord, lowrecord = self._colored(temps)
+        return "{0} :: Normal High: {1} (Record: {2} in {3}) | Normal Low: {4} (Record: {5} in {6})".format(\
+            _bu('Almanac:'), highnormal, highrecord, highyear, lownormal, lowrecord, lowyear)
+
+    def astronomy(self, data):
+        moon = data['moon_phase']
+        sunriseh, sunrisem = moon['sunrise']['hour'], moon['sunrise']['minute']
+        sunseth, sunsetm = moon['sunset']['hour'], moon['sunset']['minute']
+        lengthofday = "%dh%dm" % divmod((((int(sunseth)-int(sunriseh))+float((int(sunsetm)-int(sunrisem))/60.0))*60),60)
+        return "{0} :: Moon illum: {1}%   Moon age: {2}d   Sunrise: {3}:{4}  Sunset: {5}:{6}  Length of Day: {7}".format(\
+            _bu('Astronomy:'), moon['percentIlluminated'], moon['ageOfMoon'], sunriseh, sunrisem,\
+            sunseth, sunsetm, lengthofday)
+
+    def forecast(self, data):
+        scale = 'fahrenheit' if self.imperial else 'celsius'
+        days = data['forecast']['simpleforecast']['forecastday']
+        # highs and lows, interleaved, colored in one go.
+        temps = self._colored([day[hl][scale] + self.unit for day in days for hl in ('high', 'low')])
+        outforecast = []
+        for (i, day) in enumerate(days):
+            outforecast.append("{0}: {1} ({2}/{3})".format(_bold(day['date']['weekday_short']), day['conditions'],\
+                temps[2 * i], temps[2 * i + 1]))
+        return "{0} :: {1}".format(_bu('Forecast:'), " | ".join(outforecast))
+
+    def _temp(self, value):
+        return "NA" if value is None else "{0:.0f}{1}".format(value, self.unit)
+
+    def hourly(self, data, now):
+        """The next 24 hours: temperatures as a sparkline, the low and high, and when precipitation is likely."""
+
+        hourly = data.get('hourly')
+        start = hourly.start(now) if hourly else 0
+        end = min(start + 24, len(hourly.times)) if hourly else 0
+        temps = hourly.temps[self.unit][start:end] if hourly else []
+        known = [temp for temp in temps if temp is not None]
+        if not known:
+            return "{0} :: No hourly forecast.".format(_bu('Hourly:'))
+        (low, high) = (min(known), max(known))
+        scale = (len(SPARKS) - 1) / (high - low) if high > low else 0
+        spark = "".join(" " if temp is None else SPARKS[int(round((temp - low) * scale))] for temp in temps)
+        first, last, lowtemp, hightemp = self._colored([self._temp(temps[0]), self._temp(temps[-1]), self._temp(low), self._temp(high)])
+        times = hourly.times
+        output = ["{0} {1} {2} {3} {4}".format(times[start], first, spark, times[end - 1], last),
+                  "{0} {1} at {2}".format(_bold('Low:'), lowtemp, times[start + temps.index(low)]),
+                  "{0} {1} at {2}".format(_bold('High:'), hightemp, times[start + temps.index(high)])]
+        windows = []
+        for (s, e, pop) in hourly.windows:
+            if s < end and e > start:
+                (s, e) = (max(s, start), min(e, end) - 1)
+                span = times[s] if s == e else "{0}-{1}".format(times[s], times[e])
+                windows.append("{0} {1} ({2}%)".format(hourly.weekdays[s], span, pop))
+        output.append("{0} {1}".format(_bold('Precipitation:'), ", ".join(windows) if windows else "none likely"))
+        return "{0} :: {1}".format(_bu('Hourly:'), " | ".join(output))
+
+    def tenday(self, data, now):
+        """Each day's conditions, high and low, and chance of precipitation if it's likely."""
+
+        hourly = data.get('hourly')
+        days = [day for day in hourly.days if day['end'] > hourly.start(now)] if hourly else []
+        if not days:
+            return "{0} :: No forecast.".format(_bu('10-Day:'))
+        temps = self._colored([self._temp(day[hl][self.unit]) for day in days for hl in ('high', 'low')])
+        output = []
+        for (i, day) in enumerate(days):
+            pop = ", {0}%".format(day['pop']) if day['pop'] >= POPTHRESHOLD else ""
+            output.append("{0}: {1} ({2}/{3}{4})".format(_bold(day['weekday']), day['conditions'], temps[2 * i], temps[2 * i + 1], pop))
+        return "{0} :: {1}".format(_bu('10-Day:'), " | ".join(output))
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=250:
@@ -6,26 +6,892 @@
 ###
 
 from supybot.test import *
+import json
 import os
+import re
+import sqlite3
+import threading
+import time
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # python2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+import supybot.utils as utils
+
+from .cache import CircuitBreaker, Popularity, QuotaGovernor, SingleFlight, TTLCache
+from . import extract
+from .fixtureserver import FIXTURES, Fixtures, FixtureServer
+from .gazetteer import Gazetteer, build
+from .metrics import Metrics
+from .plugin import WeatherDB
+from .providers import Provider
+from .userfile import readusers, writeusers
+from .render import Hourly, Renderer, coloredtemp
+
+class FixtureProvider(Provider):
+    """In-process stand-in serving the recorded responses in fixtures/, keeping a list of what it was asked.
+
+    delay adds that many seconds to every request, to stand in for the network."""
+
+    name = 'fixtures'
+
+    def __init__(self, registryValue=None, metrics=None, delay=0):
+        Provider.__init__(self, registryValue, metrics)
+        self.fixtures = Fixtures()
+        self.delay = delay
+        self.requests = []
+
+    def _request(self, request):
+        self.requests.append(request)
+        if self.delay:
+            time.sleep(self.delay)
+
+    def geocode(self, query):
+        self._request(('geocode', query))
+        results = self.fixtures.autocomplete(query)['RESULTS']
+        if not results:
+            return None
+        return "zmw:%s" % results[0]['zmw']
+
+    def fetch(self, location, features, lang):
+        self._request(('fetch', location, tuple(features)))
+        return extract.prune(self.fixtures.api(location, features))
 
 class WeatherTestCase(PluginTestCase):
     plugins = ('Weather',)
 
     def setUp(self):
         PluginTestCase.setUp(self)
-        apiKey = os.environ.get('apiKey')
-        if not apiKey:
-            e = """The Wunderground API key has not been set.
-            please set this value correctly and try again:
-            'export apiKey=<key>' for bash users"""
-            raise Exception(e)
-        conf.supybot.plugins.Weather.apiKey.setValue(apiKey)
+        # answer from recorded responses instead of the live API.
+        self.server = FixtureServer()
+        self.server.start()
+        conf.supybot.plugins.Weather.apiUrl.setValue(self.server.url + 'api/')
+        conf.supybot.plugins.Weather.autocompleteUrl.setValue(self.server.url + 'aq')
+        conf.supybot.plugins.Weather.apiKey.setValue('KEY')
+        conf.supybot.plugins.Weather.disableColoredTemp.setValue(True)
+        self.assertNotError('reload Weather')
+
+    def tearDown(self):
+        self.server.stop()
+        for name in ('apiUrl', 'autocompleteUrl', 'apiKey', 'disableColoredTemp'):
+            value = conf.supybot.plugins.Weather.get(name)
+            value.setValue(value._default)
+        PluginTestCase.tearDown(self)
 
     def testWeather(self):
-        self.assertSnarfResponse('reload Weather', 'The operation succeeded.')
         self.assertRegexp('wunderground 10002', 'New York, NY')
         self.assertSnarfResponse('setweather 10002', "I have changed test's weather ID to 10002")
         self.assertSnarfResponse('setuser metric True', "I have changed test's metric setting to 1")
         self.assertRegexp('wunderground', 'New York, NY')
 
+    def replies(self, command):
+        """All the replies to command, without formatting."""
+        replies = [self.getMsg(command)]
+        while True:
+            msg = self.irc.takeMsg()
+            if msg is None:
+                break
+            replies.append(msg)
+        return [ircutils.stripFormatting(msg.args[1]) for msg in replies]
+
+    def testOutput(self):
+        self.assertEqual(self.replies('wunderground --humidity --wind London, UK'),
+                         ['London, United Kingdom :: Overcast :: 44.6F/7.0C (Humidity: 87%) | Wind Chill: 39F/4C | Wind: N@11.0mph '
+                          '| Wednesday: Cloudy. High 70F. Winds NNE at 5 to 10 mph. Wednesday Night: Cloudy. High 69F. Winds NNE at 5 to 10 mph.'])
+        replies = self.replies('wunderground --alerts --forecast new york')
+        self.assertEqual(len(replies), 3)
+        self.assertTrue(replies[1].startswith('Alerts: :: ...Wind Advisory in effect until 6 PM EDT this evening... The National'))
+        self.assertEqual(replies[2], 'Forecast: :: Wed: Partly Cloudy (72F/55F) | Thu: Partly Cloudy (71F/54F) '
+                                     '| Fri: Partly Cloudy (70F/53F) | Sat: Partly Cloudy (69F/52F)')
+        self.assertEqual(self.replies('wunderground --metric --almanac --astronomy london')[1:],
+                         ['Almanac: :: Normal High: 15C (Record: NA in NA) | Normal Low: 8C (Record: NA in NA)',
+                          'Astronomy: :: Moon illum: 87%   Moon age: 18d   Sunrise: 7:29  Sunset: 18:00  Length of Day: 10h31m'])
+
+    def testLocations(self):
+        self.assertError('wunderground nowhere')
+        # ambiguous saved locations go to the first match, and are remembered.
+        self.assertNotError('setweather springfield')
+        self.assertRegexp('wunderground', 'Springfield, IL')
+        self.assertRegexp('wunderground', 'Springfield, IL')
+        self.assertEqual(len([path for path in self.server.requests if path.endswith('/springfield.json')]), 1)
+
+    def testNotFound(self):
+        # locations that don't exist are remembered for a while.
+        self.assertRegexp('wunderground nowhere', 'could not find a valid location for: nowhere')
+        self.assertRegexp('wunderground nowhere', 'could not find a valid location for: nowhere')
+        self.assertNotError('setweather atlantis')
+        self.assertRegexp('wunderground', "error searching 'atlantis'. \\(querynotfound")
+        self.assertRegexp('wunderground', "error searching 'atlantis'. \\(querynotfound")
+        self.assertEqual(len([path for path in self.server.requests if 'nowhere' in path or 'atlantis' in path]), 2)
+
+    def testStale(self):
+        cb = self.irc.getCallback('Weather')
+        cb.quota = QuotaGovernor(1, 0)
+        self.assertNotRegexp('wunderground 10002', 'as of')
+        # conditions have expired, and there's no quota left to refresh them.
+        cb.cache.clock = lambda: time.time() + 700
+        self.assertRegexp('wunderground 10002', 'New York, NY.*Partly Cloudy.* \\(as of 11 min ago\\)$')
+        self.assertEqual(cb.revalidate, {('zmw:10001.5.99999', 'EN'): set(['conditions'])})
+        requests = len(self.server.requests)
+        # they're refreshed in the background once there's quota again.
+        cb.quota.tokens = 1
+        cb._prefetching.acquire()
+        cb._prefetchrun()
+        self.assertEqual(len(self.server.requests), requests + 1)
+        self.assertEqual(cb.revalidate, {})
+        self.assertNotRegexp('wunderground 10002', 'as of')
+        # with nothing to fall back on, say why.
+        self.assertRegexp('wunderground london', 'out of Wunderground API calls')
+
+    def testBreaker(self):
+        conf.supybot.plugins.Weather.apiUrl.setValue('http://127.0.0.1:1/api/')  # nothing listens there.
+        for _ in range(4):
+            self.assertRegexp('wunderground 10002', 'Failed to load Wunderground API')
+        # the fifth failure in a row opens the breaker, and then we don't even try.
+        self.assertRegexp('wunderground 10002', 'unavailable right now')
+        self.assertRegexp('wunderground 10002', 'unavailable right now')
+        self.assertEqual(self.irc.getCallback('Weather').breakers[('wunderground', 'api')].rejected, 1)
+        self.assertRegexp('stats', 'API: open \\(retry in \\d+s\\), 1 failed fast \\| Autocomplete: closed')
+
+    def testProviders(self):
+        conf.supybot.plugins.Weather.hedgeDelay.setValue(0.1)
+        try:
+            cb = self.irc.getCallback('Weather')
+            stand_in = FixtureProvider(cb.registryValue, cb.metrics)
+            cb._setproviders([cb.providers[0], stand_in])
+            # the first one's slow, so the second gets asked too and answers first.
+            cb.db.setlocation('10002', 'zmw:10001.5.99999')
+            self.server.delay = 1
+            start = time.time()
+            self.assertRegexp('wunderground 10002', 'New York, NY.* :: Partly Cloudy :: 61.2F/16.2C')
+            self.assertTrue(time.time() - start < 1, time.time() - start)
+            self.assertEqual(stand_in.requests, [('fetch', 'zmw:10001.5.99999', ('conditions', 'forecast'))])
+            # and when it's down, it's skipped.
+            self.server.delay = 0
+            conf.supybot.plugins.Weather.apiUrl.setValue('http://127.0.0.1:1/api/')
+            self.assertRegexp('wunderground london', 'London, United Kingdom')
+            self.assertEqual(len(stand_in.requests), 2)
+            self.assertRegexp('stats', 'API \\(wunderground\\): closed \\| Autocomplete \\(wunderground\\): closed '
+                                       '\\| API \\(fixtures\\): closed')
+        finally:
+            conf.supybot.plugins.Weather.hedgeDelay.setValue(2.0)
+
+    def testGazetteer(self):
+        conf.supybot.plugins.Weather.gazetteer.dumps.setValue([os.path.join(FIXTURES, 'cities.txt'), os.path.join(FIXTURES, 'postalcodes.txt')])
+        try:
+            self.assertNotError('reload Weather')
+            cb = self.irc.getCallback('Weather')
+            for _ in range(500):  # it's built in the background.
+                if cb.gazetteer:
+                    break
+                time.sleep(0.01)
+            requests = len(self.server.requests)
+            self.assertRegexp('wunderground London', 'London, United Kingdom')
+            self.assertRegexp('wunderground 10012', 'New York, NY')
+            self.assertRegexp('wunderground 40.72,-74.00', 'New York, NY')
+            self.assertEqual([r for r in self.server.requests[requests:] if r.startswith('/aq')], [])
+            self.assertIn('| Gazetteer: 18 places, 3 local lookups', self.replies('stats')[0])
+        finally:
+            conf.supybot.plugins.Weather.gazetteer.dumps.setValue([])
+
+    def testHourly(self):
+        cb = self.irc.getCallback('Weather')
+        cb.cache.clock = lambda: 1476885600  # when the recorded forecast starts.
+        replies = self.replies('wunderground --hourly --10day 10002')
+        self.assertEqual(replies[1], 'Hourly: :: 10:00 AM 62F \u2586\u2586\u2587\u2588\u2588\u2588\u2588\u2588\u2587\u2586\u2586\u2585'
+                                     '\u2584\u2583\u2582\u2582\u2581\u2581\u2581\u2581\u2582\u2583\u2583\u2584 9:00 AM 59F '
+                                     '| Low: 51F at 3:00 AM | High: 68F at 2:00 PM | Precipitation: none likely')
+        self.assertTrue(replies[2].startswith('10-Day: :: Wed: Clear (68F/56F) | Thu: Mostly Cloudy (67F/51F, 60%) | Fri: '))
+        hourly = cb.cache.get(('zmw:10001.5.99999', 'hourly10day', 'EN'))['hourly']
+        # both came from one API call, and later replies are made from the same entry.
+        self.assertTrue(self.replies('wunderground --10day 10002')[1].startswith('10-Day: :: Wed: Clear (68F/56F)'))
+        self.assertTrue('Low: 11C at 2:00 AM' in self.replies('wunderground --hourly --metric 10002')[1])
+        self.assertEqual(len([path for path in self.server.requests if 'hourly10day' in path]), 1)
+        self.assertTrue(cb.cache.get(('zmw:10001.5.99999', 'hourly10day', 'EN'))['hourly'] is hourly)
+        self.assertEqual(self.replies('wunderground --hourly london')[1], 'Hourly: :: No hourly forecast.')
+
+    def testImportUsers(self):
+        with open(conf.supybot.directories.data.dirize('WeatherUsers.json'), 'w') as f:
+            json.dump([{'nick': 'test', 'location': '10002', 'metric': 1}, {'nick': 'other', 'location': 'london'}], f)
+        self.assertRegexp('importusers WeatherUsers.json', 'Imported 2 users')
+        self.assertRegexp('wunderground', 'New York, NY.*High 21C')  # test's settings came along.
+        self.assertRegexp('exportusers WeatherUsers.csv', 'Exported 2 users')
+        with open(conf.supybot.directories.data.dirize('WeatherUsers.csv')) as f:
+            self.assertEqual(f.readline().strip(), 'nick,location,metric,colortemp,alerts,almanac,astronomy,forecast,pressure,wind,uv,visibility,dewpoint,humidity,updated')
+        self.assertError('importusers nothere.json')
+
+    def testPersist(self):
+        self.assertRegexp('wunderground 10002', 'New York, NY')
+        requests = len(self.server.requests)
+        # a fresh start loads the responses from the DB instead of asking again.
+        self.assertNotError('reload Weather')
+        self.assertRegexp('wunderground 10002', 'New York, NY')
+        self.assertEqual(len(self.server.requests), requests)
+        self.assertIn('| 2 loaded from disk |', self.replies('stats')[0])
+        # expired ones can still be shown stale.
+        self.assertNotError('reload Weather')
+        cb = self.irc.getCallback('Weather')
+        cb.quota = QuotaGovernor(1, 0)
+        cb.quota.tokens = 0
+        cb.cache.clock = lambda: time.time() + 700
+        self.assertRegexp('wunderground 10002', 'New York, NY.*\\(as of 11 min ago\\)$')
+
+    def testMetrics(self):
+        self.assertResponse('stats', 'Cache: 0 entries | 0 hits, 0 misses (0.0% hit rate) | 0 evictions | '
+                                     '0 coalesced requests | 0 loaded from disk | 0 unknown locations remembered | 0 stale replies | '
+                                     'Quota: 10/10 calls left this minute, 0/500 used today, 0 over quota | API: closed | Autocomplete: closed')
+        self.assertEqual(ircutils.stripFormatting(self.irc.takeMsg().args[1]),
+                         'Timings (p50/p95/p99 of the last 1000): no lookups yet | 0 API calls, 0 autocomplete calls')
+        self.assertNotError('wunderground new york')
+        self.assertNotError('wunderground new york')
+        replies = self.replies('stats')
+        self.assertTrue(re.search('^Timings \\(p50/p95/p99 of the last 1000\\): total [\\d.]+/[\\d.]+/[\\d.]+ms \\(2\\) '
+                                  '\\| autocomplete .* \\(2\\) \\| fetch .* \\(2\\) \\| api .* \\(1\\) \\| decode .* \\(1\\) '
+                                  '\\| format .* \\(2\\) \\| 1 API calls, 1 autocomplete calls$', replies[1]), replies[1])
+
+class WeatherDigestTestCase(ChannelPluginTestCase):
+    plugins = ('Weather',)
+    config = {'supybot.plugins.Weather.disableColoredTemp': True}
+
+    def setUp(self):
+        ChannelPluginTestCase.setUp(self)
+        cb = self.irc.getCallback('Weather')
+        cb._setproviders([FixtureProvider(cb.registryValue, cb.metrics)])
+
+    def testDigests(self):
+        self.assertResponse('digests', '#test has no digests.')
+        self.assertError('adddigest 7am London')
+        self.assertNotError('adddigest 7:00 London | 10002 | london')
+        self.assertNotError('adddigest 18:30 KJFK')
+        self.assertResponse('digests', '07:00: London | 10002 | london; 18:30: KJFK')
+        self.assertNotError('deldigest 18:30')
+        self.assertError('deldigest 18:30')
+        self.assertResponse('digests', '07:00: London | 10002 | london')
+        self.assertError('deldigest 7am')
+        self.assertNotError('deldigest 7:00')  # stored as 07:00.
+        self.assertResponse('digests', '#test has no digests.')
+
+    def testDigestRun(self):
+        cb = self.irc.getCallback('Weather')
+        self.irc.feedMsg(ircmsgs.join('#other', prefix=self.irc.prefix))
+        cb.db.setdigest(self.irc.network, '#test', '07:00', ['London', '10002'])
+        cb.db.setdigest(self.irc.network, '#other', '07:00', ['london'])
+        cb.db.setdigest(self.irc.network, '#gone', '07:00', ['KJFK'])  # not joined.
+        cb.db.setdigest(self.irc.network, '#test', '08:00', ['Springfield'])
+        while self.irc.takeMsg():
+            pass
+        cb._digestrun(cb.db.duedigests(['07:00']))
+        posted = []
+        while True:
+            msg = self.irc.takeMsg()
+            if msg is None:
+                break
+            posted.append((msg.args[0], ircutils.stripFormatting(msg.args[1]).split(' :: ')[0]))
+        self.assertEqual(posted, [('#other', 'London, United Kingdom'), ('#test', 'London, United Kingdom'), ('#test', 'New York, NY')])
+        # london was fetched once for both channels, and #gone's location not at all.
+        self.assertEqual(sorted(request[1] for request in cb.providers[0].requests if request[0] == 'fetch'), ['zmw:00000.1.03772', 'zmw:10001.5.99999'])
+
+    def testDigestErrors(self):
+        cb = self.irc.getCallback('Weather')
+        self.irc.feedMsg(ircmsgs.join('#other', prefix=self.irc.prefix))
+        cb.db.setdigest(self.irc.network, '#test', '07:00', ['London', '10002'])
+        cb.db.setdigest(self.irc.network, '#other', '07:00', ['10002'])
+        while self.irc.takeMsg():
+            pass
+        (lookup, settings) = (cb._lookup, cb._settings)
+        def brokenlookup(urlArgs, location):
+            if location == 'London':
+                raise ValueError('broken')
+            return lookup(urlArgs, location)
+        def brokensettings(nick, channel):
+            if channel == '#other':
+                raise ValueError('broken')
+            return settings(nick, channel)
+        (cb._lookup, cb._settings) = (brokenlookup, brokensettings)
+        cb._digestrun(cb.db.duedigests(['07:00']))
+        posted = []
+        while True:
+            msg = self.irc.takeMsg()
+            if msg is None:
+                break
+            posted.append((msg.args[0], ircutils.stripFormatting(msg.args[1]).split(' :: ')[0]))
+        # #other's digest failed, and London's lookup, but the rest still went out.
+        self.assertEqual(posted, [('#test', 'Failed to get weather for: London'), ('#test', 'New York, NY')])
+
+    def testDueTimes(self):
+        cb = self.irc.getCallback('Weather')
+        minute = int(time.time() // 60)
+        cb._digested = minute - 1
+        hhmm = lambda m: time.strftime('%H:%M', time.localtime(m * 60))
+        self.assertEqual(cb._duetimes(minute), [hhmm(minute)])
+        self.assertEqual(cb._duetimes(minute), [])
+        # skipped minutes are caught up on, up to ten.
+        self.assertEqual(cb._duetimes(minute + 3), [hhmm(minute + 1), hhmm(minute + 2), hhmm(minute + 3)])
+        self.assertEqual(len(cb._duetimes(minute + 60)), 10)
+
+class WeatherSubscriptionTestCase(ChannelPluginTestCase):
+    plugins = ('Weather',)
+    config = {'supybot.plugins.Weather.disableColoredTemp': True}
+
+    def setUp(self):
+        ChannelPluginTestCase.setUp(self)
+        cb = self.irc.getCallback('Weather')
+        cb._setproviders([FixtureProvider(cb.registryValue, cb.metrics)])
+
+    def testSubscriptions(self):
+        self.assertResponse('subscriptions', "#test doesn't get alerts for any locations.")
+        self.assertNotError('subscribe New  York')
+        self.assertError('subscribe new york')
+        self.assertError('subscribe nowhere')
+        self.assertNotError('subscribe London')
+        self.assertResponse('subscriptions', 'london | new york')
+        self.assertNotError('unsubscribe new york')
+        self.assertError('unsubscribe new york')
+        self.assertResponse('subscriptions', 'london')
+
+    def _poll(self, cb):
+        cb._polling.acquire()  # as _poll does.
+        cb._pollrun()
+        posted = []
+        while True:
+            msg = self.irc.takeMsg()
+            if msg is None:
+                return posted
+            posted.append((msg.args[0], ircutils.stripFormatting(msg.args[1])))
+
+    def testPoll(self):
+        cb = self.irc.getCallback('Weather')
+        self.irc.feedMsg(ircmsgs.join('#other', prefix=self.irc.prefix))
+        while self.irc.takeMsg():
+            pass
+        for (channel, location) in (('#test', '10002'), ('#other', '10002'), ('#test', 'new york'), ('#test', 'london')):
+            cb.db.addsubscription(self.irc.network, channel, location)
+        # the alerts there are when we start could have been announced already.
+        self.assertEqual(self._poll(cb), [])
+        # each location was fetched once, whoever subscribes to it.
+        self.assertEqual(sorted(request[1] for request in cb.providers[0].requests if request[0] == 'fetch'), ['zmw:00000.1.03772', 'zmw:10001.5.99999'])
+        cb.seenalerts.clear()  # as if it were just issued.
+        alert = ('Weather alert: New York, NY :: Wind Advisory until 6:00 PM EDT on October 19, 2016 :: '
+                 '...Wind Advisory in effect until 6 PM EDT this evening...')
+        posted = self._poll(cb)
+        # once per channel, though #test has it for two locations.
+        self.assertEqual([channel for (channel, line) in posted], ['#other', '#test'])
+        self.assertTrue(posted[0][1].startswith(alert))
+        self.assertTrue(len(posted[0][1]) < 400)
+        self.assertEqual(self._poll(cb), [])
+        self.assertEqual(len(cb.seenalerts), 2)  # (10002 and new york).
+
+class WeatherFeatureTestCase(PluginTestCase):
+    plugins = ('Weather',)
+
+    def testFeatureTTL(self):
+        cb = self.irc.getCallback('Weather')
+        self.assertEqual(cb._featurettl('conditions', {}), conf.supybot.plugins.Weather.cache.ttl.conditions())
+        # almanac lasts until midnight at the location.
+        utc = time.time() % 86400
+        for offset, hours in (('+0000', 0), ('-0400', -4), ('+0530', 5.5)):
+            data = {'current_observation': {'local_tz_offset': offset}}
+            expected = 86400 - (utc + hours * 3600) % 86400
+            self.assertAlmostEqual(cb._featurettl('almanac', data), expected, delta=5)
+        self.assertTrue(0 < cb._featurettl('astronomy', {}) <= 86400)
+
+class WeatherMultiTestCase(PluginTestCase):
+    plugins = ('Weather',)
+
+    def testMulti(self):
+        cb = self.irc.getCallback('Weather')
+        cb.APIKEY = 'KEY'
+        fetched = []
+
+        def wunderjson(urlArgs, location):
+            fetched.append(location)
+            time.sleep(0.3)
+            if location == 'zmw:bad':
+                return {'response': {'error': {'type': 'querynotfound'}}}
+            return {'response': {}, 'current_observation': {'display_location': {'full': location[4:].title()},
+                                                            'weather': 'Clear', 'temp_f': 70, 'temp_c': 21}}
+        cb._wuac = lambda q: None if q == 'nowhere' else 'zmw:' + q
+        cb._wunderjson = wunderjson
+        conf.supybot.plugins.Weather.disableColoredTemp.setValue(True)
+        try:
+            start = time.time()
+            replies = [self.getMsg('multi boston | nowhere | bad | boston | paris')]
+            while len(replies) < 4:
+                replies.append(self.irc.takeMsg())
+            replies = [ircutils.stripFormatting(m.args[1]) for m in replies]
+            self.assertEqual(replies, ['Boston: 70F/21C Clear', 'I could not find a valid location for: nowhere',
+                                       "I got an error searching 'bad'. (querynotfound: no description)", 'Paris: 70F/21C Clear'])
+            # fetched at the same time, and only once each.
+            self.assertTrue(time.time() - start < 0.8)
+            self.assertEqual(sorted(fetched), ['zmw:bad', 'zmw:boston', 'zmw:paris'])
+            self.assertError('multi a | b | c | d | e | f')
+            # a reply that can't be made doesn't take the others with it.
+            cb._wunderjson = lambda urlArgs, location: {'response': {}} if location == 'zmw:broken' else wunderjson(urlArgs, location)
+            replies = [self.getMsg('multi broken | paris'), self.irc.takeMsg()]
+            self.assertEqual([ircutils.stripFormatting(m.args[1]) for m in replies], ['Failed to get weather for: broken', 'Paris: 70F/21C Clear'])
+        finally:
+            conf.supybot.plugins.Weather.disableColoredTemp.setValue(False)
+
+class WeatherPrefetchTestCase(PluginTestCase):
+    plugins = ('Weather',)
+    config = {'supybot.plugins.Weather.prefetch.locations': 2,
+              'supybot.plugins.Weather.prefetch.maxPerMinute': 6000}
+
+    def testPrefetch(self):
+        cb = self.irc.getCallback('Weather')
+        fetched = []
+
+        def wunderfetch(urlArgs, location, cached, background=False):
+            fetched.append((location, tuple(urlArgs['features'])))
+            if location == 'nowhere':
+                return {'response': {'error': {'type': 'querynotfound'}}}
+            for feature in urlArgs['features']:
+                cb.cache.set((location, feature, urlArgs['lang']), {feature: location}, 600)
+            return {'response': {}}
+        cb._wunderfetch = wunderfetch
+        # saved locations count, as do lookups.
+        for (nick, location) in (('a', '10002'), ('b', '10002'), ('c', 'nowhere')):
+            cb.db.setweather(nick, location)
+        cb._prefetching.acquire()
+        cb._prefetchrun()
+        self.assertEqual(fetched, [('10002', ('conditions', 'forecast')), ('nowhere', ('conditions', 'forecast'))])
+        # the failed one is dropped; the rest are fresh, until they're about to expire.
+        cb.popular.hit(('KJFK', 'EN'), ['conditions'])
+        del fetched[:]
+        cb._prefetching.acquire()
+        cb._prefetchrun()
+        self.assertEqual(fetched, [('KJFK', ('conditions',))])
+        cb.cache.set(('10002', 'forecast', 'EN'), {}, 60)
+        del fetched[:]
+        cb._prefetching.acquire()
+        cb._prefetchrun()
+        self.assertEqual(fetched, [('10002', ('forecast',))])
+        self.assertResponse('stats', 'Cache: 3 entries | 0 hits, 0 misses (0.0% hit rate) | 0 evictions | '
+                                     '0 coalesced requests | 0 loaded from disk | 0 unknown locations remembered | 0 stale replies | '
+                                     'Quota: 10/10 calls left this minute, 0/500 used today, 0 over quota | API: closed | Autocomplete: closed '
+                                     '| Prefetch: 4 refreshes, 2 locations tracked')
+
+class FakeClock():
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class WeatherCacheTestCase(SupyTestCase):
+    def testTTL(self):
+        clock = FakeClock()
+        cache = TTLCache(60, 10, clock=clock)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=120)
+        self.assertEqual(cache.get('a'), 1)
+        clock.now += 90
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(cache.get('c'), None)
+        self.assertEqual(cache.stats(), {'entries': 2, 'hits': 2, 'misses': 2, 'evictions': 0})
+
+    def testLRU(self):
+        cache = TTLCache(60, 2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')  # b is now the least recently used.
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.evictions, 1)
+
+class WeatherRenderTestCase(SupyTestCase):
+    data = {'current_observation': {'display_location': {'full': 'Testville, NY'}, 'weather': 'Clear',
+                                    'temp_f': 70, 'temp_c': 21, 'relative_humidity': '50%',
+                                    'windchill_f': 'NA', 'windchill_c': 'NA', 'heat_index_f': 'NA', 'heat_index_c': 'NA',
+                                    'pressure_in': '30.1', 'pressure_mb': '1019', 'wind_mph': 0},
+            'forecast': {'txt_forecast': {'forecastday': [
+                {'period': 0, 'title': 'Today', 'fcttext': 'Sunny.', 'fcttext_metric': 'Sunny!'},
+                {'period': 1, 'title': 'Tonight', 'fcttext': 'Clear.', 'fcttext_metric': 'Clear!'}]}},
+            'almanac': {'temp_high': {'normal': {'F': '64', 'C': '18'}, 'record': {'F': '84', 'C': '29'}, 'recordyear': '1963'},
+                        'temp_low': {'normal': {'F': '50', 'C': '10'}, 'record': {'F': '35', 'C': '2'}, 'recordyear': '1940'}}}
+
+    def testMain(self):
+        renderer = Renderer(True, False, False, True, ('pressure', 'wind'), False, None)
+        self.assertEqual(ircutils.stripFormatting(renderer.main(self.data)),
+                         "Testville, NY :: Clear :: 70F (Humidity: 50%) | Pressure: 30.1in | Wind: None "
+                         "| Today: Sunny. Tonight: Clear.")
+        renderer = Renderer(False, True, False, False, (), False, None)
+        self.assertEqual(ircutils.stripFormatting(renderer.main(self.data)),
+                         "Testville, NY :: Clear :: 70F/21C | Today: Sunny! Tonight: Clear!")
+
+    def testHourly(self):
+        def hour(epoch, civil, weekday, temp, pop):
+            return {'FCTTIME': {'epoch': str(epoch), 'civil': civil, 'weekday_name_abbrev': weekday}, 'temp': {'english': temp, 'metric': temp},
+                    'condition': 'Rain' if pop > 50 else 'Clear', 'pop': str(pop)}
+        hours = [hour(1000, '10:00 PM', 'Mon', '50', 0), hour(4600, '11:00 PM', 'Mon', '-9999', 60), hour(8200, '12:00 AM', 'Tue', '40', 70),
+                 hour(11800, '1:00 AM', 'Tue', '45', 10), hour(15400, '2:00 AM', 'Tue', '48', 40)]
+        data = {'hourly': Hourly(hours)}
+        renderer = Renderer(True, False, False, False, (), False, None)
+        def render(reply, now):
+            return ircutils.stripFormatting(getattr(renderer, reply)(data, now))
+        self.assertEqual(render('hourly', 1000), 'Hourly: :: 10:00 PM 50F \u2588 \u2581\u2585\u2587 2:00 AM 48F '
+                         '| Low: 40F at 12:00 AM | High: 50F at 10:00 PM | Precipitation: Mon 11:00 PM-12:00 AM (70%), Tue 2:00 AM (40%)')
+        # hours that have begun are left out.
+        self.assertEqual(render('hourly', 1000 + 2 * 3600 + 1), 'Hourly: :: 1:00 AM 45F \u2581\u2588 2:00 AM 48F '
+                         '| Low: 45F at 1:00 AM | High: 48F at 2:00 AM | Precipitation: Tue 2:00 AM (40%)')
+        self.assertEqual(render('tenday', 1000), '10-Day: :: Mon: Clear (50F/50F, 60%) | Tue: Clear (48F/40F, 70%)')
+        self.assertEqual(render('tenday', 1000 + 3 * 3600), '10-Day: :: Tue: Clear (48F/40F, 70%)')
+        self.assertEqual(render('tenday', 1000 + 1), '10-Day: :: Mon: Clear (50F/50F, 60%) | Tue: Clear (48F/40F, 70%)')
+        self.assertEqual(render('hourly', 1000 + 5 * 3600), 'Hourly: :: No hourly forecast.')
+
+    def testAlmanac(self):
+        renderer = Renderer(False, False, False, False, (), False, None)
+        self.assertEqual(ircutils.stripFormatting(renderer.almanac(self.data)),
+                         "Almanac: :: Normal High: 18C (Record: 29C in 1963) | Normal Low: 10C (Record: 2C in 1940)")
+
+    def testColoredTemp(self):
+        def color(x):
+            return ircutils.mircColor(x[1], x[0])
+        for (temp, expected) in (('9F', ('light blue', '9F')), ('10F', ('teal', '10F')), ('32F', ('teal', '32F')),
+                                 ('32.05F', ('blue', '32F')), ('50.5F', ('light green', '50F')), ('90F', ('orange', '90F')),
+                                 ('90.01F', ('red', '90F')), ('0C', ('teal', '0C')), ('-15.2C', ('light blue', '-15C'))):
+            self.assertEqual(coloredtemp(temp), color(expected))
+        self.assertEqual(coloredtemp('NA'), 'NA')
+        self.assertEqual(coloredtemp('F'), 'F')
+        # replies color all their temperatures in one go, or none of them.
+        data = {'almanac': {'temp_high': {'normal': {'F': '61'}}, 'temp_low': {'normal': {'F': '95'}}}}  # no records.
+        almanac = "Normal High: {0} (Record: NA in NA) | Normal Low: {1} (Record: NA in NA)"
+        renderer = Renderer(True, False, True, False, (), False, None)
+        self.assertEqual(ircutils.stripFormatting(renderer.almanac(data).split(' :: ')[0]), 'Almanac:')
+        self.assertEqual(renderer.almanac(data).split(' :: ')[1], almanac.format(color(('green', '61F')), color(('red', '95F'))))
+        renderer = Renderer(True, False, False, False, (), False, None)
+        self.assertEqual(renderer.almanac(data).split(' :: ')[1], almanac.format('61F', '95F'))
+
+class WeatherExtractTestCase(SupyTestCase):
+    def _page(self, name):
+        with open(os.path.join(FIXTURES, name), 'rb') as f:
+            return f.read()
+
+    def testPrune(self):
+        data = json.loads(self._page('newyork.json').decode('utf-8'))
+        pruned = extract.prune(data)
+        self.assertEqual(set(pruned['alerts'][0]), set(['type', 'description', 'date_epoch', 'expires', 'expires_epoch', 'phenomena', 'significance', 'message']))
+        self.assertEqual(set(extract.prune({'alerts': [{'message': 'm', 'ZONES': []}]})['alerts'][0]), set(['message']))
+        # everything the replies use is still there.
+        for (imperial, both) in ((True, True), (False, False)):
+            renderer = Renderer(imperial, both, False, True, Renderer.EXTRAS, True, lambda angle: 'N')
+            for reply in ('main', 'summary', 'alerts', 'almanac', 'astronomy', 'forecast'):
+                self.assertEqual(getattr(renderer, reply)(pruned), getattr(renderer, reply)(data))
+        hourly = extract.extract(self._page('hourly10day.json'))['hourly_forecast']
+        self.assertEqual(len(hourly), 240)
+        self.assertEqual(set(hourly[0]), set(['FCTTIME', 'temp', 'condition', 'pop']))
+        self.assertEqual(set(hourly[0]['FCTTIME']), set(['epoch', 'civil', 'weekday_name_abbrev']))
+
+    def testStream(self):
+        if extract.ijson is None:
+            return
+        for name in ('newyork.json', 'hourly10day.json', 'springfield.json'):
+            page = self._page(name)
+            self.assertEqual(extract.extract(page, 1), extract.prune(json.loads(page.decode('utf-8'))))
+        self.assertEqual(extract.stream(b'{"alerts": null, "forecast": {"txt_forecast": 1}, "x": [1]}'),
+                         {'alerts': None, 'forecast': {'txt_forecast': 1}, 'x': [1]})
+        # broken responses fail like they always have.
+        self.assertRaises(ValueError, extract.extract, b'{"response": ', 1)
+
+class WeatherMetricsTestCase(SupyTestCase):
+    def testMetrics(self):
+        clock = FakeClock()
+        metrics = Metrics(size=100, clock=clock)
+        self.assertEqual(metrics.percentiles('total'), None)
+        for ms in range(1, 201):
+            with metrics.time('total'):
+                clock.now += ms / 1000.0
+        # only the last 100 are kept.
+        (n, p50, p95, p99) = metrics.percentiles('total')
+        self.assertEqual(n, 100)
+        self.assertAlmostEqual(p50, 0.151)
+        self.assertAlmostEqual(p95, 0.196)
+        self.assertAlmostEqual(p99, 0.2)
+        metrics.record('custom', 0.002)
+        metrics.count('api')
+        metrics.count('api', 2)
+        self.assertEqual(metrics.counters, {'api': 3})
+        self.assertEqual(metrics.recorded, 201)
+        self.assertEqual(metrics.report(), 'total 151.0/196.0/200.0ms (100) | custom 2.0/2.0/2.0ms (1)')
+
+class WeatherGazetteerTestCase(SupyTestCase):
+    def testGazetteer(self):
+        filename = conf.supybot.directories.data.dirize('WeatherTest.gaz')
+        self.assertEqual(build(filename, [os.path.join(FIXTURES, 'cities.txt'), os.path.join(FIXTURES, 'postalcodes.txt')]), 18)
+        gazetteer = Gazetteer(filename)
+        try:
+            # the most populous one, unless the country is given.
+            self.assertEqual(gazetteer.lookup('paris')[0], 'Paris, FR')
+            self.assertEqual(gazetteer.lookup(' Paris,US ')[0], 'Paris, US')
+            self.assertEqual(gazetteer.lookup('62701')[0], '62701 Springfield, US')
+            self.assertEqual(gazetteer.lookup('pari'), None)
+            self.assertEqual([place[0] for place in gazetteer.prefix('lo')], ['London, GB', 'London, CA'])
+            self.assertEqual(gazetteer.prefix('x'), [])
+            (label, lat, lon, km) = gazetteer.nearest(48.2, 16.3)
+            self.assertEqual(label, 'Wien, AT')
+            self.assertAlmostEqual(km, 5.4, delta=0.1)
+            self.assertEqual(gazetteer.nearest(-33.9, 151.2)[0], 'Sydney, AU')
+            # across the antimeridian from Suva, which is closer than Apia on this side.
+            (label, lat, lon, km) = gazetteer.nearest(-18.1, -179.9)
+            self.assertEqual(label, 'Suva, FJ')
+            self.assertAlmostEqual(km, 175.4, delta=0.1)
+        finally:
+            gazetteer.close()
+        # closed while being looked up in: not found, rather than misfound.
+        self.assertRaises(ValueError, gazetteer.lookup, 'paris')
+
+class WeatherQuotaTestCase(SupyTestCase):
+    def testQuota(self):
+        clock = FakeClock()
+        quota = QuotaGovernor(4, 6, clock=clock)
+        for _ in range(3):
+            self.assertTrue(quota.acquire())
+        # background calls only go ahead while half of the budget is left.
+        self.assertFalse(quota.acquire(background=True))
+        self.assertTrue(quota.acquire())
+        self.assertFalse(quota.acquire())
+        clock.now += 30  # two tokens back, but most of today's calls are used.
+        self.assertFalse(quota.acquire(background=True))
+        self.assertTrue(quota.acquire())
+        self.assertTrue(quota.acquire())
+        # that's the daily limit.
+        clock.now += 60
+        self.assertFalse(quota.available())
+        self.assertEqual((quota.today, quota.denied), (6, 3))
+        clock.now += 86400
+        self.assertTrue(quota.acquire())
+
+class WeatherBreakerTestCase(SupyTestCase):
+    def testBreaker(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(2, 60, clock=clock)
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        breaker.success()  # failures have to be in a row.
+        breaker.failure()
+        self.assertEqual(breaker.state, 'closed')
+        breaker.failure()
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.retryin(), 60)
+        # after the timeout, one probe goes through.
+        clock.now += 60
+        self.assertEqual(breaker.state, 'half-open')
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.failure()
+        clock.now += 59
+        self.assertFalse(breaker.allow())
+        clock.now += 1
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertEqual(breaker.state, 'closed')
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.rejected, 3)
+
+class WeatherPopularityTestCase(SupyTestCase):
+    def testPopularity(self):
+        popular = Popularity()
+        popular.hit('a', ['conditions'])
+        popular.hit('b', ['conditions'], weight=4)
+        popular.hit('a', ['forecast'])
+        self.assertEqual(popular.top(1), [('b', set(['conditions']))])
+        self.assertEqual(popular.top(5), [('b', set(['conditions'])), ('a', set(['conditions', 'forecast']))])
+        popular.decay()
+        popular.decay()  # a: 0.5, b: 1.
+        self.assertEqual(len(popular), 2)
+        popular.decay()
+        self.assertEqual(popular.top(5), [('b', set(['conditions']))])
+
+class SlowServer(ThreadingMixIn, HTTPServer):
+    """Local HTTP server that takes a while to answer, and counts requests."""
+    daemon_threads = True
+
+    def __init__(self, delay, status=200):
+        self.delay = delay
+        self.status = status
+        self.requests = 0
+        HTTPServer.__init__(self, ('127.0.0.1', 0), SlowHandler)
+        self.url = 'http://127.0.0.1:%d/' % self.server_address[1]
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+class SlowHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests += 1
+        time.sleep(self.server.delay)
+        self.send_response(self.server.status)
+        self.end_headers()
+        self.wfile.write(b'{"ok": true}')
+
+    def log_message(self, *args):
+        pass
+
+class WeatherSingleFlightTestCase(SupyTestCase):
+    def _fetchAll(self, server, count=5):
+        flights = SingleFlight()
+        results = []
+        def worker():
+            try:
+                results.append(flights.do(server.url, utils.web.getUrl, server.url))
+            except Exception as e:
+                results.append(e)
+        threads = [threading.Thread(target=worker) for i in range(count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        server.shutdown()
+        server.server_close()
+        self.assertEqual(flights.shared, count - 1)
+        return results
+
+    def testShared(self):
+        server = SlowServer(0.5)
+        results = self._fetchAll(server)
+        self.assertEqual(server.requests, 1)
+        self.assertEqual(results, [b'{"ok": true}'] * 5)
+
+    def testErrors(self):
+        server = SlowServer(0.5, status=500)
+        results = self._fetchAll(server)
+        self.assertEqual(server.requests, 1)
+        for result in results:
+            self.assertTrue(isinstance(result, utils.web.Error))
+
+class WeatherDBTestCase(SupyTestCase):
+    def testLocations(self):
+        db = WeatherDB()
+        self.assertEqual(db.getlocation('new york', 60), None)
+        db.setlocation('new york', 'zmw:10001.5.99999')
+        self.assertEqual(db.getlocation('new york', 60), 'zmw:10001.5.99999')
+        db.setlocation('new york', 'zmw:10002.1.99999')
+        self.assertEqual(db.getlocation('new york', 60), 'zmw:10002.1.99999')
+        # too old.
+        self.assertEqual(db.getlocation('new york', -1), None)
+
+    def testUsers(self):
+        db = WeatherDB()
+        self.assertFalse(db.getuser('cacheuser'))
+        self.assertEqual(db.getweather('cacheuser'), None)
+        db.setweather('cacheuser', '10002')
+        self.assertTrue(db.getuser('cacheuser'))
+        self.assertEqual(db.getweather('cacheuser')['location'], '10002')
+        self.assertEqual(db.getweather('cacheuser')['colortemp'], 1)
+        db.setsetting('cacheuser', 'metric', 1)
+        db.setweather('cacheuser', '10012')
+        self.assertIn('metric', db.getsettings())
+        # the cached copy matches what's stored.
+        for d in (db, WeatherDB()):
+            settings = d.getweather('cacheuser')
+            self.assertEqual(settings['location'], '10012')
+            self.assertEqual(settings['metric'], 1)
+
+    def testResponses(self):
+        db = WeatherDB()
+        self.assertEqual(db.getresponse('10002', 'conditions', 'EN'), None)
+        db.setresponses([('10002', 'conditions', 'EN', {'current_observation': {'weather': 'Clear'}}, 1000.0, 600),
+                         ('10002', 'forecast', 'EN', {'forecast': {}}, 1000.0, 3600)])
+        self.assertEqual(db.getresponse('10002', 'conditions', 'EN'), ({'current_observation': {'weather': 'Clear'}}, 1000.0, 600))
+        self.assertEqual(db.getresponse('10002', 'conditions', 'FR'), None)
+        # only what expired before the given time goes.
+        self.assertEqual(db.pruneresponses(2000.0), 1)
+        self.assertEqual(db.getresponse('10002', 'conditions', 'EN'), None)
+        self.assertEqual(db.getresponse('10002', 'forecast', 'EN'), ({'forecast': {}}, 1000.0, 3600))
+        db.close()
+
+    def testMigrations(self):
+        filename = conf.supybot.directories.data.dirize('WeatherOld.db')
+        conn = sqlite3.connect(filename)
+        conn.execute("CREATE TABLE users (nick TEXT PRIMARY KEY, location TEXT NOT NULL, metric INTEGER DEFAULT 0, colortemp INTEGER DEFAULT 1)")
+        conn.execute("INSERT INTO users VALUES ('olduser', '10002', 1, 0)")
+        conn.commit()
+        conn.close()
+        # a migration that fails takes the others with it.
+        class BrokenDB(WeatherDB):
+            def _broken(self, cursor):
+                raise sqlite3.OperationalError('broken')
+            MIGRATIONS = WeatherDB.MIGRATIONS + [_broken]
+        self.assertRaises(sqlite3.OperationalError, BrokenDB, filename)
+        conn = sqlite3.connect(filename)
+        self.assertEqual(len(conn.execute("pragma table_info('users')").fetchall()), 4)
+        self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0], 0)
+        conn.close()
+        for _ in range(2):  # the second time, there's nothing to do.
+            db = WeatherDB(filename)
+            self.assertEqual(db.getweather('olduser')['metric'], 1)
+            self.assertEqual(db.getweather('olduser')['forecast'], 0)
+            with db._connect() as conn:
+                self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0], len(WeatherDB.MIGRATIONS))
+            db.close()
+
+    def testImportExport(self):
+        db = WeatherDB(conf.supybot.directories.data.dirize('WeatherImport.db'))
+        db.setweather('known', '10002')
+        self.assertEqual(db.getweather('known')['metric'], 0)  # loads the in-memory copy.
+        users = [{'nick': 'Known', 'location': 'London', 'metric': '1'}, {'nick': 'new', 'location': 10012, 'forecast': 'true'}]
+        self.assertEqual(db.importusers(users), 1)
+        self.assertEqual(db.getweather('known')['location'], '10002')
+        self.assertEqual(db.getweather('new')['location'], '10012')
+        self.assertEqual(db.getweather('new')['forecast'], 1)
+        self.assertEqual(db.getweather('new')['colortemp'], 1)
+        self.assertEqual(db.importusers(users, overwrite=True), 2)
+        self.assertEqual(db.getweather('known')['location'], 'London')
+        self.assertEqual(db.getweather('known')['metric'], 1)
+        # all or nothing.
+        self.assertRaises(ValueError, db.importusers, [{'nick': 'a', 'location': 'b'}, {'nick': 'c', 'location': 'd', 'uv': 'maybe'}])
+        self.assertRaises(ValueError, db.importusers, [{'nick': 'e'}])
+        self.assertFalse(db.getuser('a'))
+        exported = db.exportusers()
+        self.assertEqual([user['nick'] for user in exported], ['known', 'new'])
+        for name in ('WeatherUsers.csv', 'WeatherUsers.json'):
+            filename = conf.supybot.directories.data.dirize(name)
+            writeusers(filename, exported)
+            copy = WeatherDB(conf.supybot.directories.data.dirize('WeatherCopy.db'))
+            self.assertEqual(copy.importusers(readusers(filename), overwrite=True), 2)
+            self.assertEqual(copy.exportusers(), exported)
+            copy.close()
+        txt = conf.supybot.directories.data.dirize('WeatherUsers.txt')
+        self.assertRaises(ValueError, writeusers, txt, exported)
+        self.assertFalse(os.path.exists(txt + '.tmp'))
+        # a failed write leaves neither the file nor its temporary copy.
+        bad = conf.supybot.directories.data.dirize('WeatherBad.json')
+        self.assertRaises(TypeError, writeusers, bad, [{'nick': object()}])
+        self.assertFalse(os.path.exists(bad) or os.path.exists(bad + '.tmp'))
+        db.close()
+
+    def testConcurrency(self):
+        db = WeatherDB(conf.supybot.directories.data.dirize('WeatherStress.db'))
+        errors = []
+        def worker(n):
+            try:
+                for i in range(50):
+                    nick = 'stress%d' % (i % 10)
+                    db.setweather(nick, 'loc%d-%d' % (n, i))
+                    db.setsetting(nick, 'metric', (n + i) % 2)
+                    db.getweather(nick)
+                    db.setlocation('query%d' % i, 'zmw:%d' % n)
+                    db.getlocation('query%d' % i, 60)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        # the in-memory copy agrees with what actually got written.
+        fresh = WeatherDB(db.filename)
+        for i in range(10):
+            self.assertEqual(db.getweather('stress%d' % i), fresh.getweather('stress%d' % i))
+        db.close()
+        fresh.close()
+
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
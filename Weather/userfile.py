@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+###
+# Copyright (c) 2012-2014, spline
+# All rights reserved.
+###
+# Reading and writing Weather users as CSV or JSON, for importusers/exportusers.
+from __future__ import unicode_literals
+import csv
+import io
+import json
+import os
+import sys
+
+
+def _format(filename):
+    """'csv' or 'json', from filename's extension."""
+
+    extension = os.path.splitext(filename)[1].lower()
+    if extension not in ('.csv', '.json'):
+        raise ValueError("{0} should end in .csv or .json.".format(filename))
+    return extension[1:]
+
+
+def _open(filename, mode):
+    if sys.version_info[0] < 3:  # python2's csv only does bytes.
+        return open(filename, mode + 'b')
+    return io.open(filename, mode, encoding='utf-8', newline='')
+
+
+def readusers(filename):
+    """Return the users in filename, as dicts of column -> value.
+
+    CSV files have a header row of column names. JSON files are a list of
+    objects. Either way, any columns can be left out but nick and location.
+    """
+
+    if _format(filename) == 'json':
+        with io.open(filename, encoding='utf-8') as f:
+            users = json.loads(f.read())
+        if not isinstance(users, list) or [user for user in users if not isinstance(user, dict)]:
+            raise ValueError("{0} should be a list of users.".format(filename))
+        return users
+    with _open(filename, 'r') as f:
+        users = list(csv.DictReader(f))
+    if sys.version_info[0] < 3:
+        users = [dict((k.decode('utf-8'), (v or b'').decode('utf-8')) for (k, v) in user.items() if k) for user in users]
+    return users
+
+
+def writeusers(filename, users):
+    """Write users (OrderedDicts of column -> value, all with the same columns) to filename.
+
+    The file is replaced in one go, so it's never seen half written."""
+
+    fmt = _format(filename)
+    tmp = filename + '.tmp'
+    try:
+        with _open(tmp, 'w') as f:
+            if fmt == 'json':
+                f.write(json.dumps(users, indent=1) + '\n')
+            elif users:
+                rows = [list(users[0])] + [list(user.values()) for user in users]
+                if sys.version_info[0] < 3:
+                    rows = [['{0}'.format(value).encode('utf-8') for value in row] for row in rows]
+                csv.writer(f).writerows(rows)
+        os.rename(tmp, filename)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=250: